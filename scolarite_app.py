@@ -1,9 +1,43 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file, abort, g
+from flask import has_app_context, has_request_context, before_render_template, template_rendered
 import os
-from datetime import datetime, timezone  # Ajout de timezone
+import hashlib
+import hmac
+import random
+import time
+import threading
+import click
+import csv
+import json
+import base64
+import tempfile
+import shutil
+import gzip
+import io
+import bisect
+import math
+import fcntl
+import glob
+import smtplib
+import socketserver
+from email.message import EmailMessage
+from email.utils import formatdate, make_msgid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from collections import namedtuple, deque
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta, timezone  # Ajout de timezone
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import secure_filename
 from flask_migrate import Migrate  # Import Flask-Migrate
+from sqlalchemy import event, create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.exc import DisconnectionError, TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from itsdangerous import URLSafeSerializer, BadSignature
 
 # Initialisation de l'application Flask
 app = Flask(__name__)
@@ -21,20 +55,712 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
 # - `scolarite` : Nom de la base de données
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'pool_size': 10,
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
     'pool_recycle': 300,
     'pool_pre_ping': True,
-    'connect_args': {
-        'connect_timeout': 5,
-        'read_timeout': 10,
-        'write_timeout': 10
-    }
+}
+MYSQL_CONNECT_ARGS = {  # Délais du pilote PyMySQL
+    'connect_timeout': 5,
+    'read_timeout': 10,
+    'write_timeout': 10
+}
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('mysql'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = MYSQL_CONNECT_ARGS
+
+# Campus : une base par campus dans un même déploiement (vide = un seul établissement, DATABASE_URL)
+# CAMPUS_DATABASES="dakar=mysql+pymysql://...;thies=mysql+pymysql://..." ; CAMPUS_HOSTS="dakar.scolarite.sn=dakar;..."
+def _parse_pairs(value):
+    return dict(item.split('=', 1) for item in value.split(';') if '=' in item)
+
+app.config['CAMPUS_DATABASES'] = _parse_pairs(os.environ.get('CAMPUS_DATABASES', ''))
+app.config['CAMPUS_HOSTS'] = {host.lower(): code for host, code in _parse_pairs(os.environ.get('CAMPUS_HOSTS', '')).items()}
+app.config['CAMPUS_PATH_PREFIX'] = '/c/'  # Sinon, campus dans le chemin : /c/<campus>/...
+app.config['CAMPUS_DEFAULT'] = os.environ.get('CAMPUS_DEFAULT') or None  # Campus si ni l'hôte ni le chemin n'en désignent
+app.config['CENTRAL_CAMPUS'] = os.environ.get('CENTRAL_CAMPUS') or None  # Ses administrateurs voient les agrégats
+
+# Bibliothèque : pénalité journalière appliquée aux prêts en retard
+app.config['LIBRARY_DAILY_FINE'] = float(os.environ.get('LIBRARY_DAILY_FINE', 100))
+app.config['LIBRARY_LOAN_DAYS'] = int(os.environ.get('LIBRARY_LOAN_DAYS', 14))
+app.config['LIBRARY_HOLD_DAYS'] = int(os.environ.get('LIBRARY_HOLD_DAYS', 3))  # Délai pour retirer un exemplaire réservé
+
+# Absences : seuils d'alerte par fenêtre glissante (taux d'absence pondéré)
+app.config['ABSENCE_RISK_THRESHOLDS'] = {7: 0.5, 30: 0.3, 90: 0.2}
+app.config['ABSENCE_JUSTIFIED_WEIGHT'] = 0.25  # Une absence justifiée compte pour un quart
+
+# Paiements : rapprochement des relevés bancaires
+app.config['RECONCILIATION_DATE_TOLERANCE_DAYS'] = int(os.environ.get('RECONCILIATION_DATE_TOLERANCE_DAYS', 3))
+app.config['RECONCILIATION_BATCH_SIZE'] = 1000
+
+# Paiements : numérotation des factures
+app.config['INVOICE_PREFIX_FORMAT'] = os.environ.get('INVOICE_PREFIX_FORMAT', 'F{year}')  # Remis à zéro chaque année
+app.config['INVOICE_BLOCK_SIZE'] = int(os.environ.get('INVOICE_BLOCK_SIZE', 50))
+app.config['INVOICE_GAP_POLICY'] = os.environ.get('INVOICE_GAP_POLICY', 'blocks')  # blocks (trous possibles) ou gapless
+
+# Fichiers déposés : stockage par empreinte SHA-256 (dédoublonné)
+app.config['STORAGE_ROOT'] = os.environ.get('STORAGE_ROOT', os.path.join(app.instance_path, 'storage'))
+app.config['STORAGE_SENDFILE'] = os.environ.get('STORAGE_SENDFILE', '')  # '', 'x-sendfile' (Apache) ou 'x-accel' (nginx)
+app.config['STORAGE_ACCEL_PREFIX'] = os.environ.get('STORAGE_ACCEL_PREFIX', '/_storage/')  # Emplacement interne nginx
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 50)) * 1024 * 1024
+
+# Miniatures des photos (générées à la demande, conservées sur disque)
+app.config['THUMBNAIL_SIZES'] = (32, 64, 150)
+app.config['THUMBNAIL_WORKERS'] = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+app.config['THUMBNAIL_TIMEOUT_SECONDS'] = 30  # Attente maximale d'une requête ; au-delà, 503
+
+# Journaux d'utilisateur : tables mensuelles et archivage
+app.config['USER_LOG_RETENTION_MONTHS'] = int(os.environ.get('USER_LOG_RETENTION_MONTHS', 12))  # Mois gardés en base
+app.config['USER_LOG_ARCHIVE_DIR'] = os.environ.get('USER_LOG_ARCHIVE_DIR', os.path.join(app.instance_path, 'log_archive'))
+
+# Métriques Prometheus : un fichier par processus (workers pré-forkés), agrégés par /metrics
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR', os.path.join(app.instance_path, 'metrics'))  # '' = processus seul
+app.config['METRICS_FLUSH_INTERVAL'] = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1.0))  # Secondes entre deux écritures
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')  # Jeton Bearer exigé par /metrics s'il est défini
+# Sans jeton, /metrics ne répond qu'aux connexions locales (derrière un proxy sur la même machine, définir un jeton) ;
+# METRICS_PUBLIC=1 l'ouvre à tous, explicitement
+app.config['METRICS_PUBLIC'] = os.environ.get('METRICS_PUBLIC', '0') == '1'
+
+# Année universitaire : mois de rentrée et début du second semestre (évaluations des enseignants)
+app.config['ACADEMIC_YEAR_START_MONTH'] = 9
+app.config['SECOND_SEMESTER_START_MONTH'] = 2
+
+# Statistiques institutionnelles : instantanés en colonnes NumPy, hors de la base de production
+app.config['ANALYTICS_SNAPSHOT_DIR'] = os.environ.get('ANALYTICS_SNAPSHOT_DIR', os.path.join(app.instance_path, 'analytics'))
+app.config['ANALYTICS_SNAPSHOT_KEEP'] = int(os.environ.get('ANALYTICS_SNAPSHOT_KEEP', 7))  # Instantanés conservés
+
+# Migrations de données : traitement par tranches de clé primaire, en ligne
+app.config['DATA_MIGRATION_CHUNK_SIZE'] = int(os.environ.get('DATA_MIGRATION_CHUNK_SIZE', 1000))  # Taille initiale
+app.config['DATA_MIGRATION_CHUNK_SECONDS'] = 0.5  # Durée visée d'une tranche (la taille s'ajuste)
+app.config['DATA_MIGRATION_SLEEP_RATIO'] = float(os.environ.get('DATA_MIGRATION_SLEEP_RATIO', 1.0))  # Pause / durée de tranche
+app.config['DATA_MIGRATION_MAX_LAG'] = float(os.environ.get('DATA_MIGRATION_MAX_LAG', 5))  # Retard des réplicas (s)
+app.config['DATA_MIGRATION_MAX_LOCK_WAITS'] = int(os.environ.get('DATA_MIGRATION_MAX_LOCK_WAITS', 5))
+app.config['DATA_MIGRATION_REPLICA_URLS'] = [url for url in os.environ.get('DATA_MIGRATION_REPLICA_URLS', '').split(',') if url]
+app.config['DATA_MIGRATION_PAUSE_SECONDS'] = 5.0  # Intervalle de vérification pendant une pause
+app.config['DATA_MIGRATION_CLAIM_TIMEOUT_SECONDS'] = 600  # Migration « running » sans nouvelles : processus arrêté
+
+# Courriels sortants : file durable, récapitulatifs par destinataire, envoi par un worker (flask mail-worker)
+app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'localhost')
+app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 25))  # flask mail-sink écoute par défaut sur 1025
+app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', '0') == '1'  # STARTTLS
+app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME', '')
+app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD', '')
+app.config['MAIL_SENDER'] = os.environ.get('MAIL_SENDER', 'Scolarité <no-reply@scolarite.local>')
+app.config['MAIL_RATE_PER_MINUTE'] = int(os.environ.get('MAIL_RATE_PER_MINUTE', 60))  # Courriels envoyés au plus
+app.config['MAIL_MESSAGES_PER_CONNECTION'] = 100  # Reconnexion SMTP au-delà
+app.config['MAIL_DIGEST_WINDOW_SECONDS'] = int(os.environ.get('MAIL_DIGEST_WINDOW_SECONDS', 300))  # Attente avant envoi
+app.config['MAIL_DIGEST_MAX_ITEMS'] = 50  # Messages regroupés au plus dans un courriel
+app.config['MAIL_BATCH_RECIPIENTS'] = 100  # Destinataires traités par passage du worker
+app.config['MAIL_MAX_ATTEMPTS'] = int(os.environ.get('MAIL_MAX_ATTEMPTS', 6))
+app.config['MAIL_RETRY_BASE_SECONDS'] = 60  # Délai doublé à chaque échec, avec gigue
+app.config['MAIL_RETRY_MAX_SECONDS'] = 6 * 3600
+app.config['MAIL_CLAIM_TIMEOUT_SECONDS'] = 600  # Courriels « sending » d'un worker arrêté remis en file
+
+# Calendrier : durée maximale d'un événement, pour borner la recherche par plage sur start_date
+app.config['CALENDAR_MAX_SPAN_DAYS'] = int(os.environ.get('CALENDAR_MAX_SPAN_DAYS', 31))
+
+# Pool de connexions : mode adaptatif (débordement et délai d'attente ajustés selon les attentes observées)
+app.config['DB_POOL_ADAPTIVE'] = os.environ.get('DB_POOL_ADAPTIVE', '0') == '1'
+app.config['DB_POOL_TARGET_WAIT_MS'] = float(os.environ.get('DB_POOL_TARGET_WAIT_MS', 50))  # p95 visé
+app.config['DB_POOL_MAX_OVERFLOW_CEILING'] = int(os.environ.get('DB_POOL_MAX_OVERFLOW_CEILING', 40))
+app.config['DB_POOL_TIMEOUT_BOUNDS'] = (2.0, 60.0)  # Délai d'attente minimal et maximal, en secondes
+app.config['DB_POOL_ADAPT_INTERVAL'] = 5.0  # Secondes entre deux ajustements
+
+# Pool de connexions instrumenté
+POOL_WAIT_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+class PoolStats:
+    """Télémétrie du pool de connexions, alimentée par les événements du pool.
+
+    Histogramme des temps d'obtention d'une connexion, connexions en cours
+    d'utilisation, ouvertures au-delà de pool_size, échecs du pre-ping,
+    recyclages et dépassements du délai d'attente. En mode adaptatif,
+    max_overflow et le délai d'attente sont ajustés à intervalle régulier
+    d'après les attentes de la dernière fenêtre.
+    """
+
+    def __init__(self, pool=None):
+        self.lock = threading.Lock()
+        self.pool = pool  # Pool suivi (remplacé par recreate())
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.wait_buckets = [0] * (len(POOL_WAIT_BUCKETS_MS) + 1)
+            self.wait_sum = 0.0
+            self.checkouts = 0
+            self.in_use = 0
+            self.peak_in_use = 0
+            self.connects = 0
+            self.overflow_opened = 0
+            self.timeouts = 0
+            self.invalidations = 0
+            self.preping_failures = 0
+            self.recycles = 0
+            self.adjustments = []
+            self._window = deque(maxlen=4096)
+            self._window_peak = 0
+            self._window_timeouts = 0
+            self._adapted_at = time.monotonic()
+
+    def record_wait(self, pool, seconds):
+        ms = seconds * 1000
+        index = next((i for i, bound in enumerate(POOL_WAIT_BUCKETS_MS) if ms <= bound), len(POOL_WAIT_BUCKETS_MS))
+        with self.lock:
+            self.wait_buckets[index] += 1
+            self.wait_sum += seconds
+            self.checkouts += 1
+            self._window.append(ms)
+        self.maybe_adapt(pool)
+
+    def record_timeout(self, pool):
+        with self.lock:
+            self.timeouts += 1
+            self._window_timeouts += 1
+        self.maybe_adapt(pool)
+
+    def checked_out(self):
+        with self.lock:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self._window_peak = max(self._window_peak, self.in_use)
+
+    def checked_in(self):
+        with self.lock:
+            self.in_use -= 1
+
+    def maybe_adapt(self, pool):
+        """Ajuste max_overflow et le délai d'attente du pool (mode adaptatif uniquement).
+
+        Si le p95 (ou la moyenne) des attentes dépasse la cible alors que tout le débordement
+        autorisé est utilisé, max_overflow augmente (jusqu'au plafond) ; s'il
+        reste largement sous la cible et que le débordement n'a pas servi, il
+        redescend d'un cran vers la valeur configurée. Le délai d'attente suit
+        le p99 observé (quatre fois), dans les bornes configurées : on échoue
+        vite quand le pool répond bien, on patiente davantage quand il sature.
+        Les demandes déjà en attente gardent les réglages de leur début d'attente.
+        """
+        config = app.config
+        now = time.monotonic()
+        if not config['DB_POOL_ADAPTIVE'] or now - self._adapted_at < config['DB_POOL_ADAPT_INTERVAL']:
+            return
+        with self.lock:
+            if now - self._adapted_at < config['DB_POOL_ADAPT_INTERVAL']:
+                return
+            waits = sorted(self._window)
+            peak, timeouts = self._window_peak, self._window_timeouts
+            self._window.clear()
+            self._window_peak = self.in_use
+            self._window_timeouts = 0
+            self._adapted_at = now
+        if not waits and not timeouts:
+            return
+
+        p95 = waits[int(len(waits) * 0.95)] if waits else 0.0
+        p99 = waits[int(len(waits) * 0.99)] if waits else 0.0
+        mean = sum(waits) / len(waits) if waits else 0.0
+        target = config['DB_POOL_TARGET_WAIT_MS']
+        base_overflow = config['SQLALCHEMY_ENGINE_OPTIONS'].get('max_overflow', 10)
+        size, max_overflow = pool.size(), pool._max_overflow
+        # La moyenne compte aussi : quelques threads affamés pèsent peu dans le p95
+        if (max(p95, mean) > target or timeouts) and peak >= size + max_overflow:
+            max_overflow = min(config['DB_POOL_MAX_OVERFLOW_CEILING'], max_overflow + max(2, size // 2))
+        elif max(p95, mean) < target / 4 and not timeouts and peak < size + max_overflow // 2:
+            max_overflow = max(base_overflow, max_overflow - 1)
+        low, high = config['DB_POOL_TIMEOUT_BOUNDS']
+        timeout = high if timeouts else min(high, max(low, 4 * p99 / 1000))
+
+        if (max_overflow, timeout) != (pool._max_overflow, pool._timeout):
+            pool._max_overflow, pool._timeout = max_overflow, timeout
+            with self.lock:
+                self.adjustments.append({'at': datetime.now(timezone.utc).isoformat(), 'p95_ms': round(p95, 1),
+                                         'max_overflow': max_overflow, 'timeout': timeout})
+                del self.adjustments[:-20]
+
+    def wait_quantile(self, q):
+        """Borne supérieure (ms) du seau contenant le quantile q des attentes."""
+        with self.lock:
+            buckets, total = list(self.wait_buckets), self.checkouts
+        if not total:
+            return 0.0
+        seen = 0
+        for bound, count in zip(POOL_WAIT_BUCKETS_MS + (float('inf'),), buckets):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return float('inf')
+
+    def snapshot(self, pool=None):
+        with self.lock:
+            data = {
+                'checkouts': self.checkouts,
+                'wait_histogram_ms': dict(zip([str(b) for b in POOL_WAIT_BUCKETS_MS] + ['+Inf'], self.wait_buckets)),
+                'wait_avg_ms': round(self.wait_sum * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'connects': self.connects,
+                'overflow_opened': self.overflow_opened,
+                'timeouts': self.timeouts,
+                'invalidations': self.invalidations,
+                'preping_failures': self.preping_failures,
+                'recycles': self.recycles,
+                'adjustments': list(self.adjustments),
+            }
+        if isinstance(pool, QueuePool):
+            data.update(pool_size=pool.size(), overflow=max(pool.overflow(), 0), idle=pool.checkedin(),
+                        max_overflow=pool._max_overflow, timeout=pool._timeout)
+        return data
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool qui tient sa propre télémétrie (attribut stats, une par pool et donc par campus).
+
+    Aucun événement du pool ne marque le début de l'attente : elle est donc
+    chronométrée dans connect() (file d'attente, ouverture éventuelle et
+    pre-ping compris) ; le reste de la télémétrie passe par les événements du
+    pool (_listen_pool_events). recreate() (engine.dispose()) recopie les
+    écouteurs : le nouveau pool reprend donc les mêmes compteurs.
+    """
+
+    def __init__(self, *args, _dispatch=None, **kwargs):
+        super().__init__(*args, _dispatch=_dispatch, **kwargs)
+        if _dispatch is None:
+            self.stats = PoolStats(self)
+            _listen_pool_events(self.stats)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        self.stats.pool = pool
+        return pool
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            self.stats.record_timeout(self)
+            raise
+        self.stats.record_wait(self, time.perf_counter() - started)
+        return connection
+
+def _listen_pool_events(stats):
+    """Alimente stats depuis les événements de son pool (checkout, checkin, connect, invalidate)."""
+
+    @event.listens_for(stats.pool, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        stats.checked_out()
+
+    @event.listens_for(stats.pool, 'checkin')
+    def checkin(dbapi_connection, connection_record):
+        stats.checked_in()
+
+    @event.listens_for(stats.pool, 'connect')
+    def connect(dbapi_connection, connection_record):
+        info = connection_record.record_info
+        with stats.lock:
+            stats.connects += 1
+            if info.get('opened'):
+                # Reconnexion d'un emplacement existant sans invalidation : recyclage (pool_recycle)
+                if not info.pop('invalidated', False):
+                    stats.recycles += 1
+            elif stats.pool.overflow() > 0:  # Nouvelle connexion au-delà de pool_size
+                stats.overflow_opened += 1
+        info['opened'] = True
+
+    @event.listens_for(stats.pool, 'invalidate')
+    def invalidate(dbapi_connection, connection_record, exception):
+        with stats.lock:
+            stats.invalidations += 1
+            if isinstance(exception, DisconnectionError):  # Levée au checkout : échec du pre-ping
+                stats.preping_failures += 1
+        connection_record.record_info['invalidated'] = True
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS']['poolclass'] = InstrumentedQueuePool
+
+def campus_engine_options(url):
+    """Options du moteur d'un campus : celles du moteur par défaut (pool instrumenté, pre-ping, recyclage)."""
+    options = {key: value for key, value in app.config['SQLALCHEMY_ENGINE_OPTIONS'].items() if key != 'connect_args'}
+    if url.startswith('mysql'):
+        options['connect_args'] = MYSQL_CONNECT_ARGS
+    return dict(options, url=url)
+
+app.config['SQLALCHEMY_BINDS'] = {
+    f'campus:{code}': campus_engine_options(url) for code, url in app.config['CAMPUS_DATABASES'].items()
 }
 
+def current_campus():
+    """Campus de la requête ou du contexte courant (variable SCOLARITE_CAMPUS pour les commandes flask)."""
+    if not app.config['CAMPUS_DATABASES'] or not has_app_context():
+        return None
+    campus = g.get('campus')
+    if campus is None and not has_request_context():
+        campus = os.environ.get('SCOLARITE_CAMPUS') or app.config['CAMPUS_DEFAULT']
+    return campus
+
+def campus_path(root):
+    """Sous-dossier de root propre au campus courant (root lui-même sans campus)."""
+    campus = current_campus()
+    return os.path.join(root, campus) if campus else root
+
+class CampusSession(FlaskSession):
+    """Session liée à la base du campus courant ; chaque campus a son moteur, donc son pool."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        campus = current_campus() if bind is None else None
+        if campus is not None:
+            return self._db.engines[f'campus:{campus}']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
 # Initialisation de la base de données
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': CampusSession})
 migrate = Migrate(app, db)  # Initialize Flask-Migrate
 
+def tenant_engine(campus=None):
+    """Moteur du campus donné ou courant (moteur par défaut sans campus)."""
+    campus = campus or current_campus()
+    return db.engines[f'campus:{campus}'] if campus else db.engine
+
+@contextmanager
+def campus_context(campus):
+    """Contexte d'application lié à un campus (tâches, commandes, agrégats inter-campus)."""
+    with app.app_context():
+        g.campus = campus
+        try:
+            yield
+        finally:
+            db.session.remove()
+
+class CampusMiddleware:
+    """Détermine le campus d'une requête par l'hôte, puis par le préfixe /c/<campus>/ du chemin.
+
+    Le préfixe est déplacé dans SCRIPT_NAME : les routes restent inchangées et
+    url_for() produit des liens qui restent dans le campus.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        campuses = app.config['CAMPUS_DATABASES']
+        if campuses:
+            host = environ.get('HTTP_HOST', '').split(':')[0].lower()
+            campus = app.config['CAMPUS_HOSTS'].get(host)
+            prefix, path = app.config['CAMPUS_PATH_PREFIX'], environ.get('PATH_INFO', '')
+            if campus is None and path.startswith(prefix):
+                code, _, rest = path[len(prefix):].partition('/')
+                if code in campuses:
+                    campus = code
+                    environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + prefix + code
+                    environ['PATH_INFO'] = '/' + rest
+            environ['scolarite.campus'] = campus or app.config['CAMPUS_DEFAULT']
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = CampusMiddleware(app.wsgi_app)
+
+@app.before_request
+def _bind_campus():
+    if not app.config['CAMPUS_DATABASES']:
+        return
+    campus = request.environ.get('scolarite.campus')
+    if campus is None:
+        abort(404)
+    g.campus = campus
+    if 'user_id' in session and session.get('campus') != campus:
+        session.clear()  # Identifiants valables dans un autre campus seulement
+
+class TenantCache:
+    """Cache en mémoire cloisonné par campus : une entrée n'est jamais servie à un autre campus."""
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self._entries = {}  # (campus, clé) -> (expiration, valeur)
+
+    def get(self, key, loader, ttl=300, validate=None):
+        """Valeur en cache, ou loader() ; validate(valeur) peut refuser une entrée périmée."""
+        full_key = (current_campus(), key)
+        entry = self._entries.get(full_key)
+        if entry is not None and entry[0] > time.monotonic() and (validate is None or validate(entry[1])):
+            return entry[1]
+        value = loader()
+        with self.lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries.clear()
+            self._entries[full_key] = (time.monotonic() + ttl, value)
+        return value
+
+    def clear(self, campus=None):
+        with self.lock:
+            if campus is None:
+                self._entries.clear()
+            else:
+                self._entries = {k: v for k, v in self._entries.items() if k[0] != campus}
+
+tenant_cache = TenantCache()
+
+# Métriques : registre en mémoire par processus, copié périodiquement dans METRICS_DIR
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS_HELP = {
+    'http_requests_total': ('counter', 'Requêtes HTTP traitées, par route, méthode et statut'),
+    'http_request_duration_seconds': ('histogram', 'Durée des requêtes HTTP, par route et méthode'),
+    'http_request_db_seconds_total': ('counter', 'Temps passé en base de données, par route'),
+    'db_query_duration_seconds': ('histogram', 'Durée des requêtes SQL'),
+    'template_render_duration_seconds': ('histogram', 'Durée du rendu des gabarits'),
+    'cache_requests_total': ('counter', 'Consultations des caches applicatifs, par cache et résultat'),
+    'worker_queue_depth': ('gauge', 'Tâches en attente dans les files des travailleurs en arrière-plan'),
+    'db_pool_connections': ('gauge', 'Connexions du pool, par état'),
+    'outbound_emails_total': ('counter', 'Courriels sortants traités, par résultat'),
+}
+
+class MetricsRegistry:
+    """Compteurs, histogrammes et jauges d'un processus.
+
+    L'enregistrement ne touche qu'un dictionnaire en mémoire (quelques µs par
+    requête). Au plus une fois par METRICS_FLUSH_INTERVAL, le processus écrit
+    son état dans METRICS_DIR/metrics-<pid>-<jeton>.json (le jeton distingue
+    un PID réutilisé) ; /metrics additionne les fichiers de tous les workers.
+    Les compteurs et histogrammes d'un worker arrêté sont reportés dans
+    retired.json et son fichier supprimé ; ses jauges sont abandonnées.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (nom, étiquettes) -> valeur
+        self.histograms = {}  # (nom, étiquettes) -> [effectifs par seau..., somme]
+        self.gauge_callbacks = []  # fonctions renvoyant [(nom, étiquettes, valeur)]
+        self.flushed_at = 0.0
+        self.pid, self.token = os.getpid(), os.urandom(4).hex()
+
+    def _own_path(self, directory):
+        if self.pid != os.getpid():
+            # Worker issu d'un fork : les valeurs héritées sont déjà dans le fichier du parent
+            with self.lock:
+                self.counters.clear()
+                self.histograms.clear()
+            self.pid, self.token = os.getpid(), os.urandom(4).hex()
+        return os.path.join(directory, f'metrics-{self.pid}-{self.token}.json')
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        index = bisect.bisect_left(METRICS_BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(METRICS_BUCKETS) + 2)
+            histogram[index] += 1
+            histogram[-1] += seconds
+
+    def gauge(self, func):
+        """Déclare une fonction de jauges, évaluée à chaque écriture (décorateur)."""
+        self.gauge_callbacks.append(func)
+        return func
+
+    def state(self):
+        gauges = []
+        for func in self.gauge_callbacks:
+            try:
+                gauges.extend([name, list(labels), value] for name, labels, value in func())
+            except Exception:  # Une jauge défaillante ne doit pas bloquer les autres
+                app.logger.exception("Jauge %s en erreur", func.__name__)
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, list(labels), list(h)] for (name, labels), h in self.histograms.items()],
+                'gauges': gauges,
+            }
+
+    def maybe_flush(self, force=False):
+        directory = app.config['METRICS_DIR']
+        now = time.monotonic()
+        if not directory or (not force and now - self.flushed_at < app.config['METRICS_FLUSH_INTERVAL']):
+            return
+        self.flushed_at = now
+        os.makedirs(directory, exist_ok=True)
+        path = self._own_path(directory)
+        with open(f'{path}.tmp', 'w') as out:
+            json.dump(self.state(), out)
+        os.replace(f'{path}.tmp', path)
+
+    def collect(self):
+        """Additionne les états de tous les processus (fichiers) et l'état courant de celui-ci."""
+        directory = app.config['METRICS_DIR']
+        own = self._own_path(directory) if directory else None
+        states = [self.state()]
+        if directory:
+            retired = []
+            for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+                if path == own:
+                    continue
+                state = _read_metrics_file(path)
+                if state is None:
+                    continue
+                # Même PID que ce processus mais autre jeton : ancien processus dont le PID a été réutilisé
+                if state['pid'] == self.pid or not _process_alive(state['pid']):
+                    retired.append((path, state))
+                else:
+                    states.append(state)
+            if retired:
+                self._retire(directory, retired)
+            states.append(_read_metrics_file(os.path.join(directory, 'retired.json')) or {})
+        return self._merge(states)
+
+    @staticmethod
+    def _merge(states):
+        counters, histograms, gauges = {}, {}, {}
+        for state in states:
+            for name, labels, value in state.get('counters', ()):
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in state.get('histograms', ()):
+                key = (name, tuple(map(tuple, labels)))
+                total = histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    total[i] += value
+            for name, labels, value in state.get('gauges', ()):
+                key = (name, tuple(map(tuple, labels)))
+                gauges[key] = gauges.get(key, 0) + value
+        return counters, histograms, gauges
+
+    def _retire(self, directory, retired):
+        """Reporte les compteurs des processus arrêtés dans retired.json, puis supprime leurs fichiers.
+
+        Un verrou de fichier sérialise les workers qui répondent à /metrics en
+        même temps ; un fichier déjà reporté par un autre worker est ignoré.
+        """
+        with open(os.path.join(directory, 'retired.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            retired = [(path, state) for path, state in retired if os.path.exists(path)]
+            if not retired:
+                return
+            path = os.path.join(directory, 'retired.json')
+            counters, histograms, _ = self._merge(
+                [_read_metrics_file(path) or {}] + [{'counters': state['counters'], 'histograms': state['histograms']}
+                                                    for _, state in retired])
+            with open(f'{path}.tmp', 'w') as out:
+                json.dump({
+                    'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+                    'histograms': [[name, list(labels), h] for (name, labels), h in histograms.items()],
+                }, out)
+            os.replace(f'{path}.tmp', path)
+            for dead_path, _ in retired:
+                os.unlink(dead_path)
+
+    def render(self):
+        """Format texte d'exposition Prometheus (version 0.0.4)."""
+        counters, histograms, gauges = self.collect()
+        series = {}
+        for (name, labels), value in counters.items():
+            series.setdefault(name, []).append(f'{name}{_metric_labels(labels)} {value}')
+        for (name, labels), values in histograms.items():
+            lines, cumulative = series.setdefault(name, []), 0
+            for bound, count in zip(METRICS_BUCKETS + (float('inf'),), values):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{_metric_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{_metric_labels(labels)} {values[-1]}')
+            lines.append(f'{name}_count{_metric_labels(labels)} {cumulative}')
+        for (name, labels), value in gauges.items():
+            series.setdefault(name, []).append(f'{name}{_metric_labels(labels)} {value}')
+
+        output = []
+        for name in sorted(series):
+            kind, description = METRICS_HELP.get(name, ('untyped', name))
+            output.append(f'# HELP {name} {description}')
+            output.append(f'# TYPE {name} {kind}')
+            output.extend(series[name])
+        return '\n'.join(output) + '\n'
+
+def _metric_labels(labels):
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+def _read_metrics_file(path):
+    try:
+        with open(path) as source:
+            return json.load(source)
+    except (OSError, ValueError):  # Fichier supprimé ou en cours de remplacement
+        return None
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+metrics = MetricsRegistry()
+
+def record_cache(cache, hit):
+    metrics.inc('cache_requests_total', (('cache', cache), ('result', 'hit' if hit else 'miss')))
+
+@app.before_request
+def _metrics_start():
+    g.metrics = [time.perf_counter(), 0.0]  # Début de la requête, temps passé en base
+
+@app.after_request
+def _metrics_record(response):
+    state = g.get('metrics')
+    if state is None:
+        return response
+    elapsed = time.perf_counter() - state[0]
+    req = request._get_current_object()  # Un seul passage par le proxy
+    route = req.url_rule.rule if req.url_rule is not None else 'unmatched'
+    metrics.observe('http_request_duration_seconds', (('route', route), ('method', req.method)), elapsed)
+    metrics.inc('http_requests_total', (('route', route), ('method', req.method), ('status', str(response.status_code))))
+    if state[1]:
+        metrics.inc('http_request_db_seconds_total', (('route', route),), state[1])
+    metrics.maybe_flush()
+    return response
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _metrics_query_start(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_query_started'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _metrics_query_end(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('metrics_query_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    metrics.observe('db_query_duration_seconds', (), elapsed)
+    state = g.get('metrics') if has_request_context() else None
+    if state is not None:
+        state[1] += elapsed
+
+@before_render_template.connect_via(app)
+def _metrics_render_start(sender, template, context, **extra):
+    if has_request_context():
+        g.setdefault('metrics_renders', []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _metrics_render_end(sender, template, context, **extra):
+    renders = g.get('metrics_renders') if has_request_context() else None
+    if renders:
+        metrics.observe('template_render_duration_seconds', (('template', template.name or ''),),
+                        time.perf_counter() - renders.pop())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(401)
+    elif not app.config['METRICS_PUBLIC'] and request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(403)
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 # Modèles de données
 class User(db.Model):
     __tablename__ = 'user'  # Modifié de 'users' à 'user'
@@ -98,6 +824,31 @@ class Course(db.Model):
     max_students = db.Column(db.Integer, nullable=True)
     level = db.Column(db.String(50), nullable=True)
 
+class Enrollment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
+    enrolled_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    source = db.Column(db.String(20), nullable=False, default='manual')  # manual, allocation
+    preference_rank = db.Column(db.Integer, nullable=True)  # Rang du vœu obtenu lors de l'affectation
+
+    __table_args__ = (
+        db.UniqueConstraint('student_id', 'course_id', name='uq_enrollment_student_course'),
+        db.Index('ix_enrollment_course', 'course_id'),
+    )
+
+class CoursePreference(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
+    rank = db.Column(db.Integer, nullable=False)  # 1 = premier vœu
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (
+        db.UniqueConstraint('student_id', 'course_id', name='uq_course_preference_student_course'),
+        db.Index('ix_course_preference_student_rank', 'student_id', 'rank'),
+    )
+
 class CourseSession(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
@@ -105,6 +856,37 @@ class CourseSession(db.Model):
     start_time = db.Column(db.Time, nullable=False)
     end_time = db.Column(db.Time, nullable=False)
     room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=True)
+    schedule_id = db.Column(db.Integer, db.ForeignKey('course_schedule.id'), nullable=True)  # Séance modifiée d'une récurrence
+    original_date = db.Column(db.Date, nullable=True)  # Date de l'occurrence remplacée
+
+    __table_args__ = (
+        db.Index('ix_course_session_course_date', 'course_id', 'session_date'),
+        db.Index('ix_course_session_schedule_original', 'schedule_id', 'original_date'),
+    )
+
+class CourseSchedule(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
+    weekday = db.Column(db.Integer, nullable=False)  # 0 = lundi ... 6 = dimanche
+    start_time = db.Column(db.Time, nullable=False)
+    end_time = db.Column(db.Time, nullable=False)
+    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=True)
+    interval_weeks = db.Column(db.Integer, nullable=False, default=1)  # 2 = une semaine sur deux
+    start_date = db.Column(db.Date, nullable=True)  # Par défaut Course.start_date
+    end_date = db.Column(db.Date, nullable=True)  # Par défaut Course.end_date
+
+    __table_args__ = (
+        db.Index('ix_course_schedule_course', 'course_id'),
+    )
+
+class CourseScheduleException(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    schedule_id = db.Column(db.Integer, db.ForeignKey('course_schedule.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)  # Occurrence annulée (férié, vacances...)
+
+    __table_args__ = (
+        db.UniqueConstraint('schedule_id', 'date', name='uq_course_schedule_exception'),
+    )
 
 class Room(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -134,6 +916,10 @@ class Grade(db.Model):
     weight = db.Column(db.Float, default=1.0)
     is_final = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (
+        db.UniqueConstraint('exam_id', 'student_id', name='uq_grade_exam_student'),  # Une note par copie
+    )
+
 class Exam(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
@@ -144,6 +930,18 @@ class Exam(db.Model):
     max_score = db.Column(db.Float, default=20.0)
     weight = db.Column(db.Float, default=1.0)
 
+class CourseAverage(db.Model):
+    __tablename__ = 'course_average'
+    student_id = db.Column(db.Integer, db.ForeignKey('student.id'), primary_key=True)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), primary_key=True)
+    average = db.Column(db.Float, nullable=False)  # Moyenne pondérée ramenée sur 20
+    grade_count = db.Column(db.Integer, nullable=False)
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_course_average_course', 'course_id'),
+    )
+
 class Absence(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
@@ -155,6 +953,44 @@ class Absence(db.Model):
     notify_parent = db.Column(db.Boolean, default=True)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
 
+    __table_args__ = (
+        db.UniqueConstraint('course_id', 'date', 'student_id', name='uq_absence_course_date_student'),  # Appel par séance
+        db.Index('ix_absence_student_date', 'student_id', 'date'),
+    )
+
+class AbsenceRisk(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=True)  # NULL = tous cours confondus
+    absences_7 = db.Column(db.Integer, nullable=False, default=0)
+    absences_30 = db.Column(db.Integer, nullable=False, default=0)
+    absences_90 = db.Column(db.Integer, nullable=False, default=0)
+    unjustified_90 = db.Column(db.Integer, nullable=False, default=0)
+    sessions_90 = db.Column(db.Integer, nullable=False, default=0)
+    rate_7 = db.Column(db.Float, nullable=False, default=0.0)
+    rate_30 = db.Column(db.Float, nullable=False, default=0.0)
+    rate_90 = db.Column(db.Float, nullable=False, default=0.0)
+    risk_score = db.Column(db.Float, nullable=False, default=0.0)  # >= 1 : seuil dépassé sur au moins une fenêtre
+    flagged = db.Column(db.Boolean, nullable=False, default=False)
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_absence_risk_flagged_score', 'flagged', 'risk_score'),
+        db.Index('ix_absence_risk_student', 'student_id'),
+    )
+
+class ParentNotice(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
+    absence_id = db.Column(db.Integer, db.ForeignKey('absence.id', ondelete='CASCADE'), nullable=True)
+    kind = db.Column(db.String(30), nullable=False, default='absence')
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    digested_at = db.Column(db.DateTime, nullable=True)  # Renseigné quand le récapitulatif est parti
+
+    __table_args__ = (
+        db.Index('ix_parent_notice_pending', 'digested_at', 'student_id'),
+    )
+
 class DocumentRequest(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
@@ -182,6 +1018,11 @@ class Payment(db.Model):
     processed_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     receipt_path = db.Column(db.String(200), nullable=True)
 
+    __table_args__ = (
+        db.Index('ix_payment_status', 'status'),
+        db.Index('ix_payment_student_status', 'student_id', 'status'),
+    )
+
 class Scholarship(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
@@ -194,6 +1035,19 @@ class Scholarship(db.Model):
     requirements = db.Column(db.Text, nullable=True)
     approved_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
 
+class StudentBalance(db.Model):
+    student_id = db.Column(db.Integer, db.ForeignKey('student.id'), primary_key=True)
+    due_total = db.Column(db.Float, nullable=False, default=0.0)  # Paiements en attente
+    paid_total = db.Column(db.Float, nullable=False, default=0.0)  # Paiements validés
+    scholarship_total = db.Column(db.Float, nullable=False, default=0.0)  # Bourses actives
+    balance = db.Column(db.Float, nullable=False, default=0.0)  # Reste à payer : dû - bourses
+    oldest_due_date = db.Column(db.Date, nullable=True)  # Plus ancienne échéance en attente
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_student_balance_overdue', 'oldest_due_date', 'balance'),  # Relances
+    )
+
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -230,6 +1084,8 @@ class Forum(db.Model):
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))  # Mise à jour pour timezone-aware
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     is_active = db.Column(db.Boolean, default=True)
+    topic_count = db.Column(db.Integer, nullable=False, default=0)  # Tenu à jour à chaque sujet créé ou supprimé
+    last_activity_at = db.Column(db.DateTime, nullable=True)
 
 class ForumTopic(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -241,6 +1097,10 @@ class ForumTopic(db.Model):
     is_sticky = db.Column(db.Boolean, default=False)
     is_closed = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (
+        db.Index('ix_forum_topic_listing', 'forum_id', 'is_sticky', 'created_at', 'id'),  # Pagination par clé
+    )
+
 class TeacherEvaluation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     teacher_id = db.Column(db.Integer, db.ForeignKey('teacher.id'), nullable=False)
@@ -250,6 +1110,50 @@ class TeacherEvaluation(db.Model):
     comments = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))  # Mise à jour pour timezone-aware
     is_anonymous = db.Column(db.Boolean, default=True)
+    term = db.Column(db.String(20), nullable=True)  # Semestre universitaire, déduit de created_at
+
+    @db.validates('rating')
+    def validate_rating(self, key, rating):
+        if isinstance(rating, bool) or rating not in EVALUATION_RATINGS:
+            raise ValueError(f"Note d'évaluation hors de l'échelle 1 à 5 : {rating!r}")
+        return rating
+
+EVALUATION_RATINGS = range(1, 6)  # Échelle des notes d'évaluation
+
+class TeacherEvaluationStats(db.Model):
+    """Agrégats tenus à jour à chaque évaluation : moyenne et variance lues sans GROUP BY."""
+    __tablename__ = 'teacher_evaluation_stats'
+    teacher_id = db.Column(db.Integer, db.ForeignKey('teacher.id'), primary_key=True)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), primary_key=True)
+    term = db.Column(db.String(20), primary_key=True)
+    response_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    rating_sq_sum = db.Column(db.Integer, nullable=False, default=0)  # Somme des carrés, pour la variance
+    rating_1 = db.Column(db.Integer, nullable=False, default=0)
+    rating_2 = db.Column(db.Integer, nullable=False, default=0)
+    rating_3 = db.Column(db.Integer, nullable=False, default=0)
+    rating_4 = db.Column(db.Integer, nullable=False, default=0)
+    rating_5 = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_teacher_evaluation_stats_term', 'term', 'teacher_id'),
+    )
+
+    @property
+    def mean(self):
+        return self.rating_sum / self.response_count if self.response_count else None
+
+    @property
+    def variance(self):
+        """Variance de l'échantillon (n - 1), None en dessous de deux réponses."""
+        n = self.response_count
+        if n < 2:
+            return None
+        return max((self.rating_sq_sum - self.rating_sum * self.rating_sum / n) / (n - 1), 0.0)
+
+    @property
+    def histogram(self):
+        return {rating: getattr(self, f'rating_{rating}') for rating in EVALUATION_RATINGS}
 
 class LibraryBook(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -274,7 +1178,23 @@ class LibraryLoan(db.Model):
     return_date = db.Column(db.Date, nullable=True)
     is_renewed = db.Column(db.Boolean, default=False)
     fine_amount = db.Column(db.Float, default=0.0)
-    status = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(20), nullable=False)  # borrowed, overdue, returned
+
+    __table_args__ = (
+        db.Index('ix_library_loan_status_due_date', 'status', 'due_date'),  # Parcours des prêts en retard
+    )
+
+class LibraryHold(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('library_book.id'), nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    status = db.Column(db.String(20), nullable=False, default='waiting')  # waiting, ready, fulfilled, cancelled, expired
+    ready_until = db.Column(db.Date, nullable=True)  # Date limite de retrait quand un exemplaire est mis de côté
+
+    __table_args__ = (
+        db.Index('ix_library_hold_book_status', 'book_id', 'status', 'id'),  # File d'attente par livre (FIFO)
+    )
 
 class Event(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -288,6 +1208,11 @@ class Event(db.Model):
     max_participants = db.Column(db.Integer, nullable=True)
     registration_deadline = db.Column(db.Date, nullable=True)
     is_public = db.Column(db.Boolean, default=True)
+    confirmed_count = db.Column(db.Integer, nullable=False, default=0)  # Compteur de places confirmées
+
+    __table_args__ = (
+        db.Index('ix_event_start_date', 'start_date'),
+    )
 
 class EventParticipant(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -296,6 +1221,12 @@ class EventParticipant(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # Modifié 'users.id' à 'user.id'
     registration_date = db.Column(db.DateTime, default=datetime.utcnow)
     attendance_status = db.Column(db.String(20), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='confirmed')  # confirmed, waitlisted, cancelled
+
+    __table_args__ = (
+        db.Index('ix_event_participant_event_status', 'event_id', 'status', 'id'),  # Liste d'attente (FIFO)
+        db.UniqueConstraint('event_id', 'user_id', name='uq_event_participant_event_user'),  # Une inscription par personne
+    )
 
 class Alumni(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -337,6 +1268,11 @@ class Calendar(db.Model):
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # Modifié 'users.id' à 'user.id'
     is_public = db.Column(db.Boolean, default=True)
 
+    __table_args__ = (
+        db.Index('ix_calendar_start_date', 'start_date'),  # Affichage par plage (mois visible)
+        db.Index('ix_calendar_end_date', 'end_date'),  # Entrées longues qui recouvrent la plage
+    )
+
 class UserLog(db.Model):
     __tablename__ = 'user_logs'
     id = db.Column('LogID', db.Integer, primary_key=True)
@@ -344,9 +1280,120 @@ class UserLog(db.Model):
     action = db.Column('Action', db.String(255), nullable=False)
     timestamp = db.Column('Timestamp', db.DateTime, default=lambda: datetime.now(timezone.utc))
 
+    __table_args__ = (
+        db.Index('ix_user_logs_timestamp', 'Timestamp', 'LogID'),
+        db.Index('ix_user_logs_user', 'matricule', 'Timestamp', 'LogID'),
+        db.Index('ix_user_logs_action', 'Action', 'Timestamp', 'LogID'),
+    )
+
     def __repr__(self):
         return f'<UserLog {self.action} at {self.timestamp}>'
 
+class LogPartition(db.Model):
+    month = db.Column(db.String(6), primary_key=True)  # AAAAMM
+    table_name = db.Column(db.String(30), nullable=False)
+    row_count = db.Column(db.Integer, nullable=False, default=0)
+    status = db.Column(db.String(20), nullable=False, default='online')  # online, archived
+    archive_path = db.Column(db.String(255), nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=True)
+
+class JobWatermark(db.Model):
+    __tablename__ = 'job_watermark'
+    name = db.Column(db.String(50), primary_key=True)  # Nom de la tâche planifiée
+    watermark = db.Column(db.DateTime, nullable=False)  # Point atteint par le dernier passage
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+class DataMigration(db.Model):
+    __tablename__ = 'data_migration'
+    name = db.Column(db.String(100), primary_key=True)  # Migration de données enregistrée (DATA_MIGRATIONS)
+    last_id = db.Column(db.BigInteger, nullable=False, default=0)  # Dernière clé primaire traitée
+    rows_done = db.Column(db.BigInteger, nullable=False, default=0)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, waiting, paused, done
+    started_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+class OutboundEmail(db.Model):
+    __tablename__ = 'outbound_email'
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    source = db.Column(db.String(30), nullable=False)  # parent_notice, document, notification
+    source_id = db.Column(db.Integer, nullable=True)  # Ligne d'origine, pour ne pas la mettre deux fois en file
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False)  # Fin de la fenêtre de regroupement ou du délai de reprise
+    claim_token = db.Column(db.String(32), nullable=True)  # Passage du worker qui a réservé le courriel
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('source', 'source_id', name='uq_outbound_email_source'),
+        db.Index('ix_outbound_email_due', 'status', 'next_attempt_at', 'recipient'),
+        db.Index('ix_outbound_email_claim', 'claim_token'),
+    )
+
+class InvoiceSequence(db.Model):
+    __tablename__ = 'invoice_sequence'
+    prefix = db.Column(db.String(20), primary_key=True)  # Ex. F2026
+    next_value = db.Column(db.Integer, nullable=False, default=1)  # Premier numéro non réservé
+
+class StoredFile(db.Model):
+    sha256 = db.Column(db.String(64), primary_key=True)  # Empreinte du contenu = nom du fichier sur disque
+    size = db.Column(db.BigInteger, nullable=False)
+    content_type = db.Column(db.String(100), nullable=True)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+class CacheVersion(db.Model):
+    __tablename__ = 'cache_version'
+    name = db.Column(db.String(50), primary_key=True)  # Nom de la table surveillée
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+# Versions de cache : incrémentées une fois par transaction qui écrit (par l'ORM) dans
+# les tables suivies, pour invalider les contenus dérivés (flux iCalendar...) sans
+# recalcul préalable. L'UPDATE de cache_version est fait juste avant le commit : le
+# verrou sur la ligne partagée n'est tenu que le temps du commit, pas de toute la
+# transaction. Les UPDATE/DELETE en masse sur ces tables doivent appeler bump_cache_version().
+CACHE_VERSIONED_TABLES = {'calendar', 'event', 'course_session', 'course_schedule', 'course_schedule_exception', 'exam'}
+
+def bump_cache_version(name, connection=None):
+    """Incrémente la version de cache d'une table dans la transaction courante."""
+    connection = connection or db.session.connection()
+    table = CacheVersion.__table__
+    updated = connection.execute(
+        table.update().where(table.c.name == name).values(version=table.c.version + 1)
+    ).rowcount
+    if not updated:
+        connection.execute(table.insert().values(name=name, version=1))
+
+@event.listens_for(db.session, 'before_flush')
+def _collect_cache_versions(session, flush_context, instances):
+    session.info.setdefault('cache_versions', set()).update(
+        obj.__tablename__
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted)
+        if obj.__tablename__ in CACHE_VERSIONED_TABLES
+    )
+
+@event.listens_for(db.session, 'before_commit')
+def _bump_cache_versions(session):
+    if session.in_nested_transaction():
+        return  # Point de sauvegarde : la version est incrémentée au commit de la transaction
+    session.flush()
+    for name in sorted(session.info.pop('cache_versions', ())):
+        bump_cache_version(name, session.connection())
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _forget_cache_versions(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop('cache_versions', None)
+
+def get_cache_versions():
+    """Retourne les versions de cache de toutes les tables suivies."""
+    return dict(db.session.query(CacheVersion.name, CacheVersion.version))
+
 # Routes
 @app.route('/')
 def scolarite_home():  # Renommé pour éviter le conflit
@@ -378,6 +1425,8 @@ def login():
             session['user_id'] = user.id
             session['username'] = user.username
             session['user_type'] = user.user_type
+            if current_campus():
+                session['campus'] = current_campus()
             user.last_login = datetime.now(timezone.utc)
             db.session.commit()
 
@@ -440,7 +1489,7 @@ def dashboard():
         'students': Student.query.count(),
         'teachers': Teacher.query.count(),
         'courses': Course.query.count(),
-        'logs': UserLog.query.count()  # Ajout du nombre de journaux
+        'logs': user_log_count()  # Ajout du nombre de journaux (table courante + tables mensuelles)
     }
     
     return render_template('dashboard.html', stats=stats)  # Affiche le fichier dashboard.html
@@ -521,8 +1570,231 @@ def admin_calendar():
         return redirect(url_for('login'))
     
     user = User.query.get(session['user_id'])  # Fetch the logged-in user
-    events = Calendar.query.all()  # Fetch all calendar events from the database
-    return render_template('admin/calendar.html', events=events, user=user)  # Render the calendar template
+    today = date.today()
+    year = request.args.get('year', today.year, type=int)
+    month = request.args.get('month', today.month, type=int)
+    if not (1 <= month <= 12 and 1900 <= year <= 2999):
+        abort(400)
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+    events = calendar_window(start, end, user.id).all()  # Seulement le mois affiché
+    previous_month = (year - 1, 12) if month == 1 else (year, month - 1)
+    return render_template('admin/calendar.html', events=events, user=user, year=year, month=month,
+                           month_name=MONTH_NAMES[month - 1], previous_month=previous_month,
+                           next_month=(end.year, end.month))  # Render the calendar template
+
+MONTH_NAMES = ('Janvier', 'Février', 'Mars', 'Avril', 'Mai', 'Juin', 'Juillet', 'Août', 'Septembre', 'Octobre',
+               'Novembre', 'Décembre')
+
+def calendar_window(start, end, user_id=None):
+    """Entrées du calendrier qui chevauchent la plage [start, end).
+
+    Les entrées qui commencent au plus CALENDAR_MAX_SPAN_DAYS avant la plage
+    sont trouvées par l'index start_date ; les entrées plus longues (semestre,
+    vacances) par l'index end_date.
+    """
+    earliest = start - timedelta(days=app.config['CALENDAR_MAX_SPAN_DAYS'])
+    query = Calendar.query.filter(
+        Calendar.start_date < end,
+        db.func.coalesce(Calendar.end_date, Calendar.start_date) >= start,
+        db.or_(Calendar.start_date >= earliest, Calendar.end_date >= start),
+    )
+    if user_id is not None:
+        query = query.filter(db.or_(Calendar.is_public.is_(True), Calendar.created_by == user_id))
+    return query.order_by(Calendar.start_date)
+
+def _parse_window_bound(value):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+@app.route('/api/calendar')
+def api_calendar():
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+
+    start = _parse_window_bound(request.args.get('start'))
+    end = _parse_window_bound(request.args.get('end'))
+    if start is None or end is None or end <= start:
+        return jsonify(error='Paramètres start et end invalides (format AAAA-MM-JJ).'), 400
+    if end - start > timedelta(days=366):
+        return jsonify(error='Plage limitée à un an.'), 400
+
+    return jsonify(events=[{
+        'id': entry.id,
+        'title': entry.title,
+        'start': entry.start_date.isoformat(),
+        'end': entry.end_date.isoformat() if entry.end_date else None,
+        'all_day': entry.all_day,
+        'type': entry.calendar_type,
+        'location': entry.location,
+        'color': entry.color,
+    } for entry in calendar_window(start, end, session['user_id'])])
+
+# Flux iCalendar (abonnement depuis un téléphone) : l'URL contient un jeton signé
+# car les applications de calendrier n'envoient pas le cookie de session.
+_feed_serializer = URLSafeSerializer(app.secret_key, salt='calendar-feed')
+
+def calendar_feed_url(kind, object_id):
+    """URL d'abonnement au flux iCalendar d'un utilisateur ou d'un cours."""
+    payload = [kind, object_id] + ([current_campus()] if current_campus() else [])  # Jeton propre au campus
+    return url_for('calendar_feed', token=_feed_serializer.dumps(payload), _external=True)
+
+def _ics_escape(text):
+    return (text or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def _ics_fold(line):
+    """Replie les lignes de plus de 75 octets (RFC 5545)."""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line
+    parts, current = [], ''
+    for char in line:
+        if len((current + char).encode('utf-8')) > (75 if not parts else 74):
+            parts.append(current)
+            current = char
+        else:
+            current += char
+    parts.append(current)
+    return '\r\n '.join(parts)
+
+def _ics_event(uid, summary, start, end=None, all_day=False, location=None, description=None):
+    if all_day:
+        lines = [f'DTSTART;VALUE=DATE:{start:%Y%m%d}']
+        if end:
+            lines.append(f'DTEND;VALUE=DATE:{end + timedelta(days=1):%Y%m%d}')
+    else:
+        lines = [f'DTSTART:{start:%Y%m%dT%H%M%S}']
+        if end:
+            lines.append(f'DTEND:{end:%Y%m%dT%H%M%S}')
+    lines = ['BEGIN:VEVENT', f'UID:{uid}@scolarite', f'SUMMARY:{_ics_escape(summary)}'] + lines
+    if location:
+        lines.append(f'LOCATION:{_ics_escape(location)}')
+    if description:
+        lines.append(f'DESCRIPTION:{_ics_escape(description)}')
+    lines.append('END:VEVENT')
+    return lines
+
+def _course_session_events(course_ids):
+    names = dict(db.session.query(Course.id, Course.name).filter(Course.id.in_(course_ids)))
+    today = date.today()
+    for occurrence in timetable(course_ids, today - timedelta(days=90), today + timedelta(days=365)):
+        if occurrence.session_id is not None:
+            uid = f'session-{occurrence.session_id}'
+        else:
+            uid = f'schedule-{occurrence.schedule_id}-{occurrence.session_date:%Y%m%d}'
+        yield _ics_event(
+            uid, names.get(occurrence.course_id, 'Cours'),
+            datetime.combine(occurrence.session_date, occurrence.start_time),
+            datetime.combine(occurrence.session_date, occurrence.end_time),
+        )
+    for exam in Exam.query.filter(Exam.course_id.in_(course_ids), Exam.exam_date.isnot(None)):
+        yield _ics_event(f'exam-{exam.id}', f'Examen : {exam.title}', exam.exam_date, exam.exam_date,
+                         all_day=True, description=exam.description)
+
+def _user_feed_course_ids(user_id):
+    student = Student.query.filter_by(user_id=user_id).first()
+    course_ids = set()
+    if student:
+        course_ids.update(c for (c,) in db.session.query(Enrollment.course_id).filter_by(student_id=student.id))
+    teacher = Teacher.query.filter_by(user_id=user_id).first()
+    if teacher:
+        course_ids.update(c for (c,) in db.session.query(Course.id).filter_by(teacher_id=teacher.id))
+    return sorted(course_ids)
+
+def _feed_fingerprint(kind, object_id):
+    """Empreinte bon marché des données d'un flux : versions des tables et inscriptions de l'utilisateur."""
+    parts = [kind, str(object_id), repr(sorted(get_cache_versions().items()))]
+    if kind == 'user':
+        parts.append(repr(_user_feed_course_ids(object_id)))
+        parts.append(repr(db.session.query(db.func.count(EventParticipant.id), db.func.max(EventParticipant.id)).filter(
+            EventParticipant.user_id == object_id, EventParticipant.status == REGISTRATION_CONFIRMED
+        ).one()))
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+def build_calendar_feed(kind, object_id):
+    """Construit le contenu iCalendar d'un utilisateur (calendrier, événements, cours) ou d'un cours."""
+    blocks = []
+    if kind == 'user':
+        for entry in Calendar.query.filter(db.or_(Calendar.is_public.is_(True), Calendar.created_by == object_id)):
+            blocks.append(_ics_event(f'calendar-{entry.id}', entry.title, entry.start_date, entry.end_date,
+                                     all_day=entry.all_day, location=entry.location, description=entry.description))
+        registered = db.session.query(EventParticipant.event_id).filter(
+            EventParticipant.user_id == object_id, EventParticipant.status == REGISTRATION_CONFIRMED)
+        for item in Event.query.filter(Event.id.in_(registered)):
+            blocks.append(_ics_event(f'event-{item.id}', item.title, item.start_date, item.end_date,
+                                     location=item.location, description=item.description))
+        blocks.extend(_course_session_events(_user_feed_course_ids(object_id)))
+    else:
+        blocks.extend(_course_session_events([object_id]))
+
+    stamp = f'DTSTAMP:{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}'
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Scolarite//Calendrier//FR', 'CALSCALE:GREGORIAN']
+    for block in blocks:
+        lines.extend(block[:2] + [stamp] + block[2:])
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(_ics_fold(line) for line in lines) + '\r\n'
+
+@app.route('/calendar/feeds/<token>.ics')
+def calendar_feed(token):
+    try:
+        kind, object_id, *campus = _feed_serializer.loads(token)
+    except (BadSignature, ValueError):
+        return render_template('errors/404.html'), 404
+    if kind not in ('user', 'course') or (campus[:1] or [None])[0] != current_campus():
+        return render_template('errors/404.html'), 404
+
+    etag = _feed_fingerprint(kind, object_id)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        hit = [True]
+
+        def build():
+            hit[0] = False
+            return etag, build_calendar_feed(kind, object_id)
+
+        cached = tenant_cache.get(('calendar_feed', kind, object_id), build, ttl=86400,
+                                  validate=lambda entry: entry[0] == etag)
+        record_cache('calendar_feed', hit[0])
+        response = app.response_class(cached[1], mimetype='text/calendar')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, max-age=300'
+    return response
+
+@app.route('/api/timetable')
+def api_timetable():
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+
+    start = _parse_window_bound(request.args.get('start'))
+    end = _parse_window_bound(request.args.get('end'))
+    if start is None or end is None or end <= start or end - start > timedelta(days=366):
+        return jsonify(error='Paramètres start et end invalides (format AAAA-MM-JJ).'), 400
+
+    course_id = request.args.get('course_id', type=int)
+    course_ids = [course_id] if course_id else _user_feed_course_ids(session['user_id'])
+    return jsonify(sessions=[{
+        'course_id': o.course_id,
+        'date': o.session_date.isoformat(),
+        'start_time': o.start_time.strftime('%H:%M'),
+        'end_time': o.end_time.strftime('%H:%M'),
+        'room_id': o.room_id,
+        'schedule_id': o.schedule_id,
+        'session_id': o.session_id,
+    } for o in timetable(course_ids, start.date(), end.date())])
+
+@app.route('/calendar/feeds')
+def calendar_feeds():
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+
+    user_id = session['user_id']
+    return jsonify(
+        user=calendar_feed_url('user', user_id),
+        courses={course_id: calendar_feed_url('course', course_id) for course_id in _user_feed_course_ids(user_id)},
+    )
 
 @app.route('/admin/announcements')
 def admin_announcements():
@@ -560,9 +1832,222 @@ def forums():
         return redirect(url_for('login'))
     
     user = User.query.get(session['user_id'])  # Fetch the logged-in user
-    forums = Forum.query.all()  # Fetch all forums from the database
+    forums = Forum.query.all()  # Fetch all forums (topic_count et last_activity_at déjà calculés)
     return render_template('forums.html', forums=forums, user=user)  # Render the forums template
 
+@app.route('/forums/<int:forum_id>/topics')
+def forum_topics(forum_id):
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+
+    forum = Forum.query.get_or_404(forum_id)
+    per_page = max(1, min(request.args.get('per_page', 20, type=int), 100))
+    try:
+        topics, next_cursor = forum_topics_page(forum_id, request.args.get('after'), per_page)
+    except ValueError as exc:
+        return jsonify(error=str(exc)), 400
+    return jsonify(
+        forum={'id': forum.id, 'title': forum.title, 'topic_count': forum.topic_count,
+               'last_activity_at': forum.last_activity_at.isoformat() if forum.last_activity_at else None},
+        topics=[{
+            'id': topic.id,
+            'title': topic.title,
+            'author_id': topic.author_id,
+            'created_at': topic.created_at.isoformat(),
+            'is_sticky': bool(topic.is_sticky),
+            'is_closed': bool(topic.is_closed),
+        } for topic in topics],
+        next=next_cursor,
+    )
+
+def current_student():
+    """Retourne la fiche étudiant de l'utilisateur connecté, ou None."""
+    return Student.query.filter_by(user_id=session.get('user_id')).first()
+
+@app.route('/library/books/<int:book_id>/checkout', methods=['POST'])
+def library_checkout(book_id):
+    student = current_student() if 'user_id' in session else None
+    if student is None:
+        return jsonify(error='Veuillez vous connecter avec un compte étudiant.'), 401
+
+    loan = checkout_book(book_id, student.id)
+    if loan is None:
+        return jsonify(error='Aucun exemplaire disponible. Vous pouvez réserver ce livre.'), 409
+    return jsonify(loan_id=loan.id, due_date=loan.due_date.isoformat()), 201
+
+@app.route('/library/books/<int:book_id>/hold', methods=['POST'])
+def library_hold(book_id):
+    student = current_student() if 'user_id' in session else None
+    if student is None:
+        return jsonify(error='Veuillez vous connecter avec un compte étudiant.'), 401
+
+    hold = place_hold(book_id, student.id)
+    position = LibraryHold.query.filter(
+        LibraryHold.book_id == book_id,
+        LibraryHold.status == HOLD_STATUS_WAITING,
+        LibraryHold.id <= hold.id,
+    ).count()
+    return jsonify(hold_id=hold.id, status=hold.status, position=position), 201
+
+@app.route('/library/loans/<int:loan_id>/return', methods=['POST'])
+def library_return(loan_id):
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+    loan = db.session.get(LibraryLoan, loan_id)
+    if loan is None:
+        return jsonify(error='Prêt introuvable ou déjà rendu.'), 409
+    if session.get('user_type') not in ('admin', 'staff'):  # Sinon, seul l'emprunteur rend son prêt
+        student = current_student()
+        if student is None or student.id != loan.student_id:
+            return jsonify(error='Accès refusé : droits insuffisants.'), 403
+
+    if not return_book(loan_id):
+        return jsonify(error='Prêt introuvable ou déjà rendu.'), 409
+    return jsonify(status=LOAN_STATUS_RETURNED)
+
+@app.route('/courses/preferences', methods=['POST'])
+def course_preferences():
+    student = current_student() if 'user_id' in session else None
+    if student is None:
+        return jsonify(error='Veuillez vous connecter avec un compte étudiant.'), 401
+
+    payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict):
+        return jsonify(error='Corps JSON invalide.'), 400
+    course_ids = payload.get('course_ids', [])
+    if not isinstance(course_ids, list) or not all(
+            isinstance(cid, int) and not isinstance(cid, bool) for cid in course_ids):
+        return jsonify(error='Liste de cours invalide.'), 400
+    course_ids = list(dict.fromkeys(course_ids))  # Supprime les doublons en gardant l'ordre
+
+    known = {cid for (cid,) in db.session.query(Course.id).filter(Course.id.in_(course_ids))}
+    unknown = [cid for cid in course_ids if cid not in known]
+    if unknown:
+        return jsonify(error='Cours inconnus.', course_ids=unknown), 400
+
+    CoursePreference.query.filter_by(student_id=student.id).delete(synchronize_session=False)
+    now = datetime.now(timezone.utc)
+    if course_ids:
+        db.session.execute(CoursePreference.__table__.insert(), [
+            {'student_id': student.id, 'course_id': cid, 'rank': rank, 'updated_at': now}
+            for rank, cid in enumerate(course_ids, start=1)
+        ])
+    db.session.commit()
+    return jsonify(course_ids=course_ids)
+
+@app.route('/courses/<int:course_id>/attendance', methods=['POST'])
+def course_attendance(course_id):
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+    if session.get('user_type') not in ('teacher', 'admin', 'staff'):
+        return jsonify(error='Accès refusé : droits insuffisants.'), 403
+
+    course = Course.query.get_or_404(course_id)
+    if session.get('user_type') == 'teacher':
+        teacher = current_teacher()
+        if teacher is None or course.teacher_id != teacher.id:
+            return jsonify(error='Accès refusé : droits insuffisants.'), 403
+    payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict):
+        return jsonify(error='Corps JSON invalide.'), 400
+    try:
+        day = date.fromisoformat(payload.get('date') or date.today().isoformat())
+    except (TypeError, ValueError):  # TypeError : date transmise comme nombre, liste...
+        return jsonify(error='Date invalide (format AAAA-MM-JJ).'), 400
+    absent_ids = payload.get('absent', [])
+    if not isinstance(absent_ids, list) or not all(
+            isinstance(sid, int) and not isinstance(sid, bool) for sid in absent_ids):
+        return jsonify(error="Liste d'absents invalide."), 400
+
+    known = {sid for (sid,) in db.session.query(Student.id).filter(Student.id.in_(absent_ids))}
+    unknown = sorted(set(absent_ids) - known)
+    if unknown:
+        return jsonify(error='Étudiants inconnus.', student_ids=unknown), 400
+
+    try:
+        return jsonify(record_roll_call(course_id, day, absent_ids, created_by=session['user_id']))
+    except db.exc.IntegrityError:  # Même séance enregistrée en même temps par un autre appel
+        db.session.rollback()
+        return jsonify(error='Appel enregistré en même temps par un autre utilisateur, veuillez réessayer.'), 409
+
+@app.route('/api/absence-risk')
+def api_absence_risk():
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+    if session.get('user_type') not in ('teacher', 'admin', 'staff'):
+        return jsonify(error='Accès refusé : droits insuffisants.'), 403
+
+    query = AbsenceRisk.query.filter(AbsenceRisk.flagged.is_(True))
+    course_id = request.args.get('course_id', type=int)
+    if course_id:
+        query = query.filter(AbsenceRisk.course_id == course_id)
+    else:
+        query = query.filter(AbsenceRisk.course_id.is_(None))
+    limit = max(1, min(request.args.get('limit', 100, type=int), 500))
+    return jsonify(students=[{
+        'student_id': risk.student_id,
+        'course_id': risk.course_id,
+        'absences': {'7': risk.absences_7, '30': risk.absences_30, '90': risk.absences_90},
+        'unjustified_90': risk.unjustified_90,
+        'rates': {'7': risk.rate_7, '30': risk.rate_30, '90': risk.rate_90},
+        'risk_score': risk.risk_score,
+        'computed_at': risk.computed_at.isoformat(),
+    } for risk in query.order_by(AbsenceRisk.risk_score.desc()).limit(limit)])
+
+@app.route('/api/balances/overdue')
+def api_overdue_balances():
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+    if session.get('user_type') not in ('admin', 'staff'):
+        return jsonify(error='Accès refusé : droits insuffisants.'), 403
+
+    limit = min(request.args.get('limit', 200, type=int), 1000)
+    return jsonify(balances=[{
+        'student_id': item.student_id,
+        'balance': item.balance,
+        'due_total': item.due_total,
+        'scholarship_total': item.scholarship_total,
+        'oldest_due_date': item.oldest_due_date.isoformat(),
+    } for item in overdue_balances(limit=limit)])
+
+@app.route('/api/balance')
+def api_my_balance():
+    student = current_student() if 'user_id' in session else None
+    if student is None:
+        return jsonify(error='Veuillez vous connecter avec un compte étudiant.'), 401
+
+    item = db.session.get(StudentBalance, student.id)
+    return jsonify(
+        balance=item.balance if item else 0.0,
+        due_total=item.due_total if item else 0.0,
+        paid_total=item.paid_total if item else 0.0,
+        scholarship_total=item.scholarship_total if item else 0.0,
+        oldest_due_date=item.oldest_due_date.isoformat() if item and item.oldest_due_date else None,
+    )
+
+@app.route('/events/<int:event_id>/register', methods=['POST'])
+def event_register(event_id):
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+
+    student = current_student()
+    participant = register_for_event(event_id, session['user_id'], student.id if student else None)
+    if participant is None:
+        return jsonify(error='Les inscriptions sont closes pour cet événement.'), 409
+    return jsonify(participant_id=participant.id, status=participant.status), 201
+
+@app.route('/events/registrations/<int:participant_id>/cancel', methods=['POST'])
+def event_cancel(participant_id):
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+
+    participant = EventParticipant.query.get_or_404(participant_id)
+    if participant.user_id != session['user_id'] and session.get('user_type') != 'admin':
+        return jsonify(error='Accès refusé : droits insuffisants.'), 403
+    if not cancel_registration(participant_id):
+        return jsonify(error='Inscription déjà annulée.'), 409
+    return jsonify(status=REGISTRATION_CANCELLED)
+
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
     if 'user_id' not in session:
@@ -584,6 +2069,3337 @@ def settings():
     
     return render_template('settings.html', user=user)  # Render the settings template
 
+# Bibliothèque : pénalités de retard
+LOAN_STATUS_BORROWED = 'borrowed'
+LOAN_STATUS_OVERDUE = 'overdue'
+LOAN_STATUS_RETURNED = 'returned'
+
+def get_watermark(name):
+    """Retourne le point atteint par le dernier passage d'une tâche, ou None."""
+    mark = db.session.get(JobWatermark, name)
+    return mark.watermark if mark else None
+
+def set_watermark(name, value):
+    """Enregistre le point atteint par une tâche (sans commit)."""
+    mark = db.session.get(JobWatermark, name)
+    if mark is None:
+        mark = JobWatermark(name=name)
+        db.session.add(mark)
+    mark.watermark = value
+    mark.updated_at = datetime.now(timezone.utc)
+
+class days_between(FunctionElement):
+    """Nombre de jours de la date start à la date end, dans le dialecte de la base."""
+    type = db.Integer()
+    inherit_cache = True
+
+@compiles(days_between)
+def _days_between_default(element, compiler, **kw):
+    end, start = list(element.clauses)
+    return f'DATEDIFF({compiler.process(end, **kw)}, {compiler.process(start, **kw)})'
+
+@compiles(days_between, 'sqlite')
+def _days_between_sqlite(element, compiler, **kw):
+    end, start = list(element.clauses)
+    return f'CAST(julianday({compiler.process(end, **kw)}) - julianday({compiler.process(start, **kw)}) AS INTEGER)'
+
+def loan_fine(due_date, today):
+    """Pénalité d'un prêt à une date donnée (nulle avant l'échéance)."""
+    return app.config['LIBRARY_DAILY_FINE'] * max(0, (today - due_date).days)
+
+def compute_overdue_fines(today=None):
+    """Met à jour les pénalités des prêts en retard, une fois par jour.
+
+    Seuls les prêts ouverts dont l'échéance est dépassée sont visités (index
+    status/due_date), par un unique UPDATE : pénalité = taux × jours de retard,
+    calculés en base. Les prêts qui passent en retard reçoivent un rappel. Un
+    prêt rendu garde la pénalité fixée à son retour.
+    """
+    today = today or date.today()
+    rate = app.config['LIBRARY_DAILY_FINE']
+    last_run = get_watermark('library_fines')
+    if last_run is not None and last_run.date() >= today:
+        return {'extended': 0, 'new_overdue': 0, 'reminders': 0}
+
+    late = db.and_(LibraryLoan.status.in_((LOAN_STATUS_BORROWED, LOAN_STATUS_OVERDUE)), LibraryLoan.due_date < today)
+
+    # Nouveaux retards : rappels préparés avant le changement de statut
+    new_loans = db.session.query(Student.user_id, LibraryBook.title, LibraryLoan.due_date).join(
+        Student, Student.id == LibraryLoan.student_id
+    ).join(LibraryBook, LibraryBook.id == LibraryLoan.book_id).filter(
+        LibraryLoan.status == LOAN_STATUS_BORROWED, LibraryLoan.due_date < today
+    ).all()
+    reminders = [
+        {
+            'user_id': user_id,
+            'title': 'Retard de prêt',
+            'message': f"Le livre « {title} » devait être rendu le {due_date.strftime('%d/%m/%Y')}.",
+            'notification_type': 'library_overdue',
+        }
+        for user_id, title, due_date in new_loans if user_id is not None
+    ]
+    updated = db.session.execute(LibraryLoan.__table__.update().where(late).values(
+        fine_amount=rate * days_between(db.literal(today, db.Date), LibraryLoan.__table__.c.due_date),
+        status=LOAN_STATUS_OVERDUE,
+    )).rowcount
+    if reminders:
+        db.session.execute(Notification.__table__.insert(), reminders)
+    extended, new_overdue = updated - len(new_loans), len(new_loans)
+
+    set_watermark('library_fines', datetime.combine(today, datetime.min.time()))
+    db.session.commit()
+    return {'extended': extended, 'new_overdue': new_overdue, 'reminders': len(reminders)}
+
+# Bibliothèque : emprunts, retours et réservations
+HOLD_STATUS_WAITING = 'waiting'
+HOLD_STATUS_READY = 'ready'
+HOLD_STATUS_FULFILLED = 'fulfilled'
+HOLD_STATUS_CANCELLED = 'cancelled'
+HOLD_STATUS_EXPIRED = 'expired'
+
+def _open_loan(book_id, student_id, today):
+    loan = LibraryLoan(
+        book_id=book_id,
+        student_id=student_id,
+        checkout_date=today,
+        due_date=today + timedelta(days=app.config['LIBRARY_LOAN_DAYS']),
+        status=LOAN_STATUS_BORROWED,
+    )
+    db.session.add(loan)
+    return loan
+
+def checkout_book(book_id, student_id, today=None):
+    """Emprunte un exemplaire ; retourne le prêt créé ou None si aucun exemplaire n'est libre.
+
+    Le stock est décrémenté par un UPDATE conditionnel (available > 0) : aucune
+    lecture préalable, donc pas de survente et un verrou de ligne très court.
+    Un étudiant dont la réservation est prête retire l'exemplaire mis de côté.
+    """
+    today = today or date.today()
+    claimed = LibraryHold.query.filter(
+        LibraryHold.book_id == book_id,
+        LibraryHold.student_id == student_id,
+        LibraryHold.status == HOLD_STATUS_READY,
+    ).update({LibraryHold.status: HOLD_STATUS_FULFILLED}, synchronize_session=False)
+    if not claimed:
+        taken = LibraryBook.query.filter(
+            LibraryBook.id == book_id, LibraryBook.available > 0
+        ).update({LibraryBook.available: LibraryBook.available - 1}, synchronize_session=False)
+        if not taken:
+            db.session.rollback()
+            return None
+    loan = _open_loan(book_id, student_id, today)
+    db.session.commit()
+    return loan
+
+def _release_copy(book_id, today):
+    """Attribue un exemplaire libéré à la première réservation en attente, sinon le remet en rayon."""
+    while True:
+        hold_id = db.session.query(LibraryHold.id).filter(
+            LibraryHold.book_id == book_id, LibraryHold.status == HOLD_STATUS_WAITING
+        ).order_by(LibraryHold.id).limit(1).scalar()
+        if hold_id is None:
+            LibraryBook.query.filter(LibraryBook.id == book_id).update(
+                {LibraryBook.available: LibraryBook.available + 1}, synchronize_session=False)
+            return None
+        # Une autre transaction peut avoir servi cette réservation entre-temps : on passe à la suivante
+        promoted = LibraryHold.query.filter(
+            LibraryHold.id == hold_id, LibraryHold.status == HOLD_STATUS_WAITING
+        ).update({
+            LibraryHold.status: HOLD_STATUS_READY,
+            LibraryHold.ready_until: today + timedelta(days=app.config['LIBRARY_HOLD_DAYS']),
+        }, synchronize_session=False)
+        if promoted:
+            return hold_id
+
+def return_book(loan_id, today=None):
+    """Enregistre le retour d'un prêt ; retourne False si le prêt était déjà clos."""
+    today = today or date.today()
+    loan = db.session.get(LibraryLoan, loan_id)
+    if loan is None:
+        return False
+    closed = LibraryLoan.query.filter(
+        LibraryLoan.id == loan_id,
+        LibraryLoan.status.in_((LOAN_STATUS_BORROWED, LOAN_STATUS_OVERDUE)),
+    ).update({
+        LibraryLoan.status: LOAN_STATUS_RETURNED,
+        LibraryLoan.return_date: today,
+        LibraryLoan.fine_amount: loan_fine(loan.due_date, today),  # Pénalité arrêtée au jour du retour
+    }, synchronize_session=False)
+    if not closed:
+        db.session.rollback()
+        return False
+    _release_copy(loan.book_id, today)
+    db.session.commit()
+    return True
+
+def place_hold(book_id, student_id):
+    """Inscrit un étudiant dans la file de réservation d'un livre."""
+    existing = LibraryHold.query.filter(
+        LibraryHold.book_id == book_id,
+        LibraryHold.student_id == student_id,
+        LibraryHold.status.in_((HOLD_STATUS_WAITING, HOLD_STATUS_READY)),
+    ).first()
+    if existing:
+        return existing
+    hold = LibraryHold(book_id=book_id, student_id=student_id, status=HOLD_STATUS_WAITING)
+    db.session.add(hold)
+    db.session.commit()
+    return hold
+
+def expire_library_holds(today=None):
+    """Libère les exemplaires mis de côté et non retirés à temps."""
+    today = today or date.today()
+    expired = LibraryHold.query.filter(
+        LibraryHold.status == HOLD_STATUS_READY, LibraryHold.ready_until < today
+    ).all()
+    for hold in expired:
+        released = LibraryHold.query.filter(
+            LibraryHold.id == hold.id, LibraryHold.status == HOLD_STATUS_READY
+        ).update({LibraryHold.status: HOLD_STATUS_EXPIRED}, synchronize_session=False)
+        if released:
+            _release_copy(hold.book_id, today)
+    db.session.commit()
+    return len(expired)
+
+@app.cli.command('library-fines')
+def library_fines_command():
+    """Tâche quotidienne : calcule les pénalités des prêts en retard."""
+    result = compute_overdue_fines()
+    expired = expire_library_holds()
+    print(f"Prêts prolongés : {result['extended']}, nouveaux retards : {result['new_overdue']}, "
+          f"rappels : {result['reminders']}, réservations expirées : {expired}")
+
+# Événements : inscriptions et liste d'attente
+REGISTRATION_CONFIRMED = 'confirmed'
+REGISTRATION_WAITLISTED = 'waitlisted'
+REGISTRATION_CANCELLED = 'cancelled'
+
+def register_for_event(event_id, user_id, student_id=None, today=None):
+    """Inscrit un utilisateur à un événement ; retourne l'inscription ou None si la date limite est passée.
+
+    La place est réservée par un UPDATE conditionnel sur Event.confirmed_count,
+    qui vérifie aussi la date limite : aucun comptage des inscrits n'est nécessaire.
+    Si l'événement est complet, l'inscription part en liste d'attente. Deux
+    demandes simultanées du même utilisateur se heurtent à la contrainte
+    uq_event_participant_event_user : la seconde est annulée, place comprise.
+    """
+    today = today or date.today()
+    existing = EventParticipant.query.filter(
+        EventParticipant.event_id == event_id, EventParticipant.user_id == user_id,
+    ).first()
+    if existing and existing.status != REGISTRATION_CANCELLED:
+        return existing
+
+    open_for_registration = db.or_(Event.registration_deadline.is_(None), Event.registration_deadline >= today)
+    seated = Event.query.filter(
+        Event.id == event_id,
+        open_for_registration,
+        db.or_(Event.max_participants.is_(None), Event.confirmed_count < Event.max_participants),
+    ).update({Event.confirmed_count: Event.confirmed_count + 1}, synchronize_session=False)
+    if seated:
+        status = REGISTRATION_CONFIRMED
+    elif Event.query.filter(Event.id == event_id, open_for_registration).count():
+        status = REGISTRATION_WAITLISTED
+    else:
+        db.session.rollback()
+        return None
+
+    if existing:  # Réinscription après annulation : nouvelle ligne, en fin de liste d'attente
+        EventParticipant.query.filter(
+            EventParticipant.id == existing.id, EventParticipant.status == REGISTRATION_CANCELLED
+        ).delete(synchronize_session=False)
+        db.session.expunge(existing)
+    participant = EventParticipant(event_id=event_id, user_id=user_id, student_id=student_id, status=status)
+    db.session.add(participant)
+    try:
+        db.session.commit()
+    except db.exc.IntegrityError:  # Inscription concurrente du même utilisateur
+        db.session.rollback()
+        return EventParticipant.query.filter(
+            EventParticipant.event_id == event_id, EventParticipant.user_id == user_id,
+        ).first()
+    return participant
+
+def _promote_waitlist(event_id):
+    """Cède une place libérée au premier inscrit en liste d'attente, sinon libère le compteur."""
+    while True:
+        participant_id = db.session.query(EventParticipant.id).filter(
+            EventParticipant.event_id == event_id, EventParticipant.status == REGISTRATION_WAITLISTED
+        ).order_by(EventParticipant.id).limit(1).scalar()
+        if participant_id is None:
+            Event.query.filter(Event.id == event_id).update(
+                {Event.confirmed_count: Event.confirmed_count - 1}, synchronize_session=False)
+            return None
+        promoted = EventParticipant.query.filter(
+            EventParticipant.id == participant_id, EventParticipant.status == REGISTRATION_WAITLISTED
+        ).update({EventParticipant.status: REGISTRATION_CONFIRMED}, synchronize_session=False)
+        if promoted:
+            return participant_id
+
+def cancel_registration(participant_id):
+    """Annule une inscription ; une place confirmée passe au suivant de la liste d'attente."""
+    participant = db.session.get(EventParticipant, participant_id)
+    if participant is None:
+        return False
+    for status in (REGISTRATION_CONFIRMED, REGISTRATION_WAITLISTED):
+        cancelled = EventParticipant.query.filter(
+            EventParticipant.id == participant_id, EventParticipant.status == status
+        ).update({EventParticipant.status: REGISTRATION_CANCELLED}, synchronize_session=False)
+        if cancelled:
+            if status == REGISTRATION_CONFIRMED:
+                promoted_id = _promote_waitlist(participant.event_id)
+                if promoted_id is not None:
+                    _notify_promotion(promoted_id)
+            db.session.commit()
+            return True
+    db.session.rollback()
+    return False
+
+def _notify_promotion(participant_id):
+    participant = db.session.get(EventParticipant, participant_id)
+    if participant.user_id is None:
+        return
+    event = db.session.get(Event, participant.event_id)
+    db.session.add(Notification(
+        user_id=participant.user_id,
+        title='Inscription confirmée',
+        message=f"Une place s'est libérée : votre inscription à « {event.title} » est confirmée.",
+        notification_type='event_promotion',
+    ))
+
+# Emploi du temps : séances récurrentes développées à la demande
+Occurrence = namedtuple('Occurrence', 'course_id session_date start_time end_time room_id schedule_id session_id')
+
+def expand_schedule(schedule, course, start, end, skipped=frozenset()):
+    """Génère les occurrences d'une récurrence hebdomadaire dans la plage [start, end).
+
+    Seules les dates de la plage sont calculées ; les dates de `skipped`
+    (exceptions et occurrences remplacées) sont omises.
+    """
+    anchor = schedule.start_date or course.start_date
+    if anchor is None:
+        return
+    last = min(d for d in (schedule.end_date or course.end_date, end - timedelta(days=1)) if d is not None)
+    step = 7 * (schedule.interval_weeks or 1)
+    day = anchor + timedelta(days=(schedule.weekday - anchor.weekday()) % 7)
+    if day < start:
+        day += timedelta(days=-(-(start - day).days // step) * step)  # Première occurrence >= start
+    while day <= last:
+        if day not in skipped:
+            yield Occurrence(course.id, day, schedule.start_time, schedule.end_time, schedule.room_id, schedule.id, None)
+        day += timedelta(days=step)
+
+def timetable(course_ids, start, end):
+    """Séances des cours dans la plage de dates [start, end), triées.
+
+    Combine les séances enregistrées (ponctuelles ou modifiées) et les
+    récurrences développées uniquement sur la plage demandée.
+    """
+    course_ids = list(course_ids)
+    courses = {course.id: course for course in Course.query.filter(Course.id.in_(course_ids))}
+    schedules = CourseSchedule.query.filter(CourseSchedule.course_id.in_(course_ids)).all()
+    schedule_ids = [schedule.id for schedule in schedules]
+
+    skipped = {}
+    for schedule_id, day in db.session.query(CourseScheduleException.schedule_id, CourseScheduleException.date).filter(
+        CourseScheduleException.schedule_id.in_(schedule_ids),
+        CourseScheduleException.date >= start, CourseScheduleException.date < end,
+    ):
+        skipped.setdefault(schedule_id, set()).add(day)
+    for schedule_id, day in db.session.query(CourseSession.schedule_id, CourseSession.original_date).filter(
+        CourseSession.schedule_id.in_(schedule_ids),
+        CourseSession.original_date >= start, CourseSession.original_date < end,
+    ):
+        skipped.setdefault(schedule_id, set()).add(day)
+
+    occurrences = [
+        Occurrence(s.course_id, s.session_date, s.start_time, s.end_time, s.room_id, s.schedule_id, s.id)
+        for s in CourseSession.query.filter(
+            CourseSession.course_id.in_(course_ids),
+            CourseSession.session_date >= start, CourseSession.session_date < end,
+        )
+    ]
+    for schedule in schedules:
+        occurrences.extend(expand_schedule(schedule, courses[schedule.course_id], start, end,
+                                           skipped.get(schedule.id, frozenset())))
+    occurrences.sort(key=lambda o: (o.session_date, o.start_time))
+    return occurrences
+
+def cancel_occurrence(schedule_id, day):
+    """Annule une occurrence d'une récurrence."""
+    db.session.add(CourseScheduleException(schedule_id=schedule_id, date=day))
+    db.session.commit()
+
+def override_occurrence(schedule_id, day, **changes):
+    """Remplace une occurrence par une séance modifiée (date, horaires ou salle)."""
+    schedule = db.session.get(CourseSchedule, schedule_id)
+    course_session = CourseSession(
+        course_id=schedule.course_id,
+        session_date=changes.get('session_date', day),
+        start_time=changes.get('start_time', schedule.start_time),
+        end_time=changes.get('end_time', schedule.end_time),
+        room_id=changes.get('room_id', schedule.room_id),
+        schedule_id=schedule_id,
+        original_date=day,
+    )
+    db.session.add(course_session)
+    db.session.commit()
+    return course_session
+
+# Absences : appel groupé et récapitulatifs pour les parents
+def record_roll_call(course_id, day, absent_ids, created_by=None):
+    """Enregistre l'appel d'une séance en une transaction.
+
+    Les nouveaux absents sont obtenus par différence d'ensembles avec les
+    absences déjà saisies ; les étudiants de nouveau marqués présents perdent
+    leur absence si elle n'a pas été justifiée. Les avis aux parents sont mis
+    en file pour un récapitulatif, pas envoyés un par un.
+    """
+    absent_ids = set(absent_ids)
+    existing = dict(db.session.query(Absence.student_id, Absence.justified).filter(
+        Absence.course_id == course_id, Absence.date == day))
+    new_ids = absent_ids - existing.keys()
+    cleared_ids = {sid for sid in existing.keys() - absent_ids if not existing[sid]}
+
+    if cleared_ids:
+        cleared = db.session.query(Absence.id).filter(
+            Absence.course_id == course_id, Absence.date == day, Absence.student_id.in_(cleared_ids))
+        ParentNotice.query.filter(ParentNotice.absence_id.in_(cleared), ParentNotice.digested_at.is_(None)).delete(
+            synchronize_session=False)
+        Absence.query.filter(
+            Absence.course_id == course_id, Absence.date == day, Absence.student_id.in_(cleared_ids)
+        ).delete(synchronize_session=False)
+
+    if new_ids:
+        db.session.execute(Absence.__table__.insert(), [
+            {'student_id': sid, 'course_id': course_id, 'date': day, 'justified': False,
+             'notify_parent': True, 'created_by': created_by}
+            for sid in sorted(new_ids)
+        ])
+        # Un avis par nouvelle absence, pour les étudiants dont un parent a une adresse e-mail
+        notices = db.session.query(Absence.id, Absence.student_id).join(Student, Student.id == Absence.student_id).filter(
+            Absence.course_id == course_id, Absence.date == day, Absence.student_id.in_(new_ids),
+            Absence.notify_parent.is_(True), Student.parent_email.isnot(None),
+        ).all()
+        if notices:
+            now = datetime.now(timezone.utc)
+            db.session.execute(ParentNotice.__table__.insert(), [
+                {'student_id': sid, 'absence_id': aid, 'kind': 'absence', 'created_at': now}
+                for aid, sid in notices
+            ])
+
+    db.session.commit()
+    return {'absent': len(absent_ids), 'new': len(new_ids), 'cleared': len(cleared_ids)}
+
+def pending_parent_digests(limit=None):
+    """Regroupe les avis en attente par adresse de parent : [(email, [(id avis, étudiant, absence, cours)])]."""
+    rows = db.session.query(ParentNotice.id, Student, Absence, Course.name).join(
+        Student, Student.id == ParentNotice.student_id
+    ).join(Absence, Absence.id == ParentNotice.absence_id).join(Course, Course.id == Absence.course_id).filter(
+        ParentNotice.digested_at.is_(None), Student.parent_email.isnot(None)
+    ).order_by(Student.parent_email, ParentNotice.id)
+    if limit:
+        rows = rows.limit(limit)
+    digests = {}
+    for notice_id, student, absence, course_name in rows:
+        digests.setdefault(student.parent_email, []).append((notice_id, student, absence, course_name))
+    return list(digests.items())
+
+def mark_notices_digested(notice_ids):
+    """Marque des avis comme envoyés dans un récapitulatif (sans commit)."""
+    ParentNotice.query.filter(ParentNotice.id.in_(notice_ids)).update(
+        {ParentNotice.digested_at: datetime.now(timezone.utc)}, synchronize_session=False)
+
+# Absences : indicateurs glissants et détection des étudiants à risque
+ABSENCE_WINDOWS = (7, 30, 90)
+
+def compute_absence_risk(today=None):
+    """Recalcule la table absence_risk pour toute la promotion.
+
+    Les absences des 90 derniers jours sont chargées en tableaux NumPy ; les
+    taux sur 7, 30 et 90 jours par étudiant et par cours, puis par étudiant,
+    sont obtenus par comptages vectorisés (bincount). Le nombre de séances
+    d'un cours vient de l'emploi du temps, complété par les jours où une
+    absence a été saisie.
+    """
+    import numpy as np
+
+    today = today or date.today()
+    horizon = today - timedelta(days=max(ABSENCE_WINDOWS) - 1)
+    thresholds = app.config['ABSENCE_RISK_THRESHOLDS']
+    justified_weight = app.config['ABSENCE_JUSTIFIED_WEIGHT']
+    now = datetime.now(timezone.utc)
+
+    absences = db.session.query(Absence.student_id, Absence.course_id, Absence.date, Absence.justified).filter(
+        Absence.date >= horizon, Absence.date <= today).all()
+    AbsenceRisk.query.delete(synchronize_session=False)
+    if not absences:
+        db.session.commit()
+        return {'rows': 0, 'flagged': 0}
+
+    students, courses, dates, justified = zip(*absences)
+    students = np.array(students, dtype=np.int64)
+    courses = np.array(courses, dtype=np.int64)
+    days_ago = (np.datetime64(today, 'D') - np.array(dates, dtype='datetime64[D]')).astype(np.int64)
+    justified = np.array([bool(j) for j in justified])
+
+    # Couples (étudiant, cours) : inscriptions et couples ayant au moins une absence
+    enrollments = db.session.query(Enrollment.student_id, Enrollment.course_id).filter(
+        Enrollment.student_id.in_(db.session.query(Absence.student_id).filter(Absence.date >= horizon))).all()
+    pair_students = np.concatenate([students, np.array([e[0] for e in enrollments], dtype=np.int64)])
+    pair_courses = np.concatenate([courses, np.array([e[1] for e in enrollments], dtype=np.int64)])
+    course_ids, pair_course_idx = np.unique(pair_courses, return_inverse=True)
+    pair_keys = pair_students * len(course_ids) + pair_course_idx
+    pair_keys, first = np.unique(pair_keys, return_index=True)
+    pair_student = pair_students[first]
+    pair_course = pair_course_idx[first]
+    absence_pair = np.searchsorted(pair_keys, students * len(course_ids) + np.searchsorted(course_ids, courses))
+    student_ids, pair_student_idx = np.unique(pair_student, return_inverse=True)
+
+    # Jours de séance par cours : emploi du temps et jours d'absence saisis
+    held = [(o.course_id, (today - o.session_date).days) for o in timetable(course_ids.tolist(), horizon, today + timedelta(days=1))]
+    held_courses = np.concatenate([np.array([h[0] for h in held], dtype=np.int64), courses])
+    held_days = np.concatenate([np.array([h[1] for h in held], dtype=np.int64), days_ago])
+    held_keys = np.unique(np.searchsorted(course_ids, held_courses) * 1000 + held_days)
+    held_course_idx, held_days = held_keys // 1000, held_keys % 1000
+
+    n_pairs, n_students = len(pair_keys), len(student_ids)
+    stats = {}
+    for window in ABSENCE_WINDOWS:
+        in_window = days_ago < window
+        total = np.bincount(absence_pair[in_window], minlength=n_pairs)
+        unjustified = np.bincount(absence_pair[in_window & ~justified], minlength=n_pairs)
+        weighted = unjustified + justified_weight * (total - unjustified)
+        sessions = np.bincount(held_course_idx[held_days < window], minlength=len(course_ids))[pair_course]
+        student_weighted = np.bincount(pair_student_idx, weights=weighted, minlength=n_students)
+        student_sessions = np.bincount(pair_student_idx, weights=sessions, minlength=n_students)
+        stats[window] = {
+            'total': total,
+            'unjustified': unjustified,
+            'sessions': sessions,
+            'rate': weighted / np.maximum(sessions, 1),
+            'student_total': np.bincount(pair_student_idx, weights=total, minlength=n_students),
+            'student_unjustified': np.bincount(pair_student_idx, weights=unjustified, minlength=n_students),
+            'student_sessions': student_sessions,
+            'student_rate': student_weighted / np.maximum(student_sessions, 1),
+        }
+    pair_score = np.max([stats[w]['rate'] / thresholds[w] for w in ABSENCE_WINDOWS], axis=0)
+    student_score = np.max([stats[w]['student_rate'] / thresholds[w] for w in ABSENCE_WINDOWS], axis=0)
+
+    def result_rows(ids, course_of, prefix, score):
+        for i in np.flatnonzero(stats[90][prefix + 'total']):
+            yield {
+                'student_id': int(ids[i]),
+                'course_id': course_of(i),
+                'absences_7': int(stats[7][prefix + 'total'][i]),
+                'absences_30': int(stats[30][prefix + 'total'][i]),
+                'absences_90': int(stats[90][prefix + 'total'][i]),
+                'unjustified_90': int(stats[90][prefix + 'unjustified'][i]),
+                'sessions_90': int(stats[90][prefix + 'sessions'][i]),
+                'rate_7': float(stats[7][prefix + 'rate'][i]),
+                'rate_30': float(stats[30][prefix + 'rate'][i]),
+                'rate_90': float(stats[90][prefix + 'rate'][i]),
+                'risk_score': float(score[i]),
+                'flagged': bool(score[i] >= 1),
+                'computed_at': now,
+            }
+
+    rows = list(result_rows(pair_student, lambda i: int(course_ids[pair_course[i]]), '', pair_score))
+    rows.extend(result_rows(student_ids, lambda i: None, 'student_', student_score))
+    db.session.execute(AbsenceRisk.__table__.insert(), rows)
+    db.session.commit()
+    return {'rows': len(rows), 'flagged': sum(1 for row in rows if row['flagged'] and row['course_id'] is None)}
+
+@app.cli.command('absence-risk')
+def absence_risk_command():
+    """Tâche quotidienne : recalcule les indicateurs d'absentéisme."""
+    started = time.perf_counter()
+    result = compute_absence_risk()
+    print(f"{result['rows']} lignes calculées, {result['flagged']} étudiants signalés "
+          f"({time.perf_counter() - started:.2f} s)")
+
+# Paiements : rapprochement des relevés bancaires
+PAYMENT_STATUS_PENDING = 'pending'
+PAYMENT_STATUS_VALIDATED = 'validated'
+
+def _parse_statement_amount(value):
+    """Montant en centimes ('1 234,50', '1234.50' ou '-1234.5')."""
+    value = value.strip().replace('\u00a0', '').replace(' ', '')
+    if ',' in value:
+        value = value.replace('.', '').replace(',', '.')
+    amount = float(value)
+    if not math.isfinite(amount):  # 'inf', 'nan', '1e400'
+        raise ValueError(f'montant invalide : {value}')
+    return round(amount * 100)
+
+def _parse_statement_date(value):
+    value = value.strip()
+    for fmt in ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y'):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    raise ValueError(f'date invalide : {value}')
+
+class PendingPaymentIndex:
+    """Index en mémoire des paiements en attente : par transaction, par facture et par montant."""
+
+    def __init__(self):
+        self.by_transaction = {}  # référence -> (id, centimes)
+        self.by_invoice = {}
+        self.by_amount = {}  # centimes -> [(id, date)]
+        self.matched = set()
+        for payment_id, transaction_id, invoice_number, amount, payment_date, due_date in db.session.query(
+            Payment.id, Payment.transaction_id, Payment.invoice_number, Payment.amount,
+            Payment.payment_date, Payment.due_date,
+        ).filter(Payment.status == PAYMENT_STATUS_PENDING):
+            cents = round(amount * 100)
+            if transaction_id:
+                # Référence bancaire connue : rapprochement par transaction uniquement
+                self.by_transaction[transaction_id.strip().upper()] = (payment_id, cents)
+                continue
+            if invoice_number:
+                self.by_invoice[invoice_number.strip().upper()] = (payment_id, cents)
+            self.by_amount.setdefault(cents, []).append(
+                (payment_id, due_date or payment_date, bool(invoice_number)))
+
+    def __len__(self):
+        return len(self.by_transaction) + sum(len(candidates) for candidates in self.by_amount.values())
+
+    def match(self, reference, label, cents, day, tolerance):
+        """Retourne (id du paiement, méthode) ou (None, None) ; un paiement n'est rapproché qu'une fois.
+
+        Une ligne qui cite la référence d'un paiement d'un autre montant
+        (virement partiel, erreur de saisie) n'est pas rapprochée : elle
+        retourne (None, 'amount_mismatch').
+        """
+        mismatch = False
+        for key in filter(None, (reference.strip().upper(), *label.upper().split())):
+            for index, method in ((self.by_transaction, 'transaction'), (self.by_invoice, 'invoice')):
+                payment_id, expected = index.get(key, (None, None))
+                if payment_id is None or payment_id in self.matched:
+                    continue
+                if expected != cents:
+                    mismatch = True
+                    continue
+                self.matched.add(payment_id)
+                return payment_id, method
+        if mismatch:
+            return None, 'amount_mismatch'
+        # Par montant : date la plus proche, les paiements sans facture d'abord
+        best = None
+        for payment_id, expected, has_invoice in self.by_amount.get(cents, ()):
+            if payment_id in self.matched or expected is None:
+                continue
+            gap = abs((day - expected).days)
+            if gap <= tolerance and (best is None or (has_invoice, gap) < best[1]):
+                best = (payment_id, (has_invoice, gap))
+        if best:
+            self.matched.add(best[0])
+            return best[0], 'amount'
+        return None, None
+
+def _flush_reconciled(batch):
+    """Valide un lot de paiements rapprochés : un UPDATE ensembliste, puis les références manquantes."""
+    if not batch:
+        return 0
+    payment_ids = [payment_id for payment_id, _ in batch]
+    updated = Payment.query.filter(
+        Payment.id.in_(payment_ids), Payment.status == PAYMENT_STATUS_PENDING
+    ).update({Payment.status: PAYMENT_STATUS_VALIDATED}, synchronize_session=False)
+    refresh_student_balances(sid for (sid,) in db.session.query(Payment.student_id).filter(Payment.id.in_(payment_ids)))
+    references = [{'pid': payment_id, 'reference': reference} for payment_id, reference in batch if reference]
+    if references:
+        table = Payment.__table__
+        db.session.execute(
+            table.update().where(table.c.id == db.bindparam('pid'), table.c.transaction_id.is_(None))
+            .values(transaction_id=db.bindparam('reference')),
+            references,
+        )
+    db.session.commit()
+    batch.clear()
+    return updated
+
+def reconcile_statement(lines, report, delimiter=';'):
+    """Rapproche un relevé (itérable de lignes CSV) des paiements en attente.
+
+    Colonnes attendues : date, amount, reference, label. Le relevé est lu en
+    flux ; seuls l'index des paiements en attente et un lot de rapprochements
+    restent en mémoire. Les lignes non rapprochées sont écrites dans `report`.
+    """
+    tolerance = app.config['RECONCILIATION_DATE_TOLERANCE_DAYS']
+    batch_size = app.config['RECONCILIATION_BATCH_SIZE']
+    index = PendingPaymentIndex()
+    writer = csv.writer(report, delimiter=delimiter)
+    writer.writerow(['line', 'date', 'amount', 'reference', 'label', 'reason'])
+    stats = {'lines': 0, 'matched': 0, 'validated': 0, 'unmatched': 0, 'pending': len(index)}
+    methods = {}
+    batch = []
+
+    for number, row in enumerate(csv.DictReader(lines, delimiter=delimiter), start=2):
+        stats['lines'] += 1
+        reference, label = row.get('reference') or '', row.get('label') or ''
+        try:
+            cents = _parse_statement_amount(row.get('amount') or '')
+            day = _parse_statement_date(row.get('date') or '')
+        except ValueError as e:
+            writer.writerow([number, row.get('date'), row.get('amount'), reference, label, f'illisible ({e})'])
+            stats['unmatched'] += 1
+            continue
+        payment_id, method = index.match(reference, label, cents, day, tolerance) if cents > 0 else (None, None)
+        if payment_id is None:
+            reason = 'montant différent' if method == 'amount_mismatch' else 'aucun paiement en attente'
+            writer.writerow([number, day.isoformat(), f'{cents / 100:.2f}', reference, label, reason])
+            stats['unmatched'] += 1
+            continue
+        stats['matched'] += 1
+        methods[method] = methods.get(method, 0) + 1
+        batch.append((payment_id, reference.strip() or None))
+        if len(batch) >= batch_size:
+            stats['validated'] += _flush_reconciled(batch)
+
+    stats['validated'] += _flush_reconciled(batch)
+    stats['methods'] = methods
+    return stats
+
+@app.cli.command('reconcile-statement')
+@click.argument('statement', type=click.Path(exists=True, dir_okay=False))
+@click.option('--report', type=click.Path(dir_okay=False), default='rapprochement_non_rapproches.csv')
+@click.option('--delimiter', default=';')
+def reconcile_statement_command(statement, report, delimiter):
+    """Rapproche un relevé bancaire CSV des paiements en attente."""
+    started = time.perf_counter()
+    with open(statement, newline='', encoding='utf-8-sig') as lines, open(report, 'w', newline='', encoding='utf-8') as out:
+        stats = reconcile_statement(lines, out, delimiter=delimiter)
+    elapsed = time.perf_counter() - started
+    print(f"{stats['lines']} lignes en {elapsed:.2f} s ({stats['lines'] / max(elapsed, 1e-9):.0f}/s) : "
+          f"{stats['validated']} paiements validés, {stats['unmatched']} lignes non rapprochées (voir {report})")
+    print(f"Méthodes : {stats['methods']}")
+
+# Paiements : soldes des comptes étudiants tenus à jour
+SCHOLARSHIP_ACTIVE_STATUSES = ('approved', 'active')
+
+def _balance_rows(connection, student_ids=None, lock=False):
+    """Calcule les soldes (de quelques étudiants ou de tous) en deux agrégations.
+
+    lock=True lit en mode verrouillant (FOR UPDATE) : sous MySQL, la lecture
+    voit alors les dernières lignes validées et non l'instantané de la
+    transaction.
+    """
+    payment, scholarship = Payment.__table__, Scholarship.__table__
+    pending = payment.c.status == PAYMENT_STATUS_PENDING
+    payments = db.select(
+        payment.c.student_id,
+        db.func.sum(db.case((pending, payment.c.amount), else_=0)),
+        db.func.sum(db.case((payment.c.status == PAYMENT_STATUS_VALIDATED, payment.c.amount), else_=0)),
+        db.func.min(db.case((pending, payment.c.due_date), else_=None)),
+    ).group_by(payment.c.student_id)
+    scholarships = db.select(scholarship.c.student_id, db.func.sum(scholarship.c.amount)).where(
+        scholarship.c.status.in_(SCHOLARSHIP_ACTIVE_STATUSES)).group_by(scholarship.c.student_id)
+    if student_ids is not None:
+        payments = payments.where(payment.c.student_id.in_(student_ids))
+        scholarships = scholarships.where(scholarship.c.student_id.in_(student_ids))
+    if lock:
+        payments, scholarships = payments.with_for_update(), scholarships.with_for_update()
+
+    now = datetime.now(timezone.utc)
+    rows = {}
+    for student_id, due, paid, oldest in connection.execute(payments):
+        rows[student_id] = {'student_id': student_id, 'due_total': due or 0.0, 'paid_total': paid or 0.0,
+                            'scholarship_total': 0.0, 'oldest_due_date': oldest, 'updated_at': now}
+    for student_id, amount in connection.execute(scholarships):
+        row = rows.setdefault(student_id, {'student_id': student_id, 'due_total': 0.0, 'paid_total': 0.0,
+                                           'oldest_due_date': None, 'updated_at': now})
+        row['scholarship_total'] = amount or 0.0
+    for row in rows.values():
+        row['balance'] = row['due_total'] - row['scholarship_total']
+        if isinstance(row['oldest_due_date'], str):  # SQLite renvoie MIN(date) sous forme de texte
+            row['oldest_due_date'] = date.fromisoformat(row['oldest_due_date'])
+    return rows
+
+def refresh_student_balances(student_ids, connection=None):
+    """Recalcule les soldes de quelques étudiants dans la transaction courante.
+
+    Les lignes de solde sont créées au besoin puis verrouillées avant
+    l'agrégation : deux écritures concurrentes pour un même étudiant se
+    succèdent, et la seconde recalcule avec les paiements de la première.
+    """
+    student_ids = sorted(set(student_ids))
+    if not student_ids:
+        return
+    connection = connection or db.session.connection()
+    table = StudentBalance.__table__
+    locked = db.select(table.c.student_id).where(table.c.student_id.in_(student_ids)).with_for_update()
+    existing = set(connection.scalars(locked))
+    for student_id in student_ids:
+        if student_id not in existing:
+            try:
+                with connection.begin_nested():
+                    connection.execute(table.insert().values(student_id=student_id,
+                                                             updated_at=datetime.now(timezone.utc)))
+            except db.exc.IntegrityError:  # Créée entre-temps par une transaction concurrente
+                pass
+    if len(existing) < len(student_ids):
+        connection.execute(locked)
+
+    rows = _balance_rows(connection, student_ids, lock=True)
+    empty = [student_id for student_id in student_ids if student_id not in rows]
+    if empty:
+        connection.execute(table.delete().where(table.c.student_id.in_(empty)))
+    if rows:
+        fields = ('due_total', 'paid_total', 'scholarship_total', 'balance', 'oldest_due_date', 'updated_at')
+        connection.execute(
+            table.update().where(table.c.student_id == db.bindparam('sid')).values(
+                {field: db.bindparam(f'new_{field}') for field in fields}),
+            [{'sid': row['student_id'], **{f'new_{field}': row[field] for field in fields}} for row in rows.values()],
+        )
+
+@event.listens_for(Payment.student_id, 'set', active_history=True)
+@event.listens_for(Scholarship.student_id, 'set', active_history=True)
+def _track_balance_owner(target, value, oldvalue, initiator):
+    """Charge l'ancien étudiant avant modification, pour recalculer aussi son solde."""
+
+@event.listens_for(db.session, 'after_flush')
+def _refresh_balances_after_flush(session, flush_context):
+    student_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Payment, Scholarship)):
+            history = db.inspect(obj).attrs.student_id.history
+            student_ids.update(sid for sid in (obj.student_id, *history.deleted) if sid is not None)
+    if student_ids:
+        refresh_student_balances(student_ids, session.connection())
+
+def rebuild_student_balances():
+    """Reconstruit tous les soldes en une passe ; retourne les étudiants dont le solde était faux."""
+    table = StudentBalance.__table__
+    connection = db.session.connection()
+    expected = _balance_rows(connection)
+    stored = {row.student_id: row for row in connection.execute(db.select(table))}
+    fields = ('due_total', 'paid_total', 'scholarship_total', 'balance')
+    mismatched = sorted(
+        student_id for student_id in expected.keys() | stored.keys()
+        if student_id not in expected or student_id not in stored
+        or any(abs(expected[student_id][f] - getattr(stored[student_id], f)) > 0.005 for f in fields)
+        or expected[student_id]['oldest_due_date'] != stored[student_id].oldest_due_date
+    )
+    connection.execute(table.delete())
+    if expected:
+        connection.execute(table.insert(), list(expected.values()))
+    db.session.commit()
+    return mismatched
+
+def overdue_balances(today=None, limit=None):
+    """Soldes à relancer : échéance dépassée et reste à payer positif (index oldest_due_date)."""
+    query = StudentBalance.query.filter(
+        StudentBalance.oldest_due_date < (today or date.today()), StudentBalance.balance > 0
+    ).order_by(StudentBalance.oldest_due_date)
+    return query.limit(limit).all() if limit else query.all()
+
+@app.cli.command('ledger-check')
+def ledger_check_command():
+    """Vérifie et reconstruit les soldes des comptes étudiants."""
+    started = time.perf_counter()
+    mismatched = rebuild_student_balances()
+    print(f"Soldes reconstruits en {time.perf_counter() - started:.2f} s, {len(mismatched)} incohérences corrigées")
+    if mismatched:
+        print(f"Étudiants concernés : {mismatched[:50]}")
+
+# Forums : compteurs de sujets et pagination par clé
+def _refresh_forum_activity(connection, forum_id):
+    """Recalcule la dernière activité d'un forum (sujet le plus récent, via l'index)."""
+    forum, topic = Forum.__table__, ForumTopic.__table__
+    latest = db.select(db.func.max(topic.c.created_at)).where(topic.c.forum_id == forum_id).scalar_subquery()
+    connection.execute(forum.update().where(forum.c.id == forum_id).values(last_activity_at=latest))
+
+@event.listens_for(ForumTopic, 'after_insert')
+def _forum_topic_inserted(mapper, connection, target):
+    forum = Forum.__table__
+    connection.execute(forum.update().where(forum.c.id == target.forum_id).values(
+        topic_count=forum.c.topic_count + 1,
+        last_activity_at=db.case(
+            (db.or_(forum.c.last_activity_at.is_(None), forum.c.last_activity_at < target.created_at), target.created_at),
+            else_=forum.c.last_activity_at,
+        ),
+    ))
+
+@event.listens_for(ForumTopic, 'after_delete')
+def _forum_topic_deleted(mapper, connection, target):
+    forum = Forum.__table__
+    connection.execute(forum.update().where(forum.c.id == target.forum_id).values(topic_count=forum.c.topic_count - 1))
+    _refresh_forum_activity(connection, target.forum_id)
+
+@event.listens_for(ForumTopic.forum_id, 'set', active_history=True)
+def _track_topic_forum(target, value, oldvalue, initiator):
+    """Charge l'ancien forum avant modification, pour corriger ses compteurs."""
+
+@event.listens_for(ForumTopic, 'after_update')
+def _forum_topic_moved(mapper, connection, target):
+    history = db.inspect(target).attrs.forum_id.history
+    if not history.deleted or history.deleted[0] == target.forum_id:
+        return
+    forum = Forum.__table__
+    old_forum_id = history.deleted[0]
+    connection.execute(forum.update().where(forum.c.id == old_forum_id).values(topic_count=forum.c.topic_count - 1))
+    connection.execute(forum.update().where(forum.c.id == target.forum_id).values(topic_count=forum.c.topic_count + 1))
+    _refresh_forum_activity(connection, old_forum_id)
+    _refresh_forum_activity(connection, target.forum_id)
+
+def rebuild_forum_counters():
+    """Recalcule les compteurs de tous les forums en une requête UPDATE."""
+    forum, topic = Forum.__table__, ForumTopic.__table__
+    db.session.execute(forum.update().values(
+        topic_count=db.select(db.func.count(topic.c.id)).where(topic.c.forum_id == forum.c.id).scalar_subquery(),
+        last_activity_at=db.select(db.func.max(topic.c.created_at)).where(topic.c.forum_id == forum.c.id).scalar_subquery(),
+    ))
+    db.session.commit()
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+def _cursor_int(value):
+    if isinstance(value, bool) or not isinstance(value, int) or not -2 ** 63 <= value < 2 ** 63:
+        raise ValueError(value)
+    return value
+
+def _cursor_bool(value):
+    if not isinstance(value, bool):
+        raise ValueError(value)
+    return value
+
+def _decode_cursor(cursor, *fields):
+    """Décode un curseur de pagination ; chaque valeur passe par le convertisseur de même rang.
+
+    Lève ValueError si le curseur est mal encodé ou n'a pas la forme attendue
+    (nombre de valeurs, types) : les vues répondent alors 400.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(fields):
+            raise ValueError(values)
+        return [field(value) for field, value in zip(fields, values)]
+    except (ValueError, TypeError) as exc:
+        raise ValueError('Curseur de pagination invalide.') from exc
+
+def forum_topics_page(forum_id, cursor=None, per_page=20):
+    """Une page de sujets triés par (épinglé, date) décroissants ; retourne (sujets, curseur suivant).
+
+    La page suivante reprend après le dernier sujet affiché (pagination par
+    clé sur l'index forum_id, is_sticky, created_at, id) : le coût ne dépend
+    pas de la profondeur de la page, contrairement à OFFSET. Un curseur mal
+    formé lève ValueError.
+    """
+    per_page = max(1, per_page)
+    query = ForumTopic.query.filter(ForumTopic.forum_id == forum_id)
+    if cursor:
+        is_sticky, created_at, topic_id = _decode_cursor(cursor, _cursor_bool, datetime.fromisoformat, _cursor_int)
+        after_in_group = db.and_(ForumTopic.is_sticky.is_(is_sticky), db.or_(
+            ForumTopic.created_at < created_at,
+            db.and_(ForumTopic.created_at == created_at, ForumTopic.id < topic_id),
+        ))
+        # Après le dernier sujet épinglé viennent tous les sujets non épinglés
+        query = query.filter(db.or_(after_in_group, ForumTopic.is_sticky.is_(False)) if is_sticky else after_in_group)
+    topics = query.order_by(
+        ForumTopic.is_sticky.desc(), ForumTopic.created_at.desc(), ForumTopic.id.desc()
+    ).limit(per_page + 1).all()
+    next_cursor = None
+    if len(topics) > per_page:
+        topics = topics[:per_page]
+        last = topics[-1]
+        next_cursor = _encode_cursor([bool(last.is_sticky), last.created_at.isoformat(), last.id])
+    return topics, next_cursor
+
+@app.cli.command('forum-counters')
+def forum_counters_command():
+    """Recalcule le nombre de sujets et la dernière activité de chaque forum."""
+    rebuild_forum_counters()
+    print(f"Compteurs recalculés pour {Forum.query.count()} forums.")
+
+# Fichiers déposés : stockage adressé par contenu
+# Les colonnes de chemin (Student.photo, CourseResource.file_path...) reçoivent
+# une clé « sha256:<empreinte> » ; les anciennes valeurs restent des chemins
+# relatifs au dossier static.
+STORAGE_KEY_PREFIX = 'sha256:'
+STORAGE_CHUNK_SIZE = 64 * 1024
+
+def storage_path(sha256):
+    """Chemin du contenu sur disque, réparti en sous-dossiers (ab/cd/abcd...)."""
+    return os.path.join(app.config['STORAGE_ROOT'], sha256[:2], sha256[2:4], sha256)
+
+def store_stream(stream, content_type=None):
+    """Enregistre un flux par blocs en calculant son empreinte ; retourne la clé de stockage.
+
+    Le contenu est écrit dans un fichier temporaire pendant le calcul, puis
+    renommé à son emplacement définitif. Un contenu déjà connu n'est pas
+    conservé une seconde fois.
+    """
+    tmp_dir = campus_path(os.path.join(app.config['STORAGE_ROOT'], 'tmp'))
+    os.makedirs(tmp_dir, exist_ok=True)
+    digest, size = hashlib.sha256(), 0
+    with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as tmp:
+        try:
+            for chunk in iter(lambda: stream.read(STORAGE_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+                tmp.write(chunk)
+        except BaseException:
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+    sha256 = digest.hexdigest()
+    target = storage_path(sha256)
+    if os.path.exists(target):
+        os.unlink(tmp.name)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(tmp.name, target)
+
+    if db.session.get(StoredFile, sha256) is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(StoredFile(sha256=sha256, size=size, content_type=content_type))
+        except db.exc.IntegrityError:
+            pass  # Même contenu déposé au même moment par un autre utilisateur
+    return STORAGE_KEY_PREFIX + sha256
+
+def stored_sha256(value):
+    """Empreinte d'une clé de stockage, ou None pour un ancien chemin."""
+    if value and value.startswith(STORAGE_KEY_PREFIX):
+        return value[len(STORAGE_KEY_PREFIX):]
+    return None
+
+@app.template_global()
+def file_url(value, **params):
+    """URL d'un fichier enregistré (clé de stockage ou ancien chemin du dossier static)."""
+    sha256 = stored_sha256(value)
+    if sha256 is None:
+        return url_for('static', filename=value)
+    return url_for('download_file', sha256=sha256, **params)
+
+# Colonnes de fichier qu'un dépôt peut renseigner : cible -> (modèle, colonne)
+STORAGE_TARGETS = {
+    'student_photo': (Student, 'photo'),
+    'profile_image': (User, 'profile_image'),
+    'course_resource': (CourseResource, 'file_path'),
+    'absence_justification': (Absence, 'justification_document'),
+    'internship_contract': (Internship, 'contract_path'),
+    'internship_report': (Internship, 'report_path'),
+    'payment_receipt': (Payment, 'receipt_path'),
+}
+
+def _can_attach(target, obj):
+    if session.get('user_type') in ('admin', 'staff'):
+        return True
+    if target == 'profile_image':
+        return obj.id == session['user_id']
+    if target == 'course_resource':
+        teacher = current_teacher() if session.get('user_type') == 'teacher' else None
+        course = db.session.get(Course, obj.course_id)
+        return teacher is not None and course is not None and course.teacher_id == teacher.id
+    student = current_student()
+    owner_id = obj.id if isinstance(obj, Student) else getattr(obj, 'student_id', None)
+    return student is not None and owner_id == student.id
+
+# Photos affichées à tout utilisateur connecté (listes, annuaires) : modèle -> colonne
+PUBLIC_STORAGE_COLUMNS = ((Student, 'photo'), (Teacher, 'photo'), (User, 'profile_image'))
+# Documents personnels d'un étudiant : lisibles par lui seul (et le personnel)
+STUDENT_STORAGE_TARGETS = ('absence_justification', 'internship_contract', 'internship_report', 'payment_receipt')
+
+def can_read_file(sha256):
+    """Droit de lecture d'un contenu stocké pour l'utilisateur connecté.
+
+    Le contenu est servi au personnel, ou si l'une des fiches qui le
+    référencent est visible de l'utilisateur : photo, document de l'étudiant
+    connecté, ressource d'un cours qu'il suit ou qu'il enseigne, justificatif
+    d'absence à l'un de ses cours pour un enseignant. Un contenu qu'aucune
+    fiche ne référence n'est servi qu'au personnel.
+    """
+    if session.get('user_type') in ('admin', 'staff'):
+        return True
+    key = STORAGE_KEY_PREFIX + sha256
+
+    def referenced(query, column):
+        return db.session.query(query.filter(column == key).exists()).scalar()
+
+    student = current_student() if session.get('user_type') == 'student' else None
+    if student is not None:
+        for target in STUDENT_STORAGE_TARGETS:
+            model, column = STORAGE_TARGETS[target]
+            if referenced(model.query.filter(model.student_id == student.id), getattr(model, column)):
+                return True
+        enrolled = db.session.query(Enrollment.course_id).filter(Enrollment.student_id == student.id)
+        if referenced(CourseResource.query.filter(CourseResource.course_id.in_(enrolled)), CourseResource.file_path):
+            return True
+    teacher = current_teacher() if session.get('user_type') == 'teacher' else None
+    if teacher is not None:
+        taught = db.session.query(Course.id).filter(Course.teacher_id == teacher.id)
+        if referenced(CourseResource.query.filter(CourseResource.course_id.in_(taught)), CourseResource.file_path):
+            return True
+        if referenced(Absence.query.filter(Absence.course_id.in_(taught)), Absence.justification_document):
+            return True
+    return any(referenced(model.query, getattr(model, column)) for model, column in PUBLIC_STORAGE_COLUMNS)
+
+@app.route('/files', methods=['POST'])
+def upload_file():
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify(error='Aucun fichier reçu.'), 400
+    target = request.form.get('target')
+    obj = None
+    if target:
+        if target not in STORAGE_TARGETS:
+            return jsonify(error='Cible inconnue.'), 400
+        model, _ = STORAGE_TARGETS[target]
+        obj = db.session.get(model, request.form.get('id', type=int))
+        if obj is None:
+            return jsonify(error='Élément introuvable.'), 404
+        if not _can_attach(target, obj):
+            return jsonify(error='Accès refusé : droits insuffisants.'), 403
+
+    key = store_stream(upload.stream, upload.mimetype)  # Werkzeug garde les gros dépôts sur disque
+    if obj is not None:
+        setattr(obj, STORAGE_TARGETS[target][1], key)
+    db.session.commit()
+    return jsonify(key=key, url=file_url(key)), 201
+
+@app.route('/files/<sha256>')
+def download_file(sha256):
+    if 'user_id' not in session:
+        abort(401)
+    stored = db.session.get(StoredFile, sha256)
+    if stored is None or not os.path.exists(storage_path(sha256)):
+        abort(404)
+    if not can_read_file(sha256):
+        abort(403)
+
+    name = request.args.get('name')
+    mode = app.config['STORAGE_SENDFILE']
+    if mode:
+        # Le serveur frontal envoie le fichier : le worker Flask ne lit pas le contenu
+        response = app.response_class(mimetype=stored.content_type or 'application/octet-stream')
+        if mode == 'x-accel':
+            response.headers['X-Accel-Redirect'] = (
+                app.config['STORAGE_ACCEL_PREFIX'] + os.path.relpath(storage_path(sha256), app.config['STORAGE_ROOT']))
+        else:
+            response.headers['X-Sendfile'] = storage_path(sha256)
+        if name:
+            response.headers.set('Content-Disposition', 'attachment', filename=name)
+        response.set_etag(sha256)
+    else:
+        # Envoi par blocs avec prise en charge des requêtes Range et If-None-Match
+        response = send_file(storage_path(sha256), mimetype=stored.content_type or 'application/octet-stream',
+                             as_attachment=bool(name), download_name=name, conditional=True, etag=sha256)
+    # Le contenu d'une empreinte ne change jamais
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+# Miniatures : générées à la demande par un groupe de threads, conservées sur disque
+_thumbnail_pool = None
+_thumbnail_jobs = {}  # (empreinte, taille) -> Future en cours
+_thumbnail_lock = threading.Lock()
+
+def thumbnail_path(sha256, size):
+    return os.path.join(app.config['STORAGE_ROOT'], 'thumbs', str(size), sha256[:2], f'{sha256}.jpg')
+
+def _render_thumbnail(source, target, size):
+    """Recadre l'image au carré et l'enregistre en JPEG (Pillow requis)."""
+    from PIL import Image, ImageOps
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            thumbnail.save(out, 'JPEG', quality=85, optimize=True)
+        os.replace(tmp, target)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return target
+
+def ensure_thumbnail(sha256, size):
+    """Retourne le chemin de la miniature, en la générant si besoin (une seule fois par couple).
+
+    Lève TimeoutError si la génération n'est pas terminée au bout de
+    THUMBNAIL_TIMEOUT_SECONDS ; elle se poursuit et servira aux demandes suivantes.
+    """
+    target = thumbnail_path(sha256, size)
+    if os.path.exists(target):
+        record_cache('thumbnail', True)
+        return target
+    record_cache('thumbnail', False)
+    global _thumbnail_pool
+    with _thumbnail_lock:
+        future = _thumbnail_jobs.get((sha256, size))
+        if future is None:
+            if _thumbnail_pool is None:
+                _thumbnail_pool = ThreadPoolExecutor(max_workers=app.config['THUMBNAIL_WORKERS'],
+                                                     thread_name_prefix='thumbnail')
+            future = _thumbnail_pool.submit(_render_thumbnail, storage_path(sha256), target, size)
+            _thumbnail_jobs[(sha256, size)] = future
+            future.add_done_callback(lambda _: _thumbnail_jobs.pop((sha256, size), None))
+    return future.result(timeout=app.config['THUMBNAIL_TIMEOUT_SECONDS'])
+
+@metrics.gauge
+def _thumbnail_queue_depth():
+    with _thumbnail_lock:
+        pending = len(_thumbnail_jobs)  # Miniatures soumises et pas encore terminées (en file ou en cours)
+    return [('worker_queue_depth', (('queue', 'thumbnail'),), pending)]
+
+@app.template_global()
+def thumbnail_url(value, size):
+    """URL d'une miniature ; les anciennes photos du dossier static sont servies telles quelles."""
+    sha256 = stored_sha256(value)
+    if sha256 is None:
+        return url_for('static', filename=value)
+    return url_for('download_thumbnail', sha256=sha256, size=size)
+
+@app.route('/files/<sha256>/thumbnail/<int:size>')
+def download_thumbnail(sha256, size):
+    if 'user_id' not in session:
+        abort(401)
+    if size not in app.config['THUMBNAIL_SIZES'] or db.session.get(StoredFile, sha256) is None:
+        abort(404)
+    if not can_read_file(sha256):
+        abort(403)
+    try:
+        path = ensure_thumbnail(sha256, size)
+    except TimeoutError:  # File de génération saturée : le client réessaiera (avant OSError, sa classe mère)
+        return app.response_class('Miniature en cours de génération, veuillez réessayer.', status=503,
+                                  headers={'Retry-After': '5'})
+    except OSError:  # Fichier absent ou qui n'est pas une image
+        abort(404)
+    response = send_file(path, mimetype='image/jpeg', conditional=True, etag=f'{sha256}-{size}')
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+# Photos affichées en miniature : modèle -> colonne
+THUMBNAIL_SOURCES = ((Student, 'photo'), (Teacher, 'photo'), (User, 'profile_image'))
+
+def import_static_photos():
+    """Transfère les anciennes photos du dossier static dans le stockage par empreinte."""
+    imported = 0
+    for model, column in THUMBNAIL_SOURCES:
+        attr = getattr(model, column)
+        for obj in model.query.filter(attr.isnot(None), attr != '', ~attr.startswith(STORAGE_KEY_PREFIX)):
+            path = os.path.join(app.static_folder, getattr(obj, column))
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as source:
+                setattr(obj, column, store_stream(source))
+            imported += 1
+        db.session.commit()
+    return imported
+
+@app.cli.command('thumbnails')
+@click.option('--workers', default=4)
+def thumbnails_command(workers):
+    """Génère à l'avance les miniatures de toutes les photos existantes."""
+    imported = import_static_photos()
+    hashes = set()
+    for model, column in THUMBNAIL_SOURCES:
+        attr = getattr(model, column)
+        hashes.update(stored_sha256(value) for (value,) in db.session.query(attr).filter(attr.startswith(STORAGE_KEY_PREFIX)))
+    jobs = [(sha256, size) for sha256 in hashes for size in app.config['THUMBNAIL_SIZES']
+            if not os.path.exists(thumbnail_path(sha256, size))]
+
+    started, failed = time.perf_counter(), 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_render_thumbnail, storage_path(sha256), thumbnail_path(sha256, size), size)
+                   for sha256, size in jobs]
+        for future in futures:
+            try:
+                future.result()
+            except OSError:
+                failed += 1
+    print(f"{imported} photos importées, {len(jobs) - failed} miniatures générées en "
+          f"{time.perf_counter() - started:.2f} s, {failed} échecs")
+
+# Notes : moyennes par cours mises en cache, import de feuilles de notes
+def _average_pairs_filter(student_id=None, course_id=None):
+    conditions = []
+    if student_id is not None:
+        conditions.append(Grade.student_id == student_id)
+    if course_id is not None:
+        conditions.append(Grade.course_id == course_id)
+    return conditions
+
+def _average_select(*conditions):
+    """Moyenne pondérée sur 20 et nombre de notes par (étudiant, cours), même pondération que les relevés."""
+    weight = db.func.coalesce(Grade.weight, 1.0) * db.func.coalesce(Exam.weight, 1.0)
+    weights = db.func.sum(weight)
+    return db.select(
+        Grade.student_id, Grade.course_id,
+        db.case((weights > 0, db.func.sum(Grade.value / db.func.coalesce(Exam.max_score, 20.0) * 20 * weight) / weights),
+                else_=0.0),
+        db.func.count(Grade.id),
+    ).outerjoin(Exam, Exam.id == Grade.exam_id).where(*conditions).group_by(Grade.student_id, Grade.course_id)
+
+def course_averages(student_id=None, course_id=None):
+    """Moyennes sur 20 par (étudiant, cours), lues dans course_average et complétées au besoin.
+
+    Le cache est tenu à jour par les écritures de notes ; les couples qui n'y
+    figurent pas encore (notes antérieures au cache) sont calculés en une
+    requête groupée, sans rien écrire : une lecture ne modifie pas la base.
+    """
+    cached = CourseAverage.query
+    if student_id is not None:
+        cached = cached.filter(CourseAverage.student_id == student_id)
+    if course_id is not None:
+        cached = cached.filter(CourseAverage.course_id == course_id)
+    averages = {(row.student_id, row.course_id): (row.average, row.grade_count) for row in cached}
+
+    missing = _average_select(
+        *_average_pairs_filter(student_id, course_id),
+        ~db.exists().where(CourseAverage.student_id == Grade.student_id, CourseAverage.course_id == Grade.course_id),
+    )
+    for sid, cid, average, count in db.session.execute(missing):
+        averages[(sid, cid)] = (average, count)
+    return averages
+
+def refresh_course_averages(pairs, connection=None):
+    """Recalcule en base les moyennes des couples (étudiant, cours) donnés, dans la transaction courante.
+
+    Les lignes sont supprimées puis réinsérées par INSERT ... SELECT ; un
+    couple qui n'a plus de note disparaît du cache.
+    """
+    connection = connection or db.session.connection()
+    table = CourseAverage.__table__
+    pairs = set(pairs)
+    by_course = {}
+    for student_id, course_id in pairs:
+        by_course.setdefault(course_id, []).append(student_id)
+    now = datetime.now(timezone.utc)
+    for course_id, student_ids in by_course.items():
+        connection.execute(table.delete().where(table.c.course_id == course_id, table.c.student_id.in_(student_ids)))
+        averages = _average_select(Grade.course_id == course_id, Grade.student_id.in_(student_ids)).add_columns(
+            db.literal(now, db.DateTime))
+        connection.execute(table.insert().from_select(
+            ['student_id', 'course_id', 'average', 'grade_count', 'computed_at'], averages))
+    return len(pairs)
+
+@event.listens_for(db.session, 'before_flush')
+def _collect_grade_averages(session, flush_context, instances):
+    pairs = session.info.setdefault('grade_average_pairs', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Grade):
+            pairs.add((obj.student_id, obj.course_id))
+            state = db.inspect(obj)
+            for old_student in state.attrs.student_id.history.deleted or [obj.student_id]:
+                for old_course in state.attrs.course_id.history.deleted or [obj.course_id]:
+                    pairs.add((old_student, old_course))
+
+@event.listens_for(db.session, 'after_flush')
+def _refresh_grade_averages(session, flush_context):
+    # Après le flush, les notes modifiées sont visibles dans la transaction
+    pairs = {(sid, cid) for sid, cid in session.info.pop('grade_average_pairs', ())
+             if sid is not None and cid is not None}
+    if pairs:
+        refresh_course_averages(pairs, session.connection())
+
+GRADE_SHEET_COLUMNS = {
+    'matricule': 'matricule',
+    'exam_id': 'exam_id', 'examen': 'exam_id', 'exam': 'exam_id',
+    'note': 'value', 'value': 'value', 'score': 'value',
+    'commentaire': 'comment', 'comment': 'comment',
+}
+
+class GradeSheetError(Exception):
+    """Feuille de notes illisible (format, en-têtes)."""
+
+def read_grade_sheet(upload):
+    """Lit une feuille CSV ou XLSX ; retourne {colonne: [valeurs]} et les numéros de ligne.
+
+    Les en-têtes français ou anglais sont acceptés (matricule, examen, note,
+    commentaire) ; les CSV peuvent être séparés par des virgules, des
+    points-virgules (Excel en français) ou des tabulations.
+    """
+    if upload.filename.lower().endswith('.xlsx'):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise GradeSheetError("L'import XLSX nécessite openpyxl ; exportez la feuille en CSV.")
+        try:
+            rows = list(load_workbook(upload.stream, read_only=True, data_only=True).active.iter_rows(values_only=True))
+        except Exception as exc:  # Fichier corrompu ou qui n'est pas un classeur
+            raise GradeSheetError(f'Classeur illisible : {exc}')
+    else:
+        try:
+            text = upload.stream.read().decode('utf-8-sig')
+        except UnicodeDecodeError:
+            raise GradeSheetError('Le fichier CSV doit être encodé en UTF-8.')
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        rows = list(csv.reader(io.StringIO(text), dialect))
+    if not rows:
+        raise GradeSheetError('Feuille vide.')
+
+    header = [GRADE_SHEET_COLUMNS.get(str(cell or '').strip().lower()) for cell in rows[0]]
+    missing = {'matricule', 'value'} - set(header)
+    if missing:
+        raise GradeSheetError('Colonnes manquantes : ' + ', '.join(sorted(missing)))
+    columns = {name: [] for name in set(GRADE_SHEET_COLUMNS.values())}
+    line_numbers = []
+    for number, row in enumerate(rows[1:], start=2):
+        if not any(cell not in (None, '') for cell in row):
+            continue
+        values = dict.fromkeys(columns)
+        for name, cell in zip(header, row):
+            if name:
+                values[name] = cell
+        for name, value in values.items():
+            columns[name].append(value)
+        line_numbers.append(number)
+    return columns, line_numbers
+
+def _parse_score(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).strip().replace(',', '.'))
+    except (TypeError, ValueError):
+        return float('nan')
+
+def validate_grade_sheet(columns, line_numbers, default_exam_id=None, allowed_course_ids=None):
+    """Valide toute la feuille d'un coup ; retourne (lignes à enregistrer, erreurs).
+
+    Les matricules et examens distincts sont résolus en deux requêtes, puis les
+    contrôles (étudiant ou examen inconnu, cours non autorisé, note illisible
+    ou hors de [0, max_score], doublon étudiant/examen) sont des opérations
+    sur des tableaux NumPy. La moindre erreur rejette la feuille entière.
+    """
+    import numpy as np
+
+    lines = np.array(line_numbers, dtype=np.int64)
+    matricules = np.array([str(m).strip() if m is not None else '' for m in columns['matricule']], dtype=object)
+    exam_cells = columns['exam_id'] if any(e not in (None, '') for e in columns['exam_id']) else \
+        [default_exam_id] * len(lines)
+    exam_numbers = np.array([_parse_score(e) for e in exam_cells], dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        # inf, NaN, décimal ou hors des identifiants possibles : examen inconnu (0) plutôt qu'un débordement
+        valid_exam = np.isfinite(exam_numbers) & (exam_numbers >= 1) & (exam_numbers <= 2**31 - 1) & \
+            (exam_numbers == np.floor(exam_numbers))
+    exam_ids = np.where(valid_exam, exam_numbers, 0).astype(np.int64)
+    values = np.array([_parse_score(v) for v in columns['value']], dtype=np.float64)
+
+    # Matricule -> id étudiant (0 = inconnu), par valeurs distinctes
+    distinct, inverse = np.unique(matricules.astype(str), return_inverse=True)
+    found = dict(db.session.query(Student.matricule, Student.id).filter(Student.matricule.in_(distinct.tolist())))
+    student_ids = np.array([found.get(m, 0) for m in distinct], dtype=np.int64)[inverse]
+
+    # Examen -> (cours, note maximale) ; NaN = examen inconnu
+    distinct_exams, exam_inverse = np.unique(exam_ids, return_inverse=True)
+    exams = {exam.id: exam for exam in Exam.query.filter(Exam.id.in_(distinct_exams.tolist()))}
+    course_ids = np.array([exams[e].course_id if e in exams else 0 for e in distinct_exams.tolist()],
+                          dtype=np.int64)[exam_inverse]
+    max_scores = np.array([(exams[e].max_score or 20.0) if e in exams else np.nan for e in distinct_exams.tolist()],
+                          dtype=np.float64)[exam_inverse]
+
+    unknown_student = student_ids == 0
+    unknown_exam = np.isnan(max_scores)
+    forbidden = ~unknown_exam & (~np.isin(course_ids, list(allowed_course_ids)) if allowed_course_ids is not None
+                                 else np.zeros(len(lines), dtype=bool))
+    unreadable = np.isnan(values)
+    with np.errstate(invalid='ignore'):
+        out_of_range = ~unreadable & ~unknown_exam & ((values < 0) | (values > max_scores))
+    keyed = ~unknown_student & ~unknown_exam
+    keys = student_ids * (int(exam_ids.max(initial=0)) + 1) + exam_ids
+    _, key_inverse, key_counts = np.unique(keys, return_inverse=True, return_counts=True)
+    duplicate = keyed & (key_counts[key_inverse] > 1)
+
+    errors = []
+    for mask, message in (
+        (unknown_student, lambda i: f"Matricule inconnu : {matricules[i] or '(vide)'}"),
+        (unknown_exam, lambda i: f"Examen inconnu : {exam_cells[i] or '(vide)'}"),
+        (forbidden, lambda i: f"Examen {exam_ids[i]} hors de vos cours"),
+        (unreadable, lambda i: f"Note illisible : {columns['value'][i]!r}"),
+        (out_of_range, lambda i: f'Note {values[i]:g} hors de [0, {max_scores[i]:g}]'),
+        (duplicate, lambda i: f'Doublon pour {matricules[i]} / examen {exam_ids[i]}'),
+    ):
+        errors.extend({'row': int(lines[i]), 'error': message(i)} for i in np.flatnonzero(mask))
+    if errors:
+        return [], sorted(errors, key=lambda e: e['row'])
+
+    comments = columns['comment']
+    return [{
+        'student_id': int(student_ids[i]), 'exam_id': int(exam_ids[i]), 'course_id': int(course_ids[i]),
+        'value': float(values[i]), 'comment': str(comments[i]).strip() if comments[i] not in (None, '') else None,
+        'date': exams[int(exam_ids[i])].exam_date or date.today(),
+    } for i in range(len(lines))], []
+
+def import_grades(records):
+    """Enregistre les notes validées : UPDATE puis INSERT en masse, dans une seule transaction.
+
+    Les notes existantes (même étudiant, même examen) sont mises à jour ; leur
+    commentaire n'est remplacé que si la feuille en fournit un. Seules les
+    moyennes des couples (étudiant, cours) touchés sont recalculées, dans la
+    même transaction.
+    """
+    exam_ids = {r['exam_id'] for r in records}
+    existing = {(sid, eid): gid for gid, sid, eid in db.session.query(Grade.id, Grade.student_id, Grade.exam_id)
+                .filter(Grade.exam_id.in_(exam_ids))}
+    updates, inserts = [], []
+    for r in records:
+        grade_id = existing.get((r['student_id'], r['exam_id']))
+        if grade_id is not None:
+            updates.append({'gid': grade_id, 'new_value': r['value'], 'new_comment': r['comment']})
+        else:
+            inserts.append({'student_id': r['student_id'], 'course_id': r['course_id'], 'exam_id': r['exam_id'],
+                            'value': r['value'], 'comment': r['comment'], 'date': r['date'],
+                            'weight': 1.0, 'is_final': False})
+
+    table = Grade.__table__
+    try:
+        if updates:
+            db.session.execute(
+                table.update().where(table.c.id == db.bindparam('gid')).values(
+                    value=db.bindparam('new_value'),
+                    comment=db.func.coalesce(db.bindparam('new_comment'), table.c.comment),
+                ),
+                updates,
+            )
+        if inserts:
+            db.session.execute(table.insert(), inserts)
+        refresh_course_averages((r['student_id'], r['course_id']) for r in records)
+        db.session.commit()
+    except db.exc.IntegrityError:  # Import concurrent des mêmes copies
+        db.session.rollback()
+        raise
+    return {'updated': len(updates), 'inserted': len(inserts)}
+
+def current_teacher():
+    """Retourne la fiche enseignant de l'utilisateur connecté, ou None."""
+    return Teacher.query.filter_by(user_id=session.get('user_id')).first()
+
+@app.route('/teacher/grades/import', methods=['POST'])
+def teacher_grades_import():
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+    if session.get('user_type') not in ('teacher', 'admin'):
+        return jsonify(error='Accès refusé : droits insuffisants.'), 403
+
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify(error='Aucun fichier reçu.'), 400
+    allowed = None
+    if session.get('user_type') == 'teacher':
+        teacher = current_teacher()
+        allowed = {cid for (cid,) in db.session.query(Course.id).filter(Course.teacher_id == teacher.id)} \
+            if teacher else set()
+
+    try:
+        columns, line_numbers = read_grade_sheet(upload)
+    except GradeSheetError as exc:
+        return jsonify(error=str(exc)), 400
+    if not line_numbers:
+        return jsonify(error='Aucune note dans la feuille.'), 400
+    records, errors = validate_grade_sheet(columns, line_numbers, request.form.get('exam_id', type=int), allowed)
+    if errors:
+        return jsonify(error='Feuille rejetée, aucune note enregistrée.', errors=errors[:200],
+                       error_count=len(errors)), 400
+    try:
+        result = import_grades(records)
+    except db.exc.IntegrityError:
+        return jsonify(error='Notes modifiées en même temps par un autre import, veuillez réessayer.'), 409
+    return jsonify(rows=len(records), **result)
+
+@app.route('/api/grades/averages')
+def api_grade_averages():
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+
+    if session.get('user_type') == 'student':
+        student = current_student()
+        if student is None:
+            return jsonify(error='Fiche étudiant introuvable.'), 404
+        averages = course_averages(student_id=student.id)
+    elif session.get('user_type') in ('teacher', 'admin'):
+        course_id = request.args.get('course_id', type=int)
+        if course_id is None:
+            return jsonify(error='Paramètre course_id requis.'), 400
+        course = Course.query.get_or_404(course_id)
+        teacher = current_teacher() if session.get('user_type') == 'teacher' else None
+        if session.get('user_type') == 'teacher' and (teacher is None or course.teacher_id != teacher.id):
+            return jsonify(error='Accès refusé : droits insuffisants.'), 403
+        averages = course_averages(course_id=course_id)
+    else:
+        return jsonify(error='Accès refusé : droits insuffisants.'), 403
+    return jsonify(averages=[{'student_id': sid, 'course_id': cid, 'average': round(average, 2), 'grade_count': count}
+                             for (sid, cid), (average, count) in sorted(averages.items())])
+
+# Évaluations des enseignants : agrégats par enseignant, cours et semestre
+def academic_term(moment):
+    """Semestre universitaire d'une date, ex. « 2025-2026 S1 » (septembre à janvier)."""
+    start, second = app.config['ACADEMIC_YEAR_START_MONTH'], app.config['SECOND_SEMESTER_START_MONTH']
+    year = moment.year if moment.month >= start else moment.year - 1
+    semester = 'S2' if second <= moment.month < start else 'S1'
+    return f'{year}-{year + 1} {semester}'
+
+def _apply_evaluation(connection, teacher_id, course_id, term, rating, sign=1):
+    """Ajoute (sign=1) ou retire (sign=-1) une note des agrégats, par UPDATE atomique.
+
+    Une note hors de l'échelle n'a pas de case dans l'histogramme : elle est
+    refusée à l'ajout, et ignorée au retrait (ligne antérieure à la validation,
+    jamais comptée par rebuild_evaluation_stats).
+    """
+    if rating not in EVALUATION_RATINGS:
+        if sign > 0:
+            raise ValueError(f"Note d'évaluation hors de l'échelle 1 à 5 : {rating!r}")
+        return
+    table = TeacherEvaluationStats.__table__
+    values = {
+        'response_count': table.c.response_count + sign,
+        'rating_sum': table.c.rating_sum + sign * rating,
+        'rating_sq_sum': table.c.rating_sq_sum + sign * rating * rating,
+        f'rating_{rating}': table.c[f'rating_{rating}'] + sign,
+    }
+    key = (table.c.teacher_id == teacher_id, table.c.course_id == course_id, table.c.term == term)
+    if connection.execute(table.update().where(*key).values(values)).rowcount or sign < 0:
+        return
+    row = {'teacher_id': teacher_id, 'course_id': course_id, 'term': term, 'response_count': 1,
+           'rating_sum': rating, 'rating_sq_sum': rating * rating}
+    row.update({f'rating_{r}': int(r == rating) for r in EVALUATION_RATINGS})
+    try:
+        with connection.begin_nested():
+            connection.execute(table.insert().values(row))
+    except db.exc.IntegrityError:  # Ligne créée entre-temps par une autre transaction
+        connection.execute(table.update().where(*key).values(values))
+
+@event.listens_for(TeacherEvaluation, 'before_insert')
+def _set_evaluation_term(mapper, connection, target):
+    if target.term is None:
+        target.term = academic_term(target.created_at or datetime.now(timezone.utc))
+
+@event.listens_for(TeacherEvaluation, 'after_insert')
+def _evaluation_inserted(mapper, connection, target):
+    _apply_evaluation(connection, target.teacher_id, target.course_id, target.term, target.rating)
+
+@event.listens_for(TeacherEvaluation, 'after_delete')
+def _evaluation_deleted(mapper, connection, target):
+    _apply_evaluation(connection, target.teacher_id, target.course_id, target.term, target.rating, -1)
+
+@event.listens_for(TeacherEvaluation.teacher_id, 'set', active_history=True)
+@event.listens_for(TeacherEvaluation.course_id, 'set', active_history=True)
+@event.listens_for(TeacherEvaluation.term, 'set', active_history=True)
+@event.listens_for(TeacherEvaluation.rating, 'set', active_history=True)
+def _track_evaluation_key(target, value, oldvalue, initiator):
+    """Charge l'ancienne valeur avant modification, pour la retirer des agrégats."""
+
+@event.listens_for(TeacherEvaluation, 'after_update')
+def _evaluation_updated(mapper, connection, target):
+    state = db.inspect(target)
+    old = []
+    for name in ('teacher_id', 'course_id', 'term', 'rating'):
+        history = state.attrs[name].history
+        old.append(history.deleted[0] if history.deleted else getattr(target, name))
+    new = [target.teacher_id, target.course_id, target.term, target.rating]
+    if old != new:
+        _apply_evaluation(connection, *old, -1)
+        _apply_evaluation(connection, *new)
+
+def evaluation_stats(teacher_id=None, course_id=None, term=None):
+    """Agrégats d'évaluation filtrés ; moyenne, variance et histogramme sont des propriétés des lignes."""
+    query = TeacherEvaluationStats.query
+    if teacher_id is not None:
+        query = query.filter(TeacherEvaluationStats.teacher_id == teacher_id)
+    if course_id is not None:
+        query = query.filter(TeacherEvaluationStats.course_id == course_id)
+    if term:
+        query = query.filter(TeacherEvaluationStats.term == term)
+    return query.filter(TeacherEvaluationStats.response_count > 0).order_by(
+        TeacherEvaluationStats.term.desc(), TeacherEvaluationStats.teacher_id, TeacherEvaluationStats.course_id).all()
+
+def rebuild_evaluation_stats(batch_size=5000):
+    """Renseigne les semestres manquants puis recalcule tous les agrégats en une requête groupée.
+
+    Les notes hors de l'échelle (lignes antérieures à la validation) sont ignorées,
+    comme par _apply_evaluation : le nombre de réponses reste la somme de l'histogramme.
+    """
+    evaluations = TeacherEvaluation.__table__
+    connection = db.session.connection()
+    while True:
+        missing = connection.execute(
+            db.select(evaluations.c.id, evaluations.c.created_at).where(evaluations.c.term.is_(None)).limit(batch_size)
+        ).all()
+        if not missing:
+            break
+        now = datetime.now(timezone.utc)
+        connection.execute(
+            evaluations.update().where(evaluations.c.id == db.bindparam('eid')).values(term=db.bindparam('new_term')),
+            [{'eid': eid, 'new_term': academic_term(created_at or now)} for eid, created_at in missing],
+        )
+
+    rating = evaluations.c.rating
+    grouped = db.select(
+        evaluations.c.teacher_id, evaluations.c.course_id, evaluations.c.term,
+        db.func.count().label('response_count'),
+        db.func.sum(rating).label('rating_sum'),
+        db.func.sum(rating * rating).label('rating_sq_sum'),
+        *[db.func.sum(db.case((rating == r, 1), else_=0)).label(f'rating_{r}') for r in EVALUATION_RATINGS],
+    ).where(rating.between(EVALUATION_RATINGS.start, EVALUATION_RATINGS.stop - 1)).group_by(
+        evaluations.c.teacher_id, evaluations.c.course_id, evaluations.c.term)
+    stats = TeacherEvaluationStats.__table__
+    connection.execute(stats.delete())
+    connection.execute(stats.insert().from_select([column.name for column in grouped.selected_columns], grouped))
+    db.session.commit()
+    return TeacherEvaluationStats.query.count()
+
+@app.route('/api/evaluations/stats')
+def api_evaluation_stats():
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+
+    teacher_id = request.args.get('teacher_id', type=int)
+    if session.get('user_type') == 'teacher':
+        teacher = current_teacher()
+        if teacher is None or teacher_id not in (None, teacher.id):
+            return jsonify(error='Accès refusé : droits insuffisants.'), 403
+        teacher_id = teacher.id
+    elif session.get('user_type') not in ('admin', 'staff'):
+        return jsonify(error='Accès refusé : droits insuffisants.'), 403
+
+    rows = evaluation_stats(teacher_id, request.args.get('course_id', type=int), request.args.get('term'))
+    return jsonify(stats=[{
+        'teacher_id': row.teacher_id, 'course_id': row.course_id, 'term': row.term,
+        'responses': row.response_count,
+        'mean': round(row.mean, 2) if row.mean is not None else None,
+        'variance': round(row.variance, 3) if row.variance is not None else None,
+        'histogram': row.histogram,
+    } for row in rows])
+
+@app.cli.command('evaluation-stats')
+def evaluation_stats_command():
+    """Recalcule les agrégats d'évaluation des enseignants à partir de toutes les évaluations."""
+    started = time.perf_counter()
+    count = rebuild_evaluation_stats()
+    print(f"{count} agrégats recalculés en {time.perf_counter() - started:.2f} s")
+
+# Relevés de notes : génération pour toute une promotion
+def transcript_mention(average):
+    if average is None:
+        return '-'
+    for threshold, mention in ((16, 'Très bien'), (14, 'Bien'), (12, 'Assez bien'), (10, 'Passable')):
+        if average >= threshold:
+            return mention
+    return 'Ajourné'
+
+def load_transcript_data(start=None, end=None, level=None):
+    """Charge les notes d'une promotion en trois requêtes et les regroupe par étudiant."""
+    courses = {course.id: course for course in Course.query.filter(Course.level == level)} if level else \
+        {course.id: course for course in Course.query}
+    exams = {exam_id: (max_score or 20.0, weight if weight is not None else 1.0)
+             for exam_id, max_score, weight in db.session.query(Exam.id, Exam.max_score, Exam.weight)}
+    grades = db.session.query(Grade.student_id, Grade.course_id, Grade.value, Grade.weight, Grade.exam_id).filter(
+        Grade.course_id.in_(courses.keys()))
+    if start:
+        grades = grades.filter(Grade.date >= start)
+    if end:
+        grades = grades.filter(Grade.date < end)
+
+    # (étudiant, cours) -> [somme pondérée sur 20, somme des poids, nombre de notes]
+    totals = {}
+    for student_id, course_id, value, weight, exam_id in grades.order_by(Grade.student_id).yield_per(10000):
+        max_score, exam_weight = exams.get(exam_id, (20.0, 1.0))
+        w = (weight if weight is not None else 1.0) * exam_weight
+        entry = totals.setdefault((student_id, course_id), [0.0, 0.0, 0])
+        entry[0] += value / max_score * 20 * w
+        entry[1] += w
+        entry[2] += 1
+
+    by_student = {}
+    for (student_id, course_id), (weighted, weights, count) in totals.items():
+        course = courses[course_id]
+        by_student.setdefault(student_id, []).append({
+            'code': course.code, 'name': course.name, 'credits': course.credits,
+            'average': weighted / weights if weights else 0.0, 'grade_count': count,
+        })
+    students = {student.id: student for student in Student.query.filter(Student.id.in_(by_student.keys()))}
+    return [(students[sid], sorted(course_list, key=lambda c: c['code'])) for sid, course_list in by_student.items()
+            if sid in students]
+
+def _transcript_payload(student, courses, term):
+    credited = [c for c in courses if c['credits']]
+    if credited:
+        average = sum(c['average'] * c['credits'] for c in credited) / sum(c['credits'] for c in credited)
+    else:
+        average = sum(c['average'] for c in courses) / len(courses) if courses else None
+    return {
+        'student': {'id': student.id, 'matricule': student.matricule, 'last_name': student.last_name,
+                    'first_name': student.first_name, 'date_of_birth': student.date_of_birth},
+        'courses': courses,
+        'term': term,
+        'average': average,
+        'mention': transcript_mention(average),
+        'credits_earned': sum(c['credits'] or 0 for c in courses if c['average'] >= 10),
+    }
+
+def transcript_filename(student):
+    """Nom du fichier d'un relevé : le matricule, nettoyé (suivi de l'id s'il a fallu le modifier)."""
+    name = secure_filename(student['matricule'])
+    if name != student['matricule']:
+        name = f"{name or 'etudiant'}-{student['id']}"  # Deux matricules ne doivent pas donner le même fichier
+    return f'{name}.html'
+
+def _render_transcript_chunk(payloads, output_dir):
+    """Exécuté dans un processus du pool : écrit les relevés d'un lot, retourne les étudiants traités."""
+    template = app.jinja_env.get_template('transcript.html')
+    generated_at = datetime.now()
+    done = []
+    for payload in payloads:
+        path = os.path.join(output_dir, transcript_filename(payload['student']))
+        with open(path + '.tmp', 'w', encoding='utf-8') as out:
+            out.write(template.render(generated_at=generated_at, **payload))
+        os.replace(path + '.tmp', path)
+        done.append(payload['student']['id'])
+    return done
+
+def generate_transcripts(term, output_dir, start=None, end=None, level=None, workers=None, chunk_size=200):
+    """Génère les relevés d'une promotion dans un pool de processus, avec reprise sur incident.
+
+    Les étudiants terminés sont ajoutés à checkpoint.txt après chaque lot ; une
+    nouvelle exécution ignore ceux qui y figurent déjà.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = os.path.join(output_dir, 'checkpoint.txt')
+    done = set()
+    if os.path.exists(checkpoint):
+        with open(checkpoint, encoding='utf-8') as lines:
+            done = {int(line) for line in lines if line.strip()}
+
+    payloads = [_transcript_payload(student, courses, term)
+                for student, courses in load_transcript_data(start, end, level) if student.id not in done]
+    chunks = [payloads[i:i + chunk_size] for i in range(0, len(payloads), chunk_size)]
+    db.session.remove()  # Pas de connexion partagée avec les processus fils
+    tenant_engine().dispose()
+
+    generated = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool, open(checkpoint, 'a', encoding='utf-8') as log:
+        for future in as_completed([pool.submit(_render_transcript_chunk, chunk, output_dir) for chunk in chunks]):
+            student_ids = future.result()
+            log.write(''.join(f'{sid}\n' for sid in student_ids))
+            log.flush()
+            generated += len(student_ids)
+    return {'generated': generated, 'skipped': len(done)}
+
+@app.cli.command('transcripts')
+@click.option('--term', required=True, help='Libellé de la période, ex. 2025-2026 S1')
+@click.option('--start', type=click.DateTime(formats=['%Y-%m-%d']), default=None)
+@click.option('--end', type=click.DateTime(formats=['%Y-%m-%d']), default=None)
+@click.option('--level', default=None)
+@click.option('--output', default=None, help='Dossier de sortie (instance/transcripts/<période> par défaut)')
+@click.option('--workers', default=None, type=int)
+def transcripts_command(term, start, end, level, output, workers):
+    """Génère les relevés de notes de fin de période pour toute une promotion."""
+    output = output or os.path.join(app.instance_path, 'transcripts', secure_filename(term.replace('/', '-')))
+    started = time.perf_counter()
+    result = generate_transcripts(term, output, start.date() if start else None, end.date() if end else None,
+                                  level, workers)
+    elapsed = time.perf_counter() - started
+    print(f"{result['generated']} relevés générés en {elapsed:.2f} s "
+          f"({result['generated'] / max(elapsed, 1e-9):.0f}/s), {result['skipped']} déjà faits, dans {output}")
+
+# Journaux d'utilisateur : user_logs ne garde que le mois en cours ; les mois
+# précédents sont déplacés dans des tables user_logs_AAAAMM, puis archivés en
+# fichiers CSV compressés au-delà de la durée de conservation.
+USER_LOG_BATCH_SIZE = 5000
+_log_partition_metadata = db.MetaData()
+
+def _month_start(day):
+    """Premier jour du mois, en UTC comme les horodatages des journaux (naïf, comme en base)."""
+    if getattr(day, 'tzinfo', None) is not None:
+        day = day.astimezone(timezone.utc)
+    return datetime(day.year, day.month, 1)
+
+def _add_months(day, months):
+    index = day.year * 12 + day.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def log_partition_table(month):
+    """Table mensuelle des journaux (mêmes colonnes que user_logs)."""
+    name = f'user_logs_{month}'
+    table = _log_partition_metadata.tables.get(name)
+    if table is None:
+        table = db.Table(
+            name, _log_partition_metadata,
+            db.Column('LogID', db.Integer, primary_key=True, autoincrement=False),
+            db.Column('matricule', db.Integer, nullable=False),
+            db.Column('Action', db.String(255), nullable=False),
+            db.Column('Timestamp', db.DateTime),
+            db.Index(f'ix_{name}_timestamp', 'Timestamp', 'LogID'),
+            db.Index(f'ix_{name}_user', 'matricule', 'Timestamp', 'LogID'),
+            db.Index(f'ix_{name}_action', 'Action', 'Timestamp', 'LogID'),
+        )
+    return table
+
+def rotate_user_logs(now=None):
+    """Déplace les journaux des mois révolus de user_logs vers leurs tables mensuelles, par lots."""
+    cutoff = _month_start(now or datetime.now(timezone.utc))
+    hot = UserLog.__table__
+    moved = 0
+    oldest = db.session.query(db.func.min(UserLog.timestamp)).filter(UserLog.timestamp < cutoff).scalar()
+    month = _month_start(oldest) if oldest else cutoff
+    while month < cutoff:
+        next_month = _add_months(month, 1)
+        key = month.strftime('%Y%m')
+        table = log_partition_table(key)
+        table.create(bind=db.session.connection(), checkfirst=True)
+        partition = db.session.get(LogPartition, key) or LogPartition(month=key, table_name=table.name, row_count=0)
+        db.session.add(partition)
+        in_month = db.and_(hot.c.Timestamp >= month, hot.c.Timestamp < next_month)
+        while True:
+            batch = db.select(hot.c.LogID).where(in_month).order_by(hot.c.LogID).limit(USER_LOG_BATCH_SIZE).subquery()
+            last_id = db.session.execute(db.select(db.func.max(batch.c.LogID))).scalar()
+            if last_id is None:
+                break
+            chunk = db.and_(in_month, hot.c.LogID <= last_id)
+            db.session.execute(table.insert().from_select(
+                ['LogID', 'matricule', 'Action', 'Timestamp'],
+                db.select(hot.c.LogID, hot.c.matricule, hot.c.Action, hot.c.Timestamp).where(chunk)))
+            count = db.session.execute(hot.delete().where(chunk)).rowcount
+            partition.row_count += count
+            moved += count
+            db.session.commit()  # Transactions courtes : un lot à la fois
+        db.session.commit()
+        month = next_month
+    return moved
+
+def archive_user_logs(now=None):
+    """Archive en CSV compressé puis supprime les tables mensuelles hors durée de conservation."""
+    limit = _add_months(_month_start(now or datetime.now(timezone.utc)), -app.config['USER_LOG_RETENTION_MONTHS']).strftime('%Y%m')
+    archive_dir = campus_path(app.config['USER_LOG_ARCHIVE_DIR'])  # Mêmes noms de tables dans chaque campus
+    os.makedirs(archive_dir, exist_ok=True)
+    archived = []
+    for partition in LogPartition.query.filter(LogPartition.status == 'online', LogPartition.month < limit).all():
+        table = log_partition_table(partition.month)
+        path = os.path.join(archive_dir, f'{table.name}.csv.gz')
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8', newline='') as out:
+            writer = csv.writer(out)
+            writer.writerow(['LogID', 'matricule', 'Action', 'Timestamp'])
+            rows = db.session.execute(db.select(table).order_by(table.c.LogID).execution_options(yield_per=USER_LOG_BATCH_SIZE))
+            for row in rows:
+                writer.writerow([row.LogID, row.matricule, row.Action, row.Timestamp.isoformat() if row.Timestamp else ''])
+        os.replace(path + '.tmp', path)
+        table.drop(bind=db.session.connection(), checkfirst=True)
+        partition.status, partition.archive_path, partition.archived_at = 'archived', path, datetime.now(timezone.utc)
+        db.session.commit()
+        archived.append(partition.month)
+    return archived
+
+def online_log_tables(start=None, end=None):
+    """Tables de journaux couvrant [start, end), de la plus récente à la plus ancienne."""
+    tables = []
+    current = _month_start(datetime.now(timezone.utc))
+    if end is None or end > current:
+        tables.append(UserLog.__table__)
+    query = LogPartition.query.filter(LogPartition.status == 'online')
+    if start is not None:
+        query = query.filter(LogPartition.month >= start.strftime('%Y%m'))
+    if end is not None:
+        query = query.filter(LogPartition.month <= end.strftime('%Y%m'))
+    tables.extend(log_partition_table(p.month) for p in query.order_by(LogPartition.month.desc()))
+    return tables
+
+def user_log_count():
+    """Nombre total de journaux en base : table courante plus compteurs des tables mensuelles."""
+    archived = db.session.query(db.func.coalesce(db.func.sum(LogPartition.row_count), 0)).filter(
+        LogPartition.status == 'online').scalar()
+    return UserLog.query.count() + archived
+
+def read_archived_logs(path, user_id=None, action=None, start=None, end=None):
+    """Parcourt une archive de journaux (hors base), avec filtres facultatifs."""
+    with gzip.open(path, 'rt', encoding='utf-8', newline='') as lines:
+        for row in csv.DictReader(lines):
+            if user_id is not None and int(row['matricule']) != user_id:
+                continue
+            if action and action.lower() not in row['Action'].lower():
+                continue
+            timestamp = datetime.fromisoformat(row['Timestamp']) if row['Timestamp'] else None
+            if (start and (timestamp is None or timestamp < start)) or (end and (timestamp is None or timestamp >= end)):
+                continue
+            yield row
+
+LogEntry = namedtuple('LogEntry', 'id user_id action timestamp')
+
+def audit_log_page(user_id=None, action=None, start=None, end=None, cursor=None, per_page=50):
+    """Une page du journal, du plus récent au plus ancien ; retourne (entrées, curseur suivant).
+
+    Pagination par clé sur (Timestamp, LogID) : chaque table mensuelle concernée
+    est lue via l'index correspondant au filtre, en commençant après la dernière
+    entrée affichée, sans OFFSET. Les tables sont disjointes par mois et lues de
+    la plus récente à la plus ancienne. Les entrées sans horodatage (colonne
+    nullable, anciennes lignes) ne peuvent pas servir de curseur : elles sont
+    exclues de la pagination.
+    """
+    per_page = max(1, per_page)
+    after = _decode_cursor(cursor, datetime.fromisoformat, _cursor_int) if cursor else None
+    upper = after[0] + timedelta(seconds=1) if after else end
+    entries = []
+    for table in online_log_tables(start, upper):
+        query = db.select(table.c.LogID, table.c.matricule, table.c.Action, table.c.Timestamp).where(
+            table.c.Timestamp.isnot(None))
+        if user_id is not None:
+            query = query.where(table.c.matricule == user_id)
+        if action:
+            query = query.where(table.c.Action == action)
+        if start:
+            query = query.where(table.c.Timestamp >= start)
+        if end:
+            query = query.where(table.c.Timestamp < end)
+        if after:
+            query = query.where(db.or_(
+                table.c.Timestamp < after[0],
+                db.and_(table.c.Timestamp == after[0], table.c.LogID < after[1]),
+            ))
+        query = query.order_by(table.c.Timestamp.desc(), table.c.LogID.desc()).limit(per_page + 1 - len(entries))
+        entries.extend(LogEntry(*row) for row in db.session.execute(query))
+        if len(entries) > per_page:
+            break
+
+    next_cursor = None
+    if len(entries) > per_page:
+        entries = entries[:per_page]
+        next_cursor = _encode_cursor([entries[-1].timestamp.isoformat(), entries[-1].id])
+    return entries, next_cursor
+
+def _audit_log_filters(args):
+    """Lit les filtres de la requête : (filtres bruts, paramètres de audit_log_page) ou une erreur."""
+    raw = {key: args.get(key, '').strip() for key in ('user', 'action', 'start', 'end')}
+    params = {'action': raw['action'] or None}
+    if raw['user']:
+        if raw['user'].isdigit():
+            params['user_id'] = int(raw['user'])
+        else:
+            user = User.query.filter_by(username=raw['user']).first()
+            params['user_id'] = user.id if user else -1
+    for key in ('start', 'end'):
+        params[key] = _parse_window_bound(raw[key]) if raw[key] else None
+        if raw[key] and params[key] is None:
+            return raw, None, 'Date invalide (format AAAA-MM-JJ).'
+    return {key: value for key, value in raw.items() if value}, params, None
+
+@app.route('/admin/logs')
+def admin_logs():
+    if 'user_id' not in session:
+        flash('Veuillez vous connecter pour accéder à cette page.', 'warning')
+        return redirect(url_for('login'))
+    if session.get('user_type') != 'admin':
+        flash('Accès refusé : droits insuffisants.', 'danger')
+        return redirect(url_for('dashboard'))
+
+    user = User.query.get(session['user_id'])  # Fetch the logged-in user
+    filters, params, error = _audit_log_filters(request.args)
+    logs, next_cursor = [], None
+    if not error:
+        try:
+            logs, next_cursor = audit_log_page(cursor=request.args.get('after'), **params)
+        except ValueError as exc:  # Curseur mal formé
+            error = str(exc)
+    if error:
+        flash(error, 'danger')
+    usernames = dict(db.session.query(User.id, User.username).filter(User.id.in_({log.user_id for log in logs})))
+    return render_template('admin/logs.html', logs=logs, next_cursor=next_cursor, filters=filters,
+                           usernames=usernames, user=user), 400 if error else 200
+
+@app.route('/api/admin/logs')
+def api_admin_logs():
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+    if session.get('user_type') != 'admin':
+        return jsonify(error='Accès refusé : droits insuffisants.'), 403
+
+    _, params, error = _audit_log_filters(request.args)
+    if error:
+        return jsonify(error=error), 400
+    per_page = max(1, min(request.args.get('per_page', 50, type=int), 500))
+    try:
+        logs, next_cursor = audit_log_page(cursor=request.args.get('after'), per_page=per_page, **params)
+    except ValueError as exc:
+        return jsonify(error=str(exc)), 400
+    return jsonify(logs=[{
+        'id': log.id,
+        'user_id': log.user_id,
+        'action': log.action,
+        'timestamp': log.timestamp.isoformat(),
+    } for log in logs], next=next_cursor)
+
+@app.cli.command('logs-rotate')
+def logs_rotate_command():
+    """Tâche mensuelle : déplace les journaux des mois révolus et archive les plus anciens."""
+    moved = rotate_user_logs()
+    archived = archive_user_logs()
+    print(f"{moved} journaux déplacés, mois archivés : {', '.join(archived) or 'aucun'}")
+
+@app.cli.command('logs-archive-query')
+@click.argument('month')
+@click.option('--user-id', type=int, default=None)
+@click.option('--action', default=None)
+def logs_archive_query_command(month, user_id, action):
+    """Affiche les journaux archivés d'un mois (AAAAMM) sans les recharger en base."""
+    path = os.path.join(campus_path(app.config['USER_LOG_ARCHIVE_DIR']), f'user_logs_{month}.csv.gz')
+    if not os.path.exists(path):
+        print(f"Aucune archive pour {month}.")
+        return
+    for row in read_archived_logs(path, user_id, action):
+        print(f"{row['Timestamp']}\t{row['matricule']}\t{row['Action']}")
+
+# Statistiques : instantané en colonnes pour les rapports institutionnels
+# Colonnes exportées par table (pas de nom, d'adresse ni de contact : uniquement ce qui sert aux rapports)
+ANALYTICS_SNAPSHOT_TABLES = (
+    (Student, ('id', 'gender', 'nationality', 'is_scholarship', 'date_of_birth', 'registration_date')),
+    (Course, ('id', 'code', 'level', 'credits', 'teacher_id')),
+    (Enrollment, ('id', 'student_id', 'course_id', 'enrolled_at', 'source')),
+    (Grade, ('id', 'student_id', 'course_id', 'exam_id', 'value', 'date')),
+    (Alumni, ('id', 'student_id', 'graduation_date', 'industry', 'company', 'is_active')),
+    (Internship, ('id', 'student_id', 'company', 'status', 'start_date', 'end_date', 'evaluation_grade', 'teacher_id')),
+)
+
+def _snapshot_kind(column):
+    """Type de stockage d'une colonne : int, float, bool, date, datetime ou category (texte codé)."""
+    if isinstance(column.type, db.Boolean):
+        return 'bool'
+    if isinstance(column.type, db.DateTime):
+        return 'datetime'
+    if isinstance(column.type, db.Date):
+        return 'date'
+    if isinstance(column.type, db.Integer):
+        return 'float' if column.nullable and not column.primary_key else 'int'  # NULL -> NaN
+    if isinstance(column.type, (db.Float, db.Numeric)):
+        return 'float'
+    return 'category'
+
+class _SnapshotColumnWriter:
+    """Remplit un fichier .npy préalloué par tranches ; le texte est codé par dictionnaire (-1 = NULL)."""
+
+    def __init__(self, directory, name, kind, count):
+        import numpy as np
+
+        self.np, self.kind, self.filled = np, kind, 0
+        self.path = os.path.join(directory, f'{name}.npy')
+        dtype = {'int': np.int64, 'float': np.float64, 'bool': np.int8, 'date': 'datetime64[D]',
+                 'datetime': 'datetime64[s]', 'category': np.int32}[kind]
+        self.array = np.lib.format.open_memmap(self.path, mode='w+', dtype=dtype, shape=(count,))
+        self.labels = {} if kind == 'category' else None
+
+    def _convert(self, value):
+        if value is None:
+            return {'float': float('nan'), 'bool': -1, 'date': 'NaT', 'datetime': 'NaT', 'category': -1}.get(self.kind, 0)
+        if self.kind == 'category':
+            return self.labels.setdefault(str(value), len(self.labels))
+        if self.kind == 'datetime' and value.tzinfo is not None:
+            return value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    def append(self, values):
+        chunk = [self._convert(value) for value in values]
+        self.array[self.filled:self.filled + len(chunk)] = chunk
+        self.filled += len(chunk)
+
+    def close(self):
+        array = self.array
+        self.array = None
+        if self.filled < len(array):  # Lignes supprimées pendant l'export
+            trimmed = self.np.array(array[:self.filled])
+            del array
+            self.np.save(self.path, trimmed)
+        else:
+            array.flush()
+            del array
+        if self.labels is not None:
+            with open(self.path[:-4] + '.labels.json', 'w', encoding='utf-8') as out:
+                json.dump(list(self.labels), out, ensure_ascii=False)
+        return self.filled
+
+def export_analytics_snapshot(root=None, chunk_size=20000):
+    """Écrit un instantané daté de ANALYTICS_SNAPSHOT_TABLES : un fichier .npy par colonne.
+
+    Chaque table est lue par tranches (yield_per) jusqu'à l'id maximal relevé au
+    départ et écrite directement dans des fichiers préalloués, sans tout garder
+    en mémoire. L'instantané est écrit dans un dossier temporaire puis renommé :
+    un lecteur ne voit jamais d'instantané partiel, et un export interrompu
+    supprime son dossier temporaire. Le nom, à la microseconde, reste trié
+    chronologiquement. Seuls les ANALYTICS_SNAPSHOT_KEEP plus récents sont conservés.
+    """
+    root = root or campus_path(app.config['ANALYTICS_SNAPSHOT_DIR'])
+    name = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    target = os.path.join(root, name)
+    os.makedirs(root, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=root, prefix=f'.{name}.', suffix='.tmp')
+    try:
+        manifest = _write_analytics_snapshot(tmp, chunk_size)
+        os.replace(tmp, target)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    for old in analytics_snapshots(root)[:-app.config['ANALYTICS_SNAPSHOT_KEEP']]:
+        shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+    return target, manifest
+
+def _write_analytics_snapshot(directory, chunk_size):
+    """Écrit les colonnes et le manifeste d'un instantané dans `directory` ; retourne le manifeste."""
+    manifest = {'created_at': datetime.now(timezone.utc).isoformat(), 'tables': {}}
+    for model, column_names in ANALYTICS_SNAPSHOT_TABLES:
+        table = model.__table__
+        columns = [table.c[column] for column in column_names]
+        upper = db.session.scalar(db.select(db.func.max(table.c.id))) or 0
+        count = db.session.scalar(db.select(db.func.count()).select_from(table).where(table.c.id <= upper))
+        table_directory = os.path.join(directory, table.name)
+        os.makedirs(table_directory)
+        writers = [_SnapshotColumnWriter(table_directory, column.name, _snapshot_kind(column), count) for column in columns]
+        result = db.session.execute(
+            db.select(*columns).where(table.c.id <= upper).order_by(table.c.id).execution_options(yield_per=chunk_size))
+        for partition in result.partitions():
+            for writer, values in zip(writers, zip(*partition)):
+                writer.append(values)
+        rows = [writer.close() for writer in writers][0] if writers else 0
+        manifest['tables'][table.name] = {
+            'rows': rows, 'columns': {column.name: writer.kind for column, writer in zip(columns, writers)}}
+    db.session.rollback()  # Fin de la transaction de lecture
+    with open(os.path.join(directory, 'manifest.json'), 'w', encoding='utf-8') as out:
+        json.dump(manifest, out, indent=2)
+    return manifest
+
+def analytics_snapshots(root=None):
+    """Noms des instantanés complets, du plus ancien au plus récent."""
+    root = root or campus_path(app.config['ANALYTICS_SNAPSHOT_DIR'])
+    if not os.path.isdir(root):
+        return []
+    return sorted(name for name in os.listdir(root)
+                  if not name.startswith('.') and os.path.exists(os.path.join(root, name, 'manifest.json')))
+
+class AnalyticsSnapshot:
+    """Couche de requête sur un instantané : colonnes ouvertes en mmap, regroupements NumPy.
+
+    Les colonnes sont chargées à la demande avec np.load(mmap_mode='r') : seules
+    les pages lues quittent le disque, et plusieurs analystes partagent le cache
+    du système. Un critère de regroupement est un nom de colonne de la table ou
+    un facteur (codes, libellés), par exemple renvoyé par joined_factor().
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            snapshots = analytics_snapshots()
+            if not snapshots:
+                raise FileNotFoundError("Aucun instantané : lancez « flask analytics-snapshot ».")
+            path = os.path.join(campus_path(app.config['ANALYTICS_SNAPSHOT_DIR']), snapshots[-1])
+        self.path = path
+        with open(os.path.join(path, 'manifest.json'), encoding='utf-8') as source:
+            self.manifest = json.load(source)
+        self._columns = {}
+
+    def column(self, table, name):
+        key = (table, name)
+        if key not in self._columns:
+            import numpy as np
+            self._columns[key] = np.load(os.path.join(self.path, table, f'{name}.npy'), mmap_mode='r')
+        return self._columns[key]
+
+    def labels(self, table, name):
+        with open(os.path.join(self.path, table, f'{name}.labels.json'), encoding='utf-8') as source:
+            return json.load(source)
+
+    def factor(self, table, name):
+        """Codes entiers 0..k-1 et libellés d'une colonne (NULL compris, libellé None)."""
+        import numpy as np
+
+        kind = self.manifest['tables'][table]['columns'][name]
+        values = self.column(table, name)
+        if kind == 'category':
+            return np.asarray(values) + 1, [None] + self.labels(table, name)
+        if kind == 'bool':
+            return np.asarray(values) + 1, [None, False, True]
+        distinct, codes = np.unique(values, return_inverse=True)
+        return codes, [None if value != value else value.item() for value in distinct]  # NaN/NaT -> None
+
+    def joined_factor(self, table, key, target_table, name):
+        """Facteur d'une colonne d'une autre table, aligné sur `table` via la clé étrangère `key`.
+
+        Les id de la table cible sont triés (export par id croissant) : la
+        jointure est une recherche dichotomique vectorisée.
+        """
+        import numpy as np
+
+        ids = self.column(target_table, 'id')
+        foreign = np.asarray(self.column(table, key))
+        foreign = np.where(np.isnan(foreign), -1, foreign).astype(np.int64) if foreign.dtype.kind == 'f' else foreign
+        positions = np.clip(np.searchsorted(ids, foreign), 0, max(len(ids) - 1, 0))
+        found = (ids[positions] == foreign) if len(ids) else np.zeros(len(foreign), dtype=bool)
+        codes, labels = self.factor(target_table, name)
+        return np.where(found, codes[positions] + 1 if len(ids) else 0, 0), [None] + labels
+
+    def _group_keys(self, table, by, mask):
+        import numpy as np
+
+        factors = [self.factor(table, item) if isinstance(item, str) else item
+                   for item in ([by] if isinstance(by, str) else by)]
+        key = np.zeros(len(factors[0][0]), dtype=np.int64)
+        for codes, labels in factors:
+            key = key * len(labels) + codes
+        if mask is not None:
+            key = key[mask]
+        return key, [labels for _, labels in factors]
+
+    @staticmethod
+    def _decode(index, label_lists):
+        parts = []
+        for labels in reversed(label_lists):
+            index, code = divmod(index, len(labels))
+            parts.append(labels[code])
+        parts.reverse()
+        return parts[0] if len(parts) == 1 else tuple(parts)
+
+    def group_count(self, table, by, mask=None):
+        """Effectifs par valeur (ou combinaison de valeurs) des critères `by`."""
+        import numpy as np
+
+        key, label_lists = self._group_keys(table, by, mask)
+        counts = np.bincount(key)
+        groups = {}
+        for i in np.flatnonzero(counts):
+            group = self._decode(int(i), label_lists)
+            groups[group] = groups.get(group, 0) + int(counts[i])  # NULL et jointure manquante : même groupe None
+        return groups
+
+    def group_mean(self, table, by, value, mask=None):
+        """Moyenne de la colonne `value` par groupe (valeurs manquantes ignorées) ; retourne {groupe: (moyenne, n)}."""
+        import numpy as np
+
+        key, label_lists = self._group_keys(table, by, mask)
+        values = np.asarray(self.column(table, value), dtype=np.float64)
+        if mask is not None:
+            values = values[mask]
+        valid = ~np.isnan(values)
+        counts = np.bincount(key[valid])
+        sums = np.bincount(key[valid], weights=values[valid], minlength=len(counts))
+        totals = {}
+        for i in np.flatnonzero(counts):
+            total = totals.setdefault(self._decode(int(i), label_lists), [0.0, 0])
+            total[0] += sums[i]
+            total[1] += int(counts[i])
+        return {group: (float(total / n), n) for group, (total, n) in totals.items()}
+
+@app.cli.command('analytics-snapshot')
+@click.option('--output', default=None, help='Dossier des instantanés (ANALYTICS_SNAPSHOT_DIR par défaut)')
+def analytics_snapshot_command(output):
+    """Exporte l'instantané statistique (à lancer chaque nuit, par cron)."""
+    started = time.perf_counter()
+    path, manifest = export_analytics_snapshot(output)
+    rows = sum(table['rows'] for table in manifest['tables'].values())
+    print(f"Instantané {path} : {rows} lignes en {time.perf_counter() - started:.2f} s")
+
+@app.cli.command('analytics-report')
+@click.argument('table')
+@click.argument('by', nargs=-1, required=True)
+@click.option('--mean', 'mean_column', default=None, help='Colonne dont afficher la moyenne par groupe')
+def analytics_report_command(table, by, mean_column):
+    """Regroupe une table du dernier instantané, ex. : flask analytics-report student nationality gender."""
+    snapshot = AnalyticsSnapshot()
+    started = time.perf_counter()
+    if mean_column:
+        groups = snapshot.group_mean(table, list(by), mean_column)
+        lines = [f"{group}\t{mean:.2f}\t(n={n})" for group, (mean, n) in sorted(groups.items(), key=lambda g: -g[1][1])]
+    else:
+        groups = snapshot.group_count(table, list(by))
+        lines = [f"{group}\t{count}" for group, count in sorted(groups.items(), key=lambda g: -g[1])]
+    elapsed = time.perf_counter() - started
+    print('\n'.join(lines))
+    print(f"{len(groups)} groupes en {elapsed * 1000:.1f} ms (instantané {os.path.basename(snapshot.path)})")
+
+# Paiements : numérotation des factures sans « max + 1 »
+def reserve_invoice_numbers(prefix, count, connection):
+    """Réserve `count` numéros consécutifs pour un préfixe ; retourne le premier."""
+    table = InvoiceSequence.__table__
+    for _ in range(2):
+        updated = connection.execute(
+            table.update().where(table.c.prefix == prefix).values(next_value=table.c.next_value + count)
+        ).rowcount
+        if updated:
+            return connection.execute(
+                db.select(table.c.next_value).where(table.c.prefix == prefix)).scalar() - count
+        try:
+            with connection.begin_nested():
+                connection.execute(table.insert().values(prefix=prefix, next_value=count + 1))
+            return 1
+        except db.exc.IntegrityError:
+            continue  # Créé en parallèle par un autre processus : on réessaie la mise à jour
+    raise RuntimeError(f'Impossible de réserver un numéro de facture pour {prefix}')
+
+class InvoiceNumberAllocator:
+    """Distribue les numéros de facture depuis des blocs réservés en mémoire.
+
+    Chaque processus réserve un bloc de INVOICE_BLOCK_SIZE numéros par une
+    courte transaction sur invoice_sequence, puis les distribue sans accès à la
+    base. Les numéros non utilisés d'un bloc sont perdus à l'arrêt (trous
+    possibles). En politique « gapless », chaque numéro est réservé dans la
+    transaction de l'appelant : il disparaît avec elle en cas d'annulation,
+    au prix d'un verrou tenu jusqu'au commit.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocks = {}  # (campus, préfixe) -> [prochain numéro, fin du bloc]
+
+    @staticmethod
+    def prefix_for(day=None):
+        return app.config['INVOICE_PREFIX_FORMAT'].format(year=(day or date.today()).year)
+
+    @staticmethod
+    def format(prefix, number):
+        return f'{prefix}-{number:06d}'
+
+    def next_number(self, day=None):
+        prefix = self.prefix_for(day)
+        if app.config['INVOICE_GAP_POLICY'] == 'gapless':
+            return self.format(prefix, reserve_invoice_numbers(prefix, 1, db.session.connection()))
+        key = (current_campus(), prefix)  # Chaque campus a sa propre série
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None or block[0] >= block[1]:
+                size = app.config['INVOICE_BLOCK_SIZE']
+                with tenant_engine().begin() as connection:
+                    first = reserve_invoice_numbers(prefix, size, connection)
+                block = self._blocks[key] = [first, first + size]
+            number = block[0]
+            block[0] += 1
+        return self.format(prefix, number)
+
+invoice_numbers = InvoiceNumberAllocator()
+
+def next_invoice_number(day=None):
+    """Numéro de facture unique pour un nouveau paiement (ex. F2026-000042)."""
+    return invoice_numbers.next_number(day)
+
+@metrics.gauge
+def _pool_connections():
+    gauges = []
+    for key, engine in db.engines.items():
+        stats = getattr(engine.pool, 'stats', None)
+        if stats is None:
+            continue
+        pool = ('pool', key.removeprefix('campus:') if key else 'default')
+        with stats.lock:
+            in_use = stats.in_use
+        gauges += [('db_pool_connections', (pool, ('state', 'in_use')), in_use),
+                   ('db_pool_connections', (pool, ('state', 'idle')), engine.pool.checkedin())]
+    return gauges
+
+@app.route('/api/admin/pool')
+def api_admin_pool():
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+    if session.get('user_type') != 'admin':
+        return jsonify(error='Accès refusé : droits insuffisants.'), 403
+    pool = tenant_engine().pool
+    return jsonify(pool.stats.snapshot(pool))
+
+@app.cli.command('pool-stats')
+def pool_stats_command():
+    """Affiche la configuration du pool de connexions et ses compteurs dans ce processus."""
+    pool = tenant_engine().pool
+    print(json.dumps(pool.stats.snapshot(pool), indent=2))
+
+@app.cli.command('pool-bench')
+@click.option('--threads', default=50)
+@click.option('--requests', 'per_thread', default=40, help='Requêtes simulées par thread')
+@click.option('--hold-ms', default=20, help='Durée pendant laquelle chaque requête garde sa connexion')
+@click.option('--mode', type=click.Choice(['static', 'adaptive', 'both']), default='both')
+def pool_bench_command(threads, per_thread, hold_ms, mode):
+    """Simule des requêtes concurrentes et compare le pool fixe au pool adaptatif."""
+    pool = db.engine.pool
+    base = (pool._max_overflow, pool._timeout)
+    adaptive_before = app.config['DB_POOL_ADAPTIVE']
+    for adaptive in {'static': [False], 'adaptive': [True], 'both': [False, True]}[mode]:
+        db.engine.dispose()
+        pool = db.engine.pool
+        pool._max_overflow, pool._timeout = base
+        app.config['DB_POOL_ADAPTIVE'] = adaptive
+        pool.stats.reset()
+        failures, lock = [0], threading.Lock()
+        barrier = threading.Barrier(threads)
+
+        def worker():
+            with app.app_context():
+                barrier.wait()
+                for _ in range(per_thread):
+                    try:
+                        db.session.execute(db.text('SELECT 1'))
+                        time.sleep(hold_ms / 1000)  # Travail de la requête, connexion tenue
+                        db.session.commit()
+                    except PoolTimeoutError:
+                        db.session.rollback()
+                        with lock:
+                            failures[0] += 1
+
+        started = time.perf_counter()
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        elapsed = time.perf_counter() - started
+        stats = pool.stats.snapshot(pool)
+        served = threads * per_thread - failures[0]
+        print(f"{'adaptatif' if adaptive else 'fixe'} : {served} requêtes en {elapsed:.2f} s "
+              f"({served / elapsed:.0f}/s), attente moyenne {stats['wait_avg_ms']} ms, "
+              f"p95 ≤ {pool.stats.wait_quantile(0.95)} ms, p99 ≤ {pool.stats.wait_quantile(0.99)} ms, "
+              f"délais dépassés : {failures[0]}, pic {stats['peak_in_use']} connexions, "
+              f"max_overflow final {stats['max_overflow']}, délai final {stats['timeout']:.1f} s")
+    app.config['DB_POOL_ADAPTIVE'] = adaptive_before
+    db.engine.dispose()
+    db.engine.pool._max_overflow, db.engine.pool._timeout = base
+
+# Cours optionnels : affectation selon les vœux des étudiants
+def allocate_courses(course_ids, incremental=False, seed=0):
+    """Affecte chaque étudiant à au plus un cours du groupe selon ses vœux classés.
+
+    Les étudiants sont servis dans l'ordre d'un tirage au sort (graine fixe) et
+    reçoivent leur meilleur vœu encore disponible : c'est l'affectation stable
+    pour une priorité commune à tous les cours. Les vœux et les effectifs sont
+    chargés en deux requêtes et les affectations écrites en un seul INSERT.
+    En mode incrémental, les affectations existantes sont conservées et seuls
+    les étudiants sans cours dans le groupe sont traités (vœux tardifs, places
+    libérées).
+    """
+    course_ids = list(course_ids)
+    if not incremental:
+        Enrollment.query.filter(
+            Enrollment.course_id.in_(course_ids), Enrollment.source == 'allocation'
+        ).delete(synchronize_session=False)
+
+    # Places restantes par cours (None = illimité)
+    capacity = {cid: cap for cid, cap in db.session.query(Course.id, Course.max_students).filter(Course.id.in_(course_ids))}
+    enrolled = set()
+    for course_id, student_id in db.session.query(Enrollment.course_id, Enrollment.student_id).filter(
+        Enrollment.course_id.in_(course_ids)
+    ):
+        enrolled.add(student_id)
+        if capacity.get(course_id) is not None:
+            capacity[course_id] -= 1
+
+    # Vœux groupés par étudiant, déjà triés par rang
+    preferences = {}
+    for student_id, course_id, rank in db.session.query(
+        CoursePreference.student_id, CoursePreference.course_id, CoursePreference.rank
+    ).filter(CoursePreference.course_id.in_(course_ids)).order_by(CoursePreference.student_id, CoursePreference.rank):
+        if student_id not in enrolled:
+            preferences.setdefault(student_id, []).append((course_id, rank))
+
+    order = sorted(preferences)
+    random.Random(seed).shuffle(order)
+    rows, now = [], datetime.now(timezone.utc)
+    for student_id in order:
+        for course_id, rank in preferences[student_id]:
+            remaining = capacity.get(course_id)
+            if remaining is None or remaining > 0:
+                if remaining is not None:
+                    capacity[course_id] = remaining - 1
+                rows.append({'student_id': student_id, 'course_id': course_id, 'enrolled_at': now,
+                             'source': 'allocation', 'preference_rank': rank})
+                break
+
+    if rows:
+        db.session.execute(Enrollment.__table__.insert(), rows)
+    db.session.commit()
+    return {'students': len(order), 'assigned': len(rows), 'unassigned': len(order) - len(rows)}
+
+@app.cli.command('allocate-courses')
+@click.option('--level', default=None, help='Niveau des cours à affecter (tous par défaut)')
+@click.option('--incremental', is_flag=True, help='Conserver les affectations existantes')
+@click.option('--seed', default=0, help='Graine du tirage au sort')
+def allocate_courses_command(level, incremental, seed):
+    """Affecte les étudiants aux cours optionnels selon leurs vœux."""
+    query = db.session.query(Course.id)
+    if level:
+        query = query.filter(Course.level == level)
+    started = time.perf_counter()
+    result = allocate_courses([cid for (cid,) in query], incremental=incremental, seed=seed)
+    print(f"{result['assigned']} étudiants affectés, {result['unassigned']} sans place "
+          f"({time.perf_counter() - started:.2f} s)")
+
+# Migrations de données : remplissages en ligne par tranches, avec reprise
+# Les migrations de schéma restent gérées par Flask-Migrate ; une révision qui
+# dépend d'un remplissage (NOT NULL, index unique...) appelle
+# require_data_migration() pour refuser de s'appliquer tant qu'il n'est pas terminé.
+DataMigrationSpec = namedtuple('DataMigrationSpec', 'name table func description')
+DATA_MIGRATIONS = {}
+
+def data_migration(name, table):
+    """Enregistre un remplissage : func(connexion, borne_exclue, borne_incluse) -> lignes modifiées."""
+    def register(func):
+        DATA_MIGRATIONS[name] = DataMigrationSpec(name, table, func, (func.__doc__ or '').strip())
+        return func
+    return register
+
+def require_data_migration(name):
+    """À appeler depuis une révision Alembic : échoue si le remplissage n'est pas terminé."""
+    table = DataMigration.__table__
+    status = db.session.execute(db.select(table.c.status).where(table.c.name == name)).scalar()
+    if status != 'done':
+        raise RuntimeError(f"Migration de données « {name} » non terminée : lancez « flask data-migrate {name} ».")
+
+_replica_engines = {}
+
+def database_health():
+    """Retourne (retard maximal des réplicas en secondes, transactions en attente de verrou).
+
+    Le retard vaut None si un réplica ne réplique plus. Hors MySQL, les deux
+    mesures valent 0 (SQLite en développement).
+    """
+    lag = 0.0
+    for url in app.config['DATA_MIGRATION_REPLICA_URLS']:
+        engine = _replica_engines.get(url)
+        if engine is None:
+            engine = _replica_engines[url] = create_engine(url, pool_pre_ping=True, pool_size=1)
+        with engine.connect() as connection:
+            try:
+                row = connection.execute(db.text('SHOW REPLICA STATUS')).mappings().first()
+            except db.exc.DBAPIError:  # MySQL < 8.0.22
+                row = connection.execute(db.text('SHOW SLAVE STATUS')).mappings().first()
+        seconds = None
+        if row is not None:
+            seconds = row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+        if seconds is None:
+            return None, 0
+        lag = max(lag, float(seconds))
+
+    lock_waits = 0
+    if tenant_engine().dialect.name == 'mysql':
+        with tenant_engine().connect() as connection:
+            lock_waits = connection.execute(db.text(
+                "SELECT COUNT(*) FROM information_schema.innodb_trx WHERE trx_state = 'LOCK WAIT'")).scalar()
+    return lag, lock_waits
+
+def _save_migration_state(name, **values):
+    table = DataMigration.__table__
+    values['updated_at'] = datetime.now(timezone.utc)
+    with tenant_engine().begin() as connection:
+        if not connection.execute(table.update().where(table.c.name == name).values(**values)).rowcount:
+            connection.execute(table.insert().values(name=name, **values))
+
+def _wait_for_healthy_database(name, report):
+    """Bloque tant que le retard de réplication ou les attentes de verrou dépassent les seuils."""
+    paused = False
+    while True:
+        lag, lock_waits = database_health()
+        if lag is not None and lag <= app.config['DATA_MIGRATION_MAX_LAG'] \
+                and lock_waits <= app.config['DATA_MIGRATION_MAX_LOCK_WAITS']:
+            break
+        _save_migration_state(name, status='waiting')  # Toujours réservée : updated_at sert de signe de vie
+        if not paused:
+            paused = True
+            report(f"Pause : retard de réplication {'arrêtée' if lag is None else f'{lag:.0f} s'}, "
+                   f"{lock_waits} attentes de verrou")
+        time.sleep(app.config['DATA_MIGRATION_PAUSE_SECONDS'])
+    if paused:
+        _save_migration_state(name, status='running')
+        report("Reprise.")
+
+ACTIVE_MIGRATION_STATUSES = ('running', 'waiting')
+
+def _claim_data_migration(name, restart=False):
+    """Réserve une migration pour ce processus ; retourne son état, ou None si un autre processus l'exécute.
+
+    La réservation est un UPDATE conditionnel : elle échoue si la migration
+    est « running » ou « waiting » et a donné signe de vie depuis moins de
+    DATA_MIGRATION_CLAIM_TIMEOUT_SECONDS. Une migration terminée n'est pas
+    réservée (sauf restart).
+    """
+    table = DataMigration.__table__
+    now = datetime.now(timezone.utc)
+    try:
+        with tenant_engine().begin() as connection:
+            if connection.execute(db.select(table.c.name).where(table.c.name == name)).first() is None:
+                connection.execute(table.insert().values(name=name, status='pending', updated_at=now))
+    except db.exc.IntegrityError:  # Ligne créée au même moment par un autre processus
+        pass
+    with tenant_engine().begin() as connection:
+        state = connection.execute(db.select(table).where(table.c.name == name)).mappings().first()
+        if state['status'] == 'done' and not restart:
+            return dict(state)
+        values = {'status': 'running', 'updated_at': now, 'started_at': db.func.coalesce(table.c.started_at, now)}
+        if restart:
+            values.update(last_id=0, rows_done=0, started_at=now, finished_at=None)
+        stale = now - timedelta(seconds=app.config['DATA_MIGRATION_CLAIM_TIMEOUT_SECONDS'])
+        claimed = connection.execute(table.update().where(
+            table.c.name == name,
+            db.or_(table.c.status.notin_(ACTIVE_MIGRATION_STATUSES), table.c.updated_at < stale),
+        ).values(**values)).rowcount
+        if not claimed:
+            return None
+        return dict(connection.execute(db.select(table).where(table.c.name == name)).mappings().first())
+
+def run_data_migration(name, chunk_size=None, max_seconds=None, restart=False, report=print):
+    """Exécute (ou reprend) un remplissage par tranches de clé primaire.
+
+    Chaque tranche est une courte transaction qui applique la migration et
+    enregistre la dernière clé traitée : une interruption ne perd au plus
+    qu'une tranche, et la reprise repart de ce point. La taille des tranches
+    s'ajuste pour durer environ DATA_MIGRATION_CHUNK_SECONDS, suivie d'une pause
+    proportionnelle (DATA_MIGRATION_SLEEP_RATIO). Avant chaque tranche, le
+    retard des réplicas et les attentes de verrou sont contrôlés. Les lignes
+    créées après le démarrage (clé au-delà du maximum relevé) sont laissées au
+    code applicatif.
+
+    Un seul processus exécute une migration donnée (_claim_data_migration) ;
+    chaque tranche vérifie en outre que last_id n'a pas avancé entre-temps,
+    sans quoi elle est annulée et le processus s'arrête.
+    """
+    spec = DATA_MIGRATIONS[name]
+    key = list(spec.table.primary_key.columns)[0]
+    table = DataMigration.__table__
+    state = _claim_data_migration(name, restart)
+    if state is None:
+        report(f"{name} : déjà en cours dans un autre processus.")
+        return {'status': 'running'}
+    if state['status'] == 'done':
+        report(f"{name} : déjà terminée.")
+        return state
+    with tenant_engine().connect() as connection:
+        ceiling = connection.execute(db.select(db.func.max(key))).scalar() or 0
+    last_id, rows_done = state['last_id'], state['rows_done']
+
+    chunk = chunk_size or app.config['DATA_MIGRATION_CHUNK_SIZE']
+    target, sleep_ratio = app.config['DATA_MIGRATION_CHUNK_SECONDS'], app.config['DATA_MIGRATION_SLEEP_RATIO']
+    started, first_id, reported_at = time.monotonic(), last_id, 0.0
+    status = 'paused'
+    try:
+        while last_id < ceiling:
+            _wait_for_healthy_database(name, report)
+            with tenant_engine().connect() as connection:
+                upper = connection.execute(db.select(key).where(key > last_id).order_by(key)
+                                           .offset(chunk - 1).limit(1)).scalar()
+            upper = ceiling if upper is None else min(upper, ceiling)
+
+            chunk_started = time.monotonic()
+            with tenant_engine().begin() as connection:
+                changed = spec.func(connection, last_id, upper) or 0
+                progressed = connection.execute(table.update().where(
+                    table.c.name == name, table.c.last_id == last_id
+                ).values(last_id=upper, rows_done=table.c.rows_done + changed, status='running',
+                         updated_at=datetime.now(timezone.utc))).rowcount
+                if not progressed:
+                    connection.rollback()  # Réservation reprise par un autre processus : tranche annulée
+                    status = None
+                    report(f"{name} : reprise par un autre processus, arrêt.")
+                    return {'last_id': last_id, 'rows_done': rows_done, 'status': 'running'}
+            elapsed = time.monotonic() - chunk_started
+            last_id, rows_done = upper, rows_done + changed
+
+            now = time.monotonic()
+            if now - reported_at >= 5 or last_id >= ceiling:
+                reported_at = now
+                rate = (last_id - first_id) / max(now - started, 1e-6)  # Clés parcourues par seconde
+                eta = (ceiling - last_id) / rate if rate else 0
+                report(f"{name} : clé {last_id}/{ceiling} ({last_id / ceiling:.1%}), {rows_done} lignes, "
+                       f"tranche {chunk}, fin estimée dans {timedelta(seconds=int(eta))}")
+            chunk = max(100, min(50000, int(chunk * min(2.0, max(0.5, target / max(elapsed, 1e-3))))))
+            if max_seconds and now - started >= max_seconds:
+                report(f"{name} : durée maximale atteinte, reprise possible.")
+                return {'last_id': last_id, 'rows_done': rows_done, 'status': 'paused'}
+            time.sleep(elapsed * sleep_ratio)
+        status = 'done'
+    finally:
+        if status is not None:
+            _save_migration_state(name, status=status,
+                                  **({'finished_at': datetime.now(timezone.utc)} if status == 'done' else {}))
+    report(f"{name} : terminée, {rows_done} lignes modifiées.")
+    return {'last_id': last_id, 'rows_done': rows_done, 'status': status}
+
+@data_migration('teacher-evaluation-terms', TeacherEvaluation.__table__)
+def _backfill_evaluation_terms(connection, lower, upper):
+    """Renseigne le semestre des évaluations antérieures à la colonne term."""
+    table = TeacherEvaluation.__table__
+    rows = connection.execute(db.select(table.c.id, table.c.created_at).where(
+        table.c.id > lower, table.c.id <= upper, table.c.term.is_(None))).all()
+    if rows:
+        now = datetime.now(timezone.utc)
+        connection.execute(
+            table.update().where(table.c.id == db.bindparam('eid')).values(term=db.bindparam('new_term')),
+            [{'eid': eid, 'new_term': academic_term(created_at or now)} for eid, created_at in rows],
+        )
+    return len(rows)
+
+@data_migration('event-confirmed-counts', Event.__table__)
+def _backfill_event_confirmed_counts(connection, lower, upper):
+    """Recalcule le compteur de places des événements à partir des inscriptions confirmées."""
+    table, participants = Event.__table__, EventParticipant.__table__
+    confirmed = db.select(db.func.count(participants.c.id)).where(
+        participants.c.event_id == table.c.id, participants.c.status == REGISTRATION_CONFIRMED
+    ).scalar_subquery()
+    return connection.execute(table.update().where(
+        table.c.id > lower, table.c.id <= upper
+    ).values(confirmed_count=confirmed)).rowcount
+
+@data_migration('course-averages', Grade.__table__)
+def _backfill_course_averages(connection, lower, upper):
+    """Calcule le cache des moyennes pour les couples (étudiant, cours) des notes de la tranche."""
+    table = Grade.__table__
+    pairs = connection.execute(db.select(table.c.student_id, table.c.course_id).where(
+        table.c.id > lower, table.c.id <= upper).distinct()).all()
+    return refresh_course_averages(pairs, connection)
+
+@data_migration('payment-invoice-numbers', Payment.__table__)
+def _backfill_invoice_numbers(connection, lower, upper):
+    """Attribue un numéro de facture aux paiements qui n'en ont pas (série de l'année du paiement)."""
+    table = Payment.__table__
+    rows = connection.execute(db.select(table.c.id, table.c.payment_date).where(
+        table.c.id > lower, table.c.id <= upper, table.c.invoice_number.is_(None)).order_by(table.c.id)).all()
+    by_prefix = {}
+    for payment_id, payment_date in rows:
+        by_prefix.setdefault(InvoiceNumberAllocator.prefix_for(payment_date), []).append(payment_id)
+    updates = []
+    for prefix, payment_ids in by_prefix.items():
+        first = reserve_invoice_numbers(prefix, len(payment_ids), connection)
+        updates.extend({'pid': pid, 'number': InvoiceNumberAllocator.format(prefix, first + i)}
+                       for i, pid in enumerate(payment_ids))
+    if updates:
+        connection.execute(
+            table.update().where(table.c.id == db.bindparam('pid')).values(invoice_number=db.bindparam('number')),
+            updates,
+        )
+    return len(updates)
+
+@app.cli.command('data-migrate')
+@click.argument('name')
+@click.option('--chunk-size', type=int, default=None, help='Taille initiale des tranches')
+@click.option('--max-seconds', type=int, default=None, help="S'arrêter après cette durée (reprise au prochain lancement)")
+@click.option('--restart', is_flag=True, help='Repartir du début')
+def data_migrate_command(name, chunk_size, max_seconds, restart):
+    """Exécute ou reprend une migration de données par tranches."""
+    if name not in DATA_MIGRATIONS:
+        print(f"Migration inconnue : {name}. Disponibles : {', '.join(sorted(DATA_MIGRATIONS))}")
+        return
+    run_data_migration(name, chunk_size=chunk_size, max_seconds=max_seconds, restart=restart)
+
+@app.cli.command('data-migrations')
+def data_migrations_command():
+    """Liste les migrations de données et leur avancement."""
+    states = {state.name: state for state in DataMigration.query}
+    for name, spec in sorted(DATA_MIGRATIONS.items()):
+        state = states.get(name)
+        key = list(spec.table.primary_key.columns)[0]
+        ceiling = db.session.scalar(db.select(db.func.max(key))) or 0
+        progress = f"{min(state.last_id / ceiling, 1):.1%}" if state and ceiling else '-'
+        print(f"{name}\t{state.status if state else 'pending'}\t{progress}\t"
+              f"{state.rows_done if state else 0} lignes\t{spec.description}")
+
+# Campus : requêtes agrégées pour l'administration centrale
+def for_each_campus(func, *args):
+    """Exécute func(*args) dans chaque campus, en parallèle (un thread par base) ; retourne {campus: résultat}."""
+    campuses = sorted(app.config['CAMPUS_DATABASES'])
+    if not campuses:
+        return {None: func(*args)}
+
+    def run(campus):
+        with campus_context(campus):
+            return func(*args)
+
+    with ThreadPoolExecutor(max_workers=len(campuses), thread_name_prefix='campus') as pool:
+        return dict(zip(campuses, pool.map(run, campuses)))
+
+def campus_overview():
+    """Chiffres clés du campus courant, chacun en une requête agrégée."""
+    today = date.today()
+    return {
+        'students': db.session.scalar(db.select(db.func.count(Student.id))),
+        'scholarship_students': db.session.scalar(
+            db.select(db.func.count(Student.id)).where(Student.is_scholarship.is_(True))),
+        'teachers': db.session.scalar(db.select(db.func.count(Teacher.id))),
+        'courses': db.session.scalar(db.select(db.func.count(Course.id))),
+        'enrollments': db.session.scalar(db.select(db.func.count(Enrollment.id))),
+        'balance_due': float(db.session.scalar(
+            db.select(db.func.coalesce(db.func.sum(StudentBalance.balance), 0)).where(StudentBalance.balance > 0))),
+        'overdue_accounts': db.session.scalar(db.select(db.func.count(StudentBalance.student_id)).where(
+            StudentBalance.oldest_due_date < today, StudentBalance.balance > 0)),
+    }
+
+def central_overview():
+    """Chiffres clés par campus et totaux de l'établissement."""
+    by_campus = for_each_campus(campus_overview)
+    totals = {}
+    for figures in by_campus.values():
+        for name, value in figures.items():
+            totals[name] = totals.get(name, 0) + value
+    return by_campus, totals
+
+@app.route('/api/central/overview')
+def api_central_overview():
+    if 'user_id' not in session:
+        return jsonify(error='Veuillez vous connecter pour accéder à cette page.'), 401
+    central = app.config['CENTRAL_CAMPUS']
+    # Plusieurs campus : réservé aux administrateurs du campus central, s'il est désigné
+    if session.get('user_type') != 'admin' or (app.config['CAMPUS_DATABASES'] and
+                                               (central is None or current_campus() != central)):
+        return jsonify(error='Accès refusé : droits insuffisants.'), 403
+
+    by_campus, totals = central_overview()
+    return jsonify(campuses=by_campus if app.config['CAMPUS_DATABASES'] else {}, totals=totals)
+
+@app.cli.command('campus-init')
+def campus_init_command():
+    """Crée les tables manquantes dans la base de chaque campus."""
+    for campus in sorted(app.config['CAMPUS_DATABASES']):
+        db.metadata.create_all(tenant_engine(campus))
+        print(f"{campus} : tables à jour.")
+
+@app.cli.command('campus-overview')
+def campus_overview_command():
+    """Affiche les chiffres clés de chaque campus et les totaux."""
+    by_campus, totals = central_overview()
+    for campus, figures in by_campus.items():
+        print(f"{campus or '-'}\t" + '\t'.join(f'{name}={value}' for name, value in figures.items()))
+    print('total\t' + '\t'.join(f'{name}={value}' for name, value in totals.items()))
+
+# Courriels sortants : file durable, récapitulatif par destinataire, envoi SMTP par lots
+DOCUMENT_TYPE_LABELS = {
+    'certificate': 'Certificat de scolarité',
+    'transcript': 'Relevé de notes',
+    'diploma': 'Diplôme',
+    'attestation': 'Attestation',
+}
+
+_mail_queue_depth = None  # Courriels en attente au dernier passage du worker de ce processus
+
+def enqueue_email(recipient, subject, body, source, source_id=None):
+    """Met un courriel en file (sans commit) ; il part à la fin de la fenêtre de regroupement."""
+    subject = ' '.join(subject.splitlines())  # Un saut de ligne est interdit dans un en-tête
+    db.session.add(OutboundEmail(
+        recipient=recipient, subject=subject[:200], body=body, source=source, source_id=source_id,
+        next_attempt_at=datetime.now(timezone.utc) + timedelta(seconds=app.config['MAIL_DIGEST_WINDOW_SECONDS']),
+    ))
+
+def _not_queued(source, column):
+    """Ligne d'origine absente de la file (anti-jointure sur uq_outbound_email_source)."""
+    return ~db.exists().where(OutboundEmail.source == source, OutboundEmail.source_id == column)
+
+def queue_parent_notices(limit=None):
+    """Un courriel par avis d'absence en attente ; les avis sont marqués dans la même transaction."""
+    notice_ids = []
+    for email, notices in pending_parent_digests(limit):
+        for notice_id, student, absence, course_name in notices:
+            name = f'{student.first_name} {student.last_name}'
+            enqueue_email(email, f'Absence de {name}',
+                          f"{name} a été noté(e) absent(e) au cours « {course_name} » le {absence.date:%d/%m/%Y}.",
+                          'parent_notice', notice_id)
+            notice_ids.append(notice_id)
+    if notice_ids:
+        mark_notices_digested(notice_ids)
+    return len(notice_ids)
+
+def queue_ready_documents():
+    """Un courriel par document terminé dont l'étudiant a demandé à être prévenu."""
+    email = db.func.coalesce(Student.email, User.email)
+    rows = db.session.query(DocumentRequest.id, DocumentRequest.document_type, email).join(
+        Student, Student.id == DocumentRequest.student_id
+    ).outerjoin(User, User.id == Student.user_id).filter(
+        DocumentRequest.status == 'completed', DocumentRequest.notify_ready.is_(True), email.isnot(None),
+        _not_queued('document', DocumentRequest.id),
+    ).all()
+    for request_id, document_type, recipient in rows:
+        label = DOCUMENT_TYPE_LABELS.get(document_type, document_type)
+        enqueue_email(recipient, f'Document disponible : {label}',
+                      f"Votre demande de document « {label} » est traitée : le document est disponible au service de scolarité.",
+                      'document', request_id)
+    return len(rows)
+
+def queue_notifications():
+    """Un courriel par notification non lue créée depuis le dernier passage.
+
+    Au premier passage, le point de départ est fixé à maintenant : les
+    notifications déjà présentes ne sont pas envoyées. Les passages se
+    chevauchent de cinq minutes pour les transactions validées en retard ;
+    l'anti-jointure évite les doublons.
+    """
+    now = datetime.now(timezone.utc)
+    mark = get_watermark('mail-notifications')
+    set_watermark('mail-notifications', now)
+    if mark is None:
+        return 0
+    rows = db.session.query(Notification.id, Notification.title, Notification.message, Notification.link, User.email).join(
+        User, User.id == Notification.user_id
+    ).filter(
+        Notification.timestamp >= mark - timedelta(minutes=5), Notification.read.is_(False),
+        _not_queued('notification', Notification.id),
+    ).all()
+    for notification_id, title, message, link, recipient in rows:
+        body = f'{message}\n\n{link}' if link else message
+        enqueue_email(recipient, title, body, 'notification', notification_id)
+    return len(rows)
+
+def collect_outbound_emails():
+    """Met en file les avis aux parents, les documents prêts et les notifications ; retourne les effectifs.
+
+    Chaque source passe dans un point de sauvegarde : si un autre worker a mis
+    en file les mêmes lignes entre-temps (uq_outbound_email_source), la source
+    est ignorée pour ce passage au lieu d'interrompre le worker.
+    """
+    queued = {}
+    for source, queue in (('parent_notice', queue_parent_notices), ('document', queue_ready_documents),
+                          ('notification', queue_notifications)):
+        try:
+            with db.session.begin_nested():
+                queued[source] = queue()
+        except db.exc.IntegrityError:
+            queued[source] = 0
+    db.session.commit()
+    return queued
+
+class MailRateLimiter:
+    """Seau à jetons : au plus per_minute courriels par minute, par rafales d'un dixième de ce débit."""
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, per_minute / 10.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            time.sleep((1 - self.tokens) / self.rate)
+            self.updated = time.monotonic()
+            self.tokens = 1.0
+        self.tokens -= 1
+
+class SMTPTransport:
+    """Connexion SMTP réutilisée d'un envoi à l'autre.
+
+    Elle est ouverte au premier envoi, rouverte après MAIL_MESSAGES_PER_CONNECTION
+    courriels et, une fois, quand le serveur l'a fermée entre deux envois.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.smtp = None
+        self.sent = 0
+
+    def _open(self):
+        smtp = smtplib.SMTP(self.config['MAIL_SERVER'], self.config['MAIL_PORT'], timeout=30)
+        try:
+            if self.config['MAIL_USE_TLS']:
+                smtp.starttls()
+            if self.config['MAIL_USERNAME']:
+                smtp.login(self.config['MAIL_USERNAME'], self.config['MAIL_PASSWORD'])
+        except BaseException:
+            smtp.close()
+            raise
+        self.smtp = smtp
+        self.sent = 0
+
+    def send(self, message):
+        if self.smtp is not None and self.sent >= self.config['MAIL_MESSAGES_PER_CONNECTION']:
+            self.close()
+        for reconnect in (True, False):
+            if self.smtp is None:
+                self._open()
+            try:
+                self.smtp.send_message(message)
+            except smtplib.SMTPServerDisconnected:
+                self.smtp = None
+                if not reconnect:
+                    raise
+                continue
+            except smtplib.SMTPResponseException:
+                raise  # Refus du serveur : la connexion reste utilisable
+            except OSError:
+                self.smtp.close()
+                self.smtp = None
+                raise
+            self.sent += 1
+            return
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except OSError:
+                self.smtp.close()
+            self.smtp = None
+
+def compose_digest(recipient, rows):
+    """Un courriel pour les messages en file d'un destinataire ; plusieurs messages forment un récapitulatif."""
+    message = EmailMessage()
+    message['From'] = app.config['MAIL_SENDER']
+    message['To'] = recipient
+    message['Date'] = formatdate(localtime=True)
+    message['Message-ID'] = make_msgid()
+    if len(rows) == 1:
+        message['Subject'] = rows[0].subject
+        message.set_content(rows[0].body)
+    else:
+        message['Subject'] = f'Scolarité : {len(rows)} nouveaux messages'
+        message.set_content('\n\n'.join(f"{row.subject}\n{'-' * len(row.subject)}\n{row.body}" for row in rows))
+    return message
+
+def mail_claim_limit():
+    """Destinataires réservés par passage : pas plus que le débit n'en envoie en une demi-durée de réservation."""
+    sendable = app.config['MAIL_RATE_PER_MINUTE'] * app.config['MAIL_CLAIM_TIMEOUT_SECONDS'] / 60 / 2
+    return max(1, min(app.config['MAIL_BATCH_RECIPIENTS'], int(sendable)))
+
+def claim_outbound_emails(now):
+    """Réserve les courriels en attente des destinataires dont au moins un courriel est dû ; retourne les lignes.
+
+    La réservation est un UPDATE conditionnel (status = 'pending') validé
+    aussitôt : deux workers ne prennent jamais le même courriel. Les
+    courriels d'un destinataire non encore dus partent avec les autres. Le
+    lot est borné par mail_claim_limit() pour être envoyé avant qu'un autre
+    worker ne le considère abandonné.
+    """
+    table = OutboundEmail.__table__
+    db.session.execute(table.update().where(
+        table.c.status == 'sending', table.c.claimed_at < now - timedelta(seconds=app.config['MAIL_CLAIM_TIMEOUT_SECONDS'])
+    ).values(status='pending', claim_token=None))  # Worker arrêté en cours d'envoi
+    recipients = db.session.scalars(db.select(table.c.recipient).where(
+        table.c.status == 'pending', table.c.next_attempt_at <= now
+    ).group_by(table.c.recipient).order_by(db.func.min(table.c.next_attempt_at)).limit(mail_claim_limit())).all()
+    if not recipients:
+        db.session.commit()
+        return []
+    token = os.urandom(16).hex()
+    db.session.execute(table.update().where(
+        table.c.status == 'pending', table.c.recipient.in_(recipients)
+    ).values(status='sending', claim_token=token, claimed_at=now))
+    db.session.commit()
+    return db.session.execute(db.select(
+        table.c.id, table.c.recipient, table.c.subject, table.c.body, table.c.attempts
+    ).where(table.c.claim_token == token).order_by(table.c.recipient, table.c.id)).all()
+
+def _finish_outbound_emails(ids, **values):
+    table = OutboundEmail.__table__
+    db.session.execute(table.update().where(table.c.id.in_(ids)).values(claim_token=None, **values))
+
+def _outbound_email_failed(rows, error, permanent):
+    """Enregistre un échec : reprise avec délai exponentiel et gigue, ou abandon ; retourne le résultat."""
+    attempts = max(row.attempts for row in rows) + 1
+    if permanent or attempts >= app.config['MAIL_MAX_ATTEMPTS']:
+        _finish_outbound_emails([row.id for row in rows], status='failed', attempts=attempts, last_error=str(error)[:255])
+        return 'failed'
+    delay = min(app.config['MAIL_RETRY_MAX_SECONDS'], app.config['MAIL_RETRY_BASE_SECONDS'] * 2 ** (attempts - 1))
+    _finish_outbound_emails(
+        [row.id for row in rows], status='pending', attempts=attempts, last_error=str(error)[:255],
+        next_attempt_at=datetime.now(timezone.utc) + timedelta(seconds=random.uniform(delay / 2, delay)),
+    )
+    return 'retry'
+
+def _send_digest(transport, limiter, recipient, group):
+    """Compose et envoie le récapitulatif d'un destinataire ; retourne (résultat, serveur injoignable)."""
+    try:
+        message = compose_digest(recipient, group)
+    except Exception as exc:  # En-tête ou adresse invalide : chaque reprise échouerait de même
+        app.logger.exception("Courriel pour %s impossible à composer", recipient)
+        return _outbound_email_failed(group, exc, permanent=True), False
+    limiter.acquire()
+    try:
+        transport.send(message)
+    except smtplib.SMTPRecipientsRefused as exc:
+        codes = [code for code, _ in exc.recipients.values()]
+        return _outbound_email_failed(group, exc, permanent=all(code >= 500 for code in codes)), False
+    except smtplib.SMTPResponseException as exc:
+        return _outbound_email_failed(group, exc, permanent=exc.smtp_code >= 500), False
+    except OSError as exc:
+        return _outbound_email_failed(group, exc, permanent=False), True
+    _finish_outbound_emails([row.id for row in group], status='sent', sent_at=datetime.now(timezone.utc),
+                            last_error=None)
+    return 'sent', False
+
+def deliver_outbound_emails(transport, limiter):
+    """Un passage du worker : réserve, regroupe par destinataire et envoie ; retourne les effectifs par résultat.
+
+    Chaque récapitulatif est validé dès son envoi. Un refus 5xx, ou un
+    courriel impossible à composer, est définitif ; un refus 4xx ou une erreur
+    réseau donne lieu à une reprise. Si le serveur est injoignable, ou si la
+    moitié de MAIL_CLAIM_TIMEOUT_SECONDS est écoulée, les courriels restants du
+    passage retournent en file sans compter de tentative.
+    """
+    global _mail_queue_depth
+    table = OutboundEmail.__table__
+    counts = {'sent': 0, 'retry': 0, 'failed': 0}
+    rows = claim_outbound_emails(datetime.now(timezone.utc))
+    deadline = time.monotonic() + app.config['MAIL_CLAIM_TIMEOUT_SECONDS'] / 2
+    max_items = app.config['MAIL_DIGEST_MAX_ITEMS']
+    digests = []
+    for row in rows:
+        if digests and digests[-1][0] == row.recipient and len(digests[-1][1]) < max_items:
+            digests[-1][1].append(row)
+        else:
+            digests.append((row.recipient, [row]))
+
+    try:
+        for recipient, group in digests:
+            if time.monotonic() > deadline:
+                break
+            result, unreachable = _send_digest(transport, limiter, recipient, group)
+            db.session.commit()
+            counts[result] += len(group)
+            metrics.inc('outbound_emails_total', (('result', result),), len(group))
+            if unreachable:
+                break
+    finally:
+        if rows:  # Interruption : les courriels réservés non traités retournent en file
+            db.session.rollback()
+            db.session.execute(table.update().where(
+                table.c.id.in_([row.id for row in rows]), table.c.status == 'sending'
+            ).values(status='pending', claim_token=None))
+            db.session.commit()
+
+    _mail_queue_depth = db.session.scalar(db.select(db.func.count()).select_from(table).where(table.c.status == 'pending'))
+    return counts
+
+@metrics.gauge
+def _outbound_email_depth():
+    if _mail_queue_depth is None:
+        return []
+    return [('worker_queue_depth', (('queue', 'email'),), _mail_queue_depth)]
+
+@app.cli.command('mail-worker')
+@click.option('--once', is_flag=True, help='Un seul passage')
+@click.option('--interval', default=10.0, help='Secondes entre deux passages quand la file est vide')
+def mail_worker_command(once, interval):
+    """Met en file avis, documents prêts et notifications, puis envoie les courriels dus."""
+    transport = SMTPTransport(app.config)
+    limiter = MailRateLimiter(app.config['MAIL_RATE_PER_MINUTE'])
+    try:
+        while True:
+            queued = collect_outbound_emails()
+            counts = deliver_outbound_emails(transport, limiter)
+            metrics.maybe_flush()
+            if once or any(queued.values()) or any(counts.values()):
+                print('en file : ' + ', '.join(f'{source}={n}' for source, n in queued.items())
+                      + ' ; ' + ', '.join(f'{result}={n}' for result, n in counts.items())
+                      + f' ; en attente={_mail_queue_depth}')
+            if once:
+                break
+            if not any(counts.values()):
+                transport.close()  # File vide : la connexion SMTP n'est pas gardée ouverte
+                time.sleep(interval)
+    finally:
+        transport.close()
+
+class _SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Dialogue SMTP minimal : HELO/EHLO, MAIL, RCPT, DATA, RSET, NOOP, QUIT."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        sink = self.server
+        with sink.lock:
+            sink.connections += 1
+        self.reply('220 scolarite-sink ESMTP')
+        sender, recipients = None, []
+        for raw in self.rfile:
+            command, _, argument = raw.decode('utf-8', 'replace').rstrip('\r\n').partition(' ')
+            command = command.upper()
+            if command == 'EHLO':
+                self.reply('250-scolarite-sink')
+                self.reply('250-8BITMIME')
+                self.reply('250 SMTPUTF8')
+            elif command == 'HELO':
+                self.reply('250 scolarite-sink')
+            elif command == 'MAIL':
+                sender, recipients = argument, []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                address = argument.partition(':')[2].strip().strip('<>').lower()
+                if address in sink.rejected:
+                    self.reply('550 5.1.1 Mailbox unavailable')
+                    continue
+                recipients.append(argument)
+                self.reply('250 OK')
+            elif command == 'DATA':
+                if sender is None or not recipients:
+                    self.reply('503 Bad sequence of commands')
+                    continue
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                for line in self.rfile:
+                    if line.rstrip(b'\r\n') == b'.':
+                        break
+                    lines.append(line[1:] if line.startswith(b'..') else line)
+                if sink.fail_rate and random.random() < sink.fail_rate:
+                    self.reply('451 4.3.0 Simulated temporary failure')
+                else:
+                    sink.store(sender, recipients, b''.join(lines))
+                    self.reply('250 OK')
+                sender, recipients = None, []
+            elif command == 'RSET':
+                sender, recipients = None, []
+                self.reply('250 OK')
+            elif command == 'NOOP':
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """Serveur SMTP local qui accepte tout : développement et essais de bout en bout du worker.
+
+    Les courriels reçus sont gardés dans messages et, si directory est
+    fourni, écrits en .eml. fail_rate fait répondre 451 à une part des
+    envois, pour exercer les reprises ; les adresses de rejected sont
+    refusées en 550. port=0 choisit un port libre.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=1025, directory=None, fail_rate=0.0, rejected=()):
+        super().__init__((host, port), _SMTPSinkHandler)
+        self.directory = directory
+        self.fail_rate = fail_rate
+        self.rejected = {address.lower() for address in rejected}
+        self.lock = threading.Lock()
+        self.messages = []
+        self.connections = 0
+
+    def store(self, sender, recipients, data):
+        import email
+        import email.policy
+        message = email.message_from_bytes(data, policy=email.policy.default)
+        with self.lock:
+            self.messages.append(message)
+            number = len(self.messages)
+        if self.directory:
+            with open(os.path.join(self.directory, f'{datetime.now():%Y%m%d-%H%M%S}-{number:05d}.eml'), 'wb') as f:
+                f.write(data)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='smtp-sink', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+@app.cli.command('mail-sink')
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', default=1025)
+@click.option('--output', type=click.Path(file_okay=False), default=None, help='Dossier des .eml (instance/mail_sink)')
+@click.option('--fail-rate', default=0.0, help='Part des envois refusés en 451')
+def mail_sink_command(host, port, output, fail_rate):
+    """Serveur SMTP local : reçoit les courriels du worker et les écrit dans un dossier."""
+    output = output or os.path.join(app.instance_path, 'mail_sink')
+    os.makedirs(output, exist_ok=True)
+    sink = SMTPSink(host, port, output, fail_rate)
+    print(f"Serveur SMTP sur {host}:{sink.server_address[1]} ; courriels dans {output}. "
+          f"Lancer le worker avec MAIL_SERVER={host} MAIL_PORT={sink.server_address[1]}.")
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.server_close()
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404  # Affiche le fichier 404.html
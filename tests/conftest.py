@@ -0,0 +1,103 @@
+"""Base de test : fichiers SQLite jetables, recréés pour chaque test.
+
+L'application lit sa configuration à l'import : les variables d'environnement
+sont donc fixées avant d'importer scolarite_app.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+_DB_DIR = tempfile.mkdtemp(prefix='scolarite-tests-')
+os.environ['DATABASE_URL'] = f'sqlite:///{_DB_DIR}/scolarite.db'
+os.environ['METRICS_DIR'] = ''
+os.environ['STORAGE_ROOT'] = os.path.join(_DB_DIR, 'storage')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.engine import Engine  # noqa: E402
+
+from scolarite_app import app, db, Student, Teacher, User  # noqa: E402
+
+
+@event.listens_for(Engine, 'connect')
+def _sqlite_connect(dbapi_connection, connection_record):
+    # Transactions ouvertes par BEGIN IMMEDIATE (ci-dessous) : SQLite sérialise alors
+    # les écritures concurrentes au lieu de refuser la mise à niveau d'un verrou.
+    if type(dbapi_connection).__module__.startswith('sqlite3'):
+        dbapi_connection.isolation_level = None
+        dbapi_connection.execute('PRAGMA busy_timeout = 30000')
+
+
+@event.listens_for(Engine, 'begin')
+def _sqlite_begin(connection):
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+
+@pytest.fixture
+def database():
+    """Contexte d'application sur une base vide."""
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield db
+        db.session.remove()
+
+
+@pytest.fixture
+def client(database):
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        yield client
+
+
+def login(client, user, user_type=None):
+    with client.session_transaction() as flask_session:
+        flask_session['user_id'] = user.id
+        flask_session['user_type'] = user_type or user.user_type
+
+
+def make_students(count, prefix='s'):
+    users = [User(username=f'{prefix}{i}', email=f'{prefix}{i}@test', user_type='student', password_hash='x')
+             for i in range(count)]
+    db.session.add_all(users)
+    db.session.flush()
+    students = [Student(matricule=f'{prefix.upper()}{i:05d}', last_name='Test', first_name=f'E{i}', user_id=users[i].id)
+                for i in range(count)]
+    db.session.add_all(students)
+    db.session.commit()
+    return students
+
+
+def make_user(username, user_type):
+    user = User(username=username, email=f'{username}@test', user_type=user_type, password_hash='x')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def make_teacher(username):
+    """Compte enseignant et sa fiche ; retourne (utilisateur, enseignant)."""
+    user = make_user(username, 'teacher')
+    teacher = Teacher(last_name='Test', first_name=username, user_id=user.id)
+    db.session.add(teacher)
+    db.session.commit()
+    return user, teacher
+
+
+def run_concurrently(func, args_list, workers=8):
+    """Exécute func(*args) dans des threads, chacun dans son propre contexte d'application."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def call(args):
+        with app.app_context():
+            try:
+                return func(*args)
+            finally:
+                db.session.remove()
+
+    db.session.commit()  # Le thread principal ne doit pas garder le verrou d'écriture de SQLite
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(call, args_list))
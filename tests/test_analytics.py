@@ -0,0 +1,66 @@
+import os
+from datetime import date
+
+import pytest
+
+import scolarite_app
+from conftest import make_students
+from scolarite_app import (db, AnalyticsSnapshot, Course, Grade, Student, analytics_snapshots,
+                           export_analytics_snapshot)
+
+
+@pytest.fixture
+def school(database):
+    students = make_students(12)
+    for i, student in enumerate(students):
+        student.gender = (None, 'F', 'M')[i % 3]
+        student.nationality = ('Sénégal', 'France', None, 'Mali')[i % 4]
+        student.is_scholarship = i % 5 == 0
+    courses = [Course(code=f'C{i}', name=f'Cours {i}', level=('L1', 'L2', None)[i % 3]) for i in range(4)]
+    db.session.add_all(courses)
+    db.session.flush()
+    db.session.add_all(Grade(student_id=student.id, course_id=course.id, value=(i * 7 + j * 3) % 21,
+                             date=date(2026, 1, 5)) for i, student in enumerate(students)
+                       for j, course in enumerate(courses) if (i + j) % 3)
+    db.session.commit()
+
+
+def test_snapshot_groups_match_sql(school, tmp_path):
+    path, manifest = export_analytics_snapshot(str(tmp_path))
+    assert manifest['tables']['grade']['rows'] == Grade.query.count()
+    snapshot = AnalyticsSnapshot(path)
+
+    expected = {(gender, nationality): n for gender, nationality, n in db.session.query(
+        Student.gender, Student.nationality, db.func.count()).group_by(Student.gender, Student.nationality)}
+    assert snapshot.group_count('student', ['gender', 'nationality']) == expected
+    assert snapshot.group_count('student', 'is_scholarship') == \
+        dict(db.session.query(Student.is_scholarship, db.func.count()).group_by(Student.is_scholarship))
+
+    means = snapshot.group_mean('grade', 'course_id', 'value')
+    for course_id, mean, n in db.session.query(Grade.course_id, db.func.avg(Grade.value), db.func.count()).group_by(
+            Grade.course_id):
+        assert means[course_id] == (pytest.approx(mean), n)
+
+    level = snapshot.joined_factor('grade', 'course_id', 'course', 'level')
+    by_level = snapshot.group_mean('grade', [level], 'value')
+    expected = db.session.query(Course.level, db.func.avg(Grade.value), db.func.count()).join(
+        Course, Course.id == Grade.course_id).group_by(Course.level).all()
+    assert sorted(by_level, key=str) == sorted((lvl for lvl, _, _ in expected), key=str)
+    for lvl, mean, n in expected:
+        assert by_level[lvl] == (pytest.approx(mean), n)
+    assert snapshot.group_count('grade', [level]) == {lvl: n for lvl, _, n in expected}
+
+
+def test_exports_in_the_same_second_and_failed_exports(school, tmp_path, monkeypatch):
+    first, _ = export_analytics_snapshot(str(tmp_path))
+    second, _ = export_analytics_snapshot(str(tmp_path))
+    assert first != second and analytics_snapshots(str(tmp_path)) == [os.path.basename(first),
+                                                                      os.path.basename(second)]
+
+    def broken(self, values):
+        raise OSError('disque plein')
+
+    monkeypatch.setattr(scolarite_app._SnapshotColumnWriter, 'append', broken)
+    with pytest.raises(OSError):
+        export_analytics_snapshot(str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == sorted(map(os.path.basename, (first, second)))  # Aucun .tmp restant
@@ -0,0 +1,74 @@
+from datetime import date
+
+import pytest
+
+import scolarite_app
+from conftest import login, make_students, make_teacher, make_user
+from scolarite_app import db, Absence, Course, ParentNotice, record_roll_call
+
+
+@pytest.fixture
+def teacher(database):
+    return make_teacher('enseignant')
+
+
+@pytest.fixture
+def course(teacher):
+    course = Course(code='MAT101', name='Analyse', teacher_id=teacher[1].id)
+    db.session.add(course)
+    db.session.commit()
+    return course
+
+
+def absent(course, day):
+    return sorted(sid for (sid,) in db.session.query(Absence.student_id).filter_by(course_id=course.id, date=day))
+
+
+@pytest.mark.parametrize('payload', [{'date': 20260105}, {'date': ['2026-01-05']}, {'date': '05/01/2026'},
+                                     ['2026-01-05'], {'absent': [True]}])
+def test_roll_call_rejects_malformed_payload(client, teacher, course, payload):
+    login(client, teacher[0])
+    assert client.post(f'/courses/{course.id}/attendance', json=payload).status_code == 400
+
+
+def test_only_the_course_teacher_or_staff_take_the_roll_call(client, teacher, course):
+    student = make_students(1)[0]
+    payload = {'date': '2026-01-05', 'absent': [student.id]}
+    login(client, make_teacher('autre')[0])
+    assert client.post(f'/courses/{course.id}/attendance', json=payload).status_code == 403
+    login(client, make_user('sans-fiche', 'teacher'))
+    assert client.post(f'/courses/{course.id}/attendance', json=payload).status_code == 403
+    assert absent(course, date(2026, 1, 5)) == []
+
+    login(client, teacher[0])
+    assert client.post(f'/courses/{course.id}/attendance', json=payload).json == {'absent': 1, 'new': 1, 'cleared': 0}
+    login(client, make_user('scolarite', 'staff'))
+    assert client.post(f'/courses/{course.id}/attendance', json=dict(payload, absent=[])).status_code == 200
+    assert absent(course, date(2026, 1, 5)) == []
+
+
+def test_concurrent_roll_call_answers_409(client, teacher, course, monkeypatch):
+    def conflict(*args, **kwargs):
+        raise db.exc.IntegrityError('INSERT INTO absence', {}, Exception('uq_absence_course_date_student'))
+
+    monkeypatch.setattr(scolarite_app, 'record_roll_call', conflict)
+    login(client, teacher[0])
+    assert client.post(f'/courses/{course.id}/attendance', json={'date': '2026-01-05'}).status_code == 409
+
+
+def test_roll_call_replaces_the_absent_list_and_queues_parent_notices(course):
+    first, second, third = make_students(3)
+    first.parent_email = third.parent_email = 'parent@test'
+    db.session.commit()
+    day = date(2026, 1, 5)
+
+    assert record_roll_call(course.id, day, [first.id, second.id]) == {'absent': 2, 'new': 2, 'cleared': 0}
+    assert record_roll_call(course.id, day, [first.id, second.id]) == {'absent': 2, 'new': 0, 'cleared': 0}
+    assert sorted(n.student_id for n in ParentNotice.query) == [first.id]
+
+    Absence.query.filter_by(student_id=second.id).update({'justified': True})
+    db.session.commit()
+    assert record_roll_call(course.id, day, [third.id]) == {'absent': 1, 'new': 1, 'cleared': 1}
+    assert absent(course, day) == [second.id, third.id]  # L'absence justifiée est conservée
+    # L'avis de l'absence effacée disparaît avec elle (ondelete CASCADE)
+    assert sorted(n.student_id for n in ParentNotice.query) == [third.id]
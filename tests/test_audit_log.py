@@ -0,0 +1,40 @@
+from datetime import datetime
+
+import pytest
+
+from conftest import login, make_user
+from scolarite_app import db, UserLog
+
+
+@pytest.fixture
+def admin(client):
+    user = make_user('admin', 'admin')
+    login(client, user)
+    return user
+
+
+@pytest.mark.parametrize('url', ['/admin/logs', '/api/admin/logs'])
+def test_malformed_cursor_is_rejected(client, admin, url):
+    assert client.get(url).status_code == 200
+    assert client.get(url, query_string={'after': 'WyJ4Il0'}).status_code == 400
+    assert client.get(url, query_string={'after': 'WyIyMDI2LTAxLTAxIiwgIjEiXQ'}).status_code == 400  # ["2026-01-01", "1"]
+
+
+@pytest.mark.parametrize('per_page', [0, -5])
+def test_page_size_has_a_lower_bound(client, admin, per_page):
+    db.session.add_all([UserLog(matricule=admin.id, action=f'action {i}', timestamp=datetime(2030, 1, 1, 0, i))
+                        for i in range(3)])
+    db.session.add(UserLog(matricule=admin.id, action='sans date'))
+    db.session.flush()
+    UserLog.query.filter_by(action='sans date').update({'timestamp': None})  # Sinon la valeur par défaut s'applique
+    db.session.commit()
+    seen, after = [], None
+    while True:
+        page = client.get('/api/admin/logs', query_string={'per_page': per_page, **({'after': after} if after else {})})
+        assert page.status_code == 200
+        assert len(page.json['logs']) == 1
+        seen.extend(log['action'] for log in page.json['logs'])
+        after = page.json['next']
+        if after is None:
+            break
+    assert seen == ['action 2', 'action 1', 'action 0']  # Entrée sans horodatage exclue de la pagination
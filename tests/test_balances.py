@@ -0,0 +1,72 @@
+from datetime import date
+
+from conftest import make_students, run_concurrently
+from scolarite_app import (db, Payment, Scholarship, StudentBalance, overdue_balances, rebuild_student_balances,
+                           PAYMENT_STATUS_PENDING, PAYMENT_STATUS_VALIDATED)
+
+
+def payment(student, amount, due_date=None, status=PAYMENT_STATUS_PENDING):
+    return Payment(student_id=student.id, amount=amount, payment_date=date(2026, 1, 5), status=status,
+                   due_date=due_date)
+
+
+def balance(student):
+    db.session.expire_all()
+    return db.session.get(StudentBalance, student.id)
+
+
+def test_ledger_follows_payment_and_scholarship_writes(database):
+    student, other = make_students(2)
+    late, later = payment(student, 300.0, date(2026, 2, 1)), payment(student, 200.0, date(2026, 3, 1))
+    db.session.add_all([late, later, payment(student, 50.0, status=PAYMENT_STATUS_VALIDATED)])
+    db.session.add(Scholarship(student_id=student.id, scholarship_type='mérite', amount=100.0,
+                               start_date=date(2025, 9, 1), status='active'))
+    db.session.commit()
+    row = balance(student)
+    assert (row.due_total, row.paid_total, row.scholarship_total, row.balance) == (500.0, 50.0, 100.0, 400.0)
+    assert row.oldest_due_date == date(2026, 2, 1)
+
+    late.status = PAYMENT_STATUS_VALIDATED
+    db.session.commit()
+    row = balance(student)
+    assert (row.due_total, row.paid_total, row.oldest_due_date) == (200.0, 350.0, date(2026, 3, 1))
+    assert [b.student_id for b in overdue_balances(today=date(2026, 3, 2))] == [student.id]
+    assert overdue_balances(today=date(2026, 2, 15)) == []
+
+    later.student_id = other.id  # Les deux comptes sont recalculés
+    db.session.commit()
+    assert (balance(student).due_total, balance(student).oldest_due_date) == (0.0, None)
+    assert balance(other).due_total == 200.0
+
+    db.session.delete(later)
+    db.session.commit()
+    assert balance(other) is None
+
+
+def test_concurrent_payments_for_one_student_all_count(database):
+    student = make_students(1)[0]
+    student_id = student.id
+
+    def pay(amount):
+        db.session.add(Payment(student_id=student_id, amount=amount, payment_date=date(2026, 1, 5),
+                               status=PAYMENT_STATUS_PENDING, due_date=date(2026, 1, 31)))
+        db.session.commit()
+
+    run_concurrently(pay, [(10.0 * (i + 1),) for i in range(8)])
+    assert balance(student).due_total == 360.0
+
+
+def test_rebuild_reports_and_fixes_drifted_balances(database):
+    first, second, third = make_students(3)
+    db.session.add_all([payment(first, 100.0, date(2026, 1, 31)), payment(second, 80.0)])
+    db.session.commit()
+    table = StudentBalance.__table__
+    db.session.execute(table.update().where(table.c.student_id == first.id).values(due_total=1.0, balance=1.0))
+    db.session.execute(table.delete().where(table.c.student_id == second.id))
+    db.session.execute(table.insert().values(student_id=third.id, due_total=5.0, paid_total=0.0,
+                                             scholarship_total=0.0, balance=5.0, updated_at=date(2026, 1, 1)))
+    db.session.commit()
+
+    assert rebuild_student_balances() == sorted([first.id, second.id, third.id])
+    assert (balance(first).balance, balance(second).balance, balance(third)) == (100.0, 80.0, None)
+    assert rebuild_student_balances() == []
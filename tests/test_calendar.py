@@ -0,0 +1,52 @@
+from datetime import datetime
+
+from conftest import login, make_user
+from scolarite_app import db, Calendar, calendar_window, get_cache_versions
+
+
+def test_admin_calendar_rejects_invalid_month(client):
+    login(client, make_user('admin', 'admin'))
+    assert client.get('/admin/calendar?month=13').status_code == 400
+    assert client.get('/admin/calendar?month=0&year=2026').status_code == 400
+
+
+def test_admin_calendar_links_adjacent_months(client):
+    login(client, make_user('admin', 'admin'))
+    response = client.get('/admin/calendar?month=1&year=2026')
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert 'Janvier 2026' in page
+    assert 'year=2025&amp;month=12' in page or 'month=12&amp;year=2025' in page
+    assert 'year=2026&amp;month=2' in page or 'month=2&amp;year=2026' in page
+
+
+def test_calendar_window_includes_entries_longer_than_the_span(database):
+    user = make_user('admin', 'admin')
+    entries = {
+        'semestre': (datetime(2025, 9, 1), datetime(2026, 1, 31)),
+        'colloque': (datetime(2026, 1, 12), datetime(2026, 1, 14)),
+        'veille': (datetime(2025, 12, 20), datetime(2026, 1, 2)),
+        'terminé': (datetime(2025, 9, 1), datetime(2025, 12, 31)),
+        'sans fin': (datetime(2025, 11, 3), None),
+    }
+    db.session.add_all(Calendar(title=title, start_date=start, end_date=end, created_by=user.id)
+                       for title, (start, end) in entries.items())
+    db.session.commit()
+    window = calendar_window(datetime(2026, 1, 1), datetime(2026, 2, 1))
+    assert [entry.title for entry in window] == ['semestre', 'veille', 'colloque']
+
+
+def test_cache_versions_bump_once_per_commit(database):
+    user = make_user('admin', 'admin')
+    for day in (5, 6, 7):
+        db.session.add(Calendar(title='Réunion', start_date=datetime(2026, 1, day), created_by=user.id))
+        db.session.flush()
+    db.session.commit()
+    assert get_cache_versions() == {'calendar': 1}
+
+    db.session.add(Calendar(title='Annulée', start_date=datetime(2026, 1, 8), created_by=user.id))
+    db.session.flush()
+    db.session.rollback()
+    db.session.add(make_user('autre', 'staff'))
+    db.session.commit()
+    assert get_cache_versions() == {'calendar': 1}
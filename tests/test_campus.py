@@ -0,0 +1,128 @@
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+from pathlib import Path
+
+import pytest
+
+# Les campus sont lus à l'import de l'application : chaque vérification tourne dans un processus séparé
+SETUP = textwrap.dedent('''
+    import conftest
+    from datetime import datetime, timezone
+    from flask import session, url_for
+    from scolarite_app import (app, db, Student, User, UserLog, archive_user_logs, campus_context, central_overview,
+                               current_campus, rotate_user_logs, tenant_engine, InstrumentedQueuePool)
+
+    with app.app_context():
+        for campus in ('nord', 'sud'):
+            db.metadata.create_all(tenant_engine(campus))
+
+    def add_admin(campus):
+        with campus_context(campus):
+            user = User(username='admin', email='admin@test', user_type='admin', password_hash='x')
+            db.session.add(user)
+            db.session.commit()
+            return user.id
+
+    def login(client, user_id, campus):
+        with client.session_transaction() as flask_session:
+            flask_session.update(user_id=user_id, user_type='admin', campus=campus)
+''')
+
+
+@pytest.fixture
+def run_campus_script(tmp_path):
+    def run(script, **env):
+        root = Path(tempfile.mkdtemp(dir=tmp_path))  # Bases neuves à chaque processus
+        env = dict(os.environ, CAMPUS_DATABASES=f'nord=sqlite:///{root}/nord.db;sud=sqlite:///{root}/sud.db',
+                   USER_LOG_ARCHIVE_DIR=str(root / 'archives'), **env)
+        result = subprocess.run([sys.executable, '-c', SETUP + textwrap.dedent(script) + "\nprint('ok')\n"],
+                                cwd=os.path.dirname(__file__), env=env, capture_output=True, text=True, timeout=60)
+        assert result.returncode == 0, result.stderr
+        assert result.stdout.strip().endswith('ok')
+        return root
+    return run
+
+
+def test_campus_engines_share_default_engine_options(run_campus_script):
+    run_campus_script('''
+        options = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+        with app.app_context():
+            for campus in ('nord', 'sud'):
+                pool = tenant_engine(campus).pool
+                assert isinstance(pool, InstrumentedQueuePool), type(pool)
+                assert pool._pre_ping is True
+                assert pool._recycle == options['pool_recycle'] > 0
+                assert pool.size() == options['pool_size']
+                assert pool._timeout == options['pool_timeout']
+
+        with app.app_context():
+            nord, sud = tenant_engine('nord').pool.stats, tenant_engine('sud').pool.stats
+        assert nord is not sud
+        before = (nord.checkouts, sud.checkouts)
+        with campus_context('sud'):
+            url = db.session.get_bind().url
+            db.session.execute(db.text('SELECT 1'))
+        assert str(url).endswith('sud.db'), url
+        assert nord.checkouts == before[0] and sud.checkouts > before[1]  # Compteurs propres à chaque campus
+    ''')
+
+
+def test_requests_are_routed_by_host_then_path(run_campus_script):
+    run_campus_script('''
+        @app.route('/campus')
+        def campus_probe():
+            return f"{current_campus()} {url_for('campus_probe')} {session.get('user_id')}"
+
+        admin_id = add_admin('nord')
+        client = app.test_client()
+        assert client.get('/c/nord/campus').text == 'nord /c/nord/campus None'
+        assert client.get('/campus', base_url='http://sud.test').text == 'sud /campus None'
+        assert client.get('/c/ouest/campus').status_code == 404
+        assert client.get('/campus').status_code == 404  # Ni hôte ni préfixe, pas de campus par défaut
+
+        login(client, admin_id, 'nord')
+        assert client.get('/c/nord/campus').text == f'nord /c/nord/campus {admin_id}'
+        assert client.get('/c/sud/campus').text == 'sud /c/sud/campus None'  # Session d'un autre campus effacée
+        assert client.get('/c/nord/campus').text == 'nord /c/nord/campus None'
+    ''', CAMPUS_HOSTS='sud.test=sud')
+
+
+def test_central_overview_requires_the_central_campus(run_campus_script):
+    script = '''
+        for campus, count in (('nord', 2), ('sud', 1)):
+            with campus_context(campus):
+                db.session.add_all(Student(matricule=f'{campus}{i}', last_name='Test', first_name='E')
+                                   for i in range(count))
+                db.session.commit()
+        by_campus, totals = central_overview()
+        assert (by_campus['nord']['students'], by_campus['sud']['students'], totals['students']) == (2, 1, 3)
+
+        client = app.test_client()
+        for campus in ('nord', 'sud'):
+            login(client, add_admin(campus), campus)
+            response = client.get(f'/c/{campus}/api/central/overview')
+            allowed = campus == app.config['CENTRAL_CAMPUS']
+            assert response.status_code == (200 if allowed else 403), (campus, response.status_code)
+            if allowed:
+                assert sorted(response.json['campuses']) == ['nord', 'sud']
+    '''
+    run_campus_script(script)
+    run_campus_script(script, CENTRAL_CAMPUS='nord')
+
+
+def test_log_archives_are_kept_per_campus(run_campus_script):
+    root = run_campus_script('''
+        for campus in ('nord', 'sud'):
+            with campus_context(campus):
+                db.session.add(UserLog(matricule=1, action=f'connexion {campus}', timestamp=datetime(2025, 1, 15)))
+                db.session.commit()
+                rotate_user_logs(now=datetime(2025, 2, 1, tzinfo=timezone.utc))
+                assert archive_user_logs(now=datetime(2026, 6, 1, tzinfo=timezone.utc)) == ['202501']
+    ''')
+    import gzip
+    for campus in ('nord', 'sud'):
+        with gzip.open(root / 'archives' / campus / 'user_logs_202501.csv.gz', 'rt') as archive:
+            assert f'connexion {campus}' in archive.read()
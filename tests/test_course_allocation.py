@@ -0,0 +1,83 @@
+import pytest
+
+from conftest import login, make_students
+from scolarite_app import db, Course, CoursePreference, Enrollment, User, allocate_courses
+
+
+@pytest.fixture
+def courses(database):
+    courses = [Course(code='OPT1', name='Option 1', max_students=1), Course(code='OPT2', name='Option 2', max_students=2),
+               Course(code='OPT3', name='Option 3')]
+    db.session.add_all(courses)
+    db.session.commit()
+    return [course.id for course in courses]
+
+
+def wish(student, *course_ids):
+    db.session.add_all(CoursePreference(student_id=student.id, course_id=cid, rank=rank)
+                       for rank, cid in enumerate(course_ids, start=1))
+    db.session.commit()
+
+
+def enrolled():
+    return {(e.student_id, e.course_id): (e.source, e.preference_rank) for e in Enrollment.query}
+
+
+def test_preferences_are_validated(client, courses):
+    student = make_students(1)[0]
+    login(client, db.session.get(User, student.user_id))
+    for payload in ([courses[0]], {'course_ids': courses[0]}, {'course_ids': [True]}, {'course_ids': ['1']}):
+        assert client.post('/courses/preferences', json=payload).status_code == 400
+    response = client.post('/courses/preferences', json={'course_ids': [courses[0], 999, 998]})
+    assert response.status_code == 400 and response.json['course_ids'] == [999, 998]
+    assert CoursePreference.query.count() == 0
+
+    response = client.post('/courses/preferences', json={'course_ids': [courses[2], courses[0], courses[2]]})
+    assert response.json == {'course_ids': [courses[2], courses[0]]}
+    assert [(p.course_id, p.rank) for p in CoursePreference.query.order_by(CoursePreference.rank)] == \
+        [(courses[2], 1), (courses[0], 2)]
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_allocation_respects_capacity_and_ranking(courses, seed):
+    first, second, third = courses
+    students = make_students(5)
+    for student in students[:4]:
+        wish(student, first, second, third)
+    wish(students[4], second)  # Un seul vœu, peut-être plus disponible
+
+    result = allocate_courses(courses, seed=seed)
+    placed = enrolled()
+    by_course = {cid: sorted(rank for (_, course_id), (_, rank) in placed.items() if course_id == cid)
+                 for cid in courses}
+    assert len(by_course[first]) == 1 and len(by_course[second]) == 2
+    assert result == {'students': 5, 'assigned': 4 + ((students[4].id, second) in placed),
+                      'unassigned': (students[4].id, second) not in placed}
+    # Chacun reçoit son meilleur vœu encore libre à son tour : un cours moins bien classé
+    # n'est attribué que si les précédents sont complets
+    assert by_course[first] == [1] and len(by_course[third]) == 5 - 1 - 2 - result['unassigned']
+    assert all(source == 'allocation' for source, _ in placed.values())
+
+
+def test_incremental_allocation_keeps_existing_places(courses):
+    first, second, third = courses
+    early, late = make_students(2), make_students(2, prefix='t')
+    for student in early:
+        wish(student, first, second)
+    db.session.add(Enrollment(student_id=late[1].id, course_id=second))  # Inscription manuelle, hors vœux
+    db.session.commit()
+    assert allocate_courses(courses) == {'students': 2, 'assigned': 2, 'unassigned': 0}
+    before = enrolled()
+
+    for student in late:
+        wish(student, first, second, third)
+    assert allocate_courses(courses, incremental=True) == {'students': 1, 'assigned': 1, 'unassigned': 0}
+    after = enrolled()
+    assert {key: value for key, value in after.items() if key in before} == before
+    assert after[(late[0].id, third)] == ('allocation', 3)  # Cours 1 et 2 déjà complets
+
+    # Affectation complète : les places attribuées sont recalculées, l'inscription manuelle est gardée
+    allocate_courses(courses)
+    after = enrolled()
+    assert after[(late[1].id, second)] == ('manual', None)
+    assert sum(1 for (_, cid) in after if cid == second) == 2 and sum(1 for (_, cid) in after if cid == first) == 1
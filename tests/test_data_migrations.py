@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import scolarite_app
+from conftest import make_students
+from scolarite_app import (app, db, DataMigration, DataMigrationSpec, Student, DATA_MIGRATIONS, run_data_migration)
+
+
+@pytest.fixture
+def migration(database, monkeypatch):
+    """Migration de test sur la table student : enregistre les tranches traitées."""
+    monkeypatch.setitem(app.config, 'DATA_MIGRATION_SLEEP_RATIO', 0)
+    monkeypatch.setitem(app.config, 'DATA_MIGRATION_PAUSE_SECONDS', 0)
+    monkeypatch.setattr(scolarite_app, 'database_health', lambda: (0.0, 0))
+    chunks = []
+
+    def touch(connection, lower, upper):
+        chunks.append((lower, upper))
+        table = Student.__table__
+        return connection.execute(table.update().where(table.c.id > lower, table.c.id <= upper)
+                                  .values(first_name='migré')).rowcount
+
+    monkeypatch.setitem(DATA_MIGRATIONS, 'test-students', DataMigrationSpec('test-students', Student.__table__,
+                                                                            touch, ''))
+    make_students(10)
+    return chunks
+
+
+def state():
+    """(statut, last_id, terminée) ; la transaction de lecture est refermée pour ne pas bloquer la migration."""
+    row = db.session.get(DataMigration, 'test-students', populate_existing=True)
+    result = (row.status, row.last_id, row.finished_at is not None)
+    db.session.rollback()
+    return result
+
+
+def migrated():
+    ids = sorted(s.id for s in Student.query.filter_by(first_name='migré'))
+    db.session.rollback()
+    return ids
+
+
+def test_resumes_from_last_id(migration):
+    db.session.add(DataMigration(name='test-students', last_id=6, rows_done=6, status='paused'))
+    db.session.commit()
+    result = run_data_migration('test-students', chunk_size=2, report=lambda message: None)
+    assert result == {'last_id': 10, 'rows_done': 10, 'status': 'done'}
+    assert migration[0] == (6, 8)
+    assert migrated() == [7, 8, 9, 10]
+    assert state() == ('done', 10, True)
+    assert run_data_migration('test-students', report=lambda message: None)['status'] == 'done'
+    assert len(migration) == 2  # Terminée : pas de nouveau passage
+
+    run_data_migration('test-students', chunk_size=100, restart=True, report=lambda message: None)
+    assert migration[-1] == (0, 10) and migrated() == list(range(1, 11))
+
+
+def test_max_seconds_stops_after_a_chunk_and_resumes(migration, monkeypatch):
+    result = run_data_migration('test-students', chunk_size=3, max_seconds=1e-9, report=lambda message: None)
+    assert result == {'last_id': 3, 'rows_done': 3, 'status': 'paused'}
+    assert state() == ('paused', 3, False)
+    assert run_data_migration('test-students', chunk_size=3, report=lambda message: None)['status'] == 'done'
+    assert migration[1][0] == 3 and migrated() == list(range(1, 11))
+
+
+def test_waits_while_the_database_is_unhealthy(migration, monkeypatch):
+    health = iter([(30.0, 0), (None, 0), (0.0, 50), (0.0, 0)])
+    seen = []
+    monkeypatch.setattr(scolarite_app, 'database_health', lambda: next(health, (0.0, 0)))
+    monkeypatch.setattr(scolarite_app.time, 'sleep', lambda seconds: seen.append(state()[0]))
+    messages = []
+    run_data_migration('test-students', chunk_size=100, report=messages.append)
+    assert messages[0].startswith('Pause : retard de réplication 30 s') and messages[1] == 'Reprise.'
+    assert seen[:3] == ['waiting'] * 3
+    assert state()[0] == 'done'
+
+
+def test_only_one_process_runs_a_migration(migration):
+    now = datetime.now(timezone.utc)
+    db.session.add(DataMigration(name='test-students', last_id=0, rows_done=0, status='running', updated_at=now))
+    db.session.commit()
+    messages = []
+    assert run_data_migration('test-students', report=messages.append) == {'status': 'running'}
+    assert messages == ['test-students : déjà en cours dans un autre processus.'] and migration == []
+
+    # Processus arrêté sans nouvelles depuis plus que le délai de réservation
+    stale = now - timedelta(seconds=app.config['DATA_MIGRATION_CLAIM_TIMEOUT_SECONDS'] + 1)
+    DataMigration.query.update({'updated_at': stale})
+    db.session.commit()
+    assert run_data_migration('test-students', report=lambda message: None)['status'] == 'done'
@@ -0,0 +1,86 @@
+from datetime import datetime
+
+import pytest
+
+from conftest import make_students, make_teacher
+from scolarite_app import (db, Course, TeacherEvaluation, TeacherEvaluationStats, evaluation_stats,
+                           rebuild_evaluation_stats)
+
+AUTUMN = datetime(2025, 10, 1)
+
+
+@pytest.fixture
+def setup(database):
+    teacher = make_teacher('enseignant')[1]
+    courses = [Course(code=f'EVA{i}', name=f'Cours {i}', teacher_id=teacher.id) for i in range(2)]
+    db.session.add_all(courses)
+    db.session.commit()
+    return teacher, courses, make_students(4)
+
+
+def evaluate(teacher, course, student, rating):
+    evaluation = TeacherEvaluation(teacher_id=teacher.id, course_id=course.id, student_id=student.id, rating=rating,
+                                   created_at=AUTUMN)
+    db.session.add(evaluation)
+    db.session.commit()
+    return evaluation
+
+
+def stats():
+    db.session.expire_all()
+    return {row.course_id: (row.response_count, row.rating_sum, row.rating_sq_sum, row.histogram)
+            for row in TeacherEvaluationStats.query}
+
+
+def test_stats_follow_inserts_updates_and_deletes(setup):
+    teacher, (first, second), students = setup
+    evaluations = [evaluate(teacher, first, student, rating) for student, rating in zip(students, (5, 4, 4))]
+    row = evaluation_stats(teacher_id=teacher.id)[0]
+    assert (row.term, row.response_count, row.mean, round(row.variance, 4)) == ('2025-2026 S1', 3, 13 / 3, 0.3333)
+    assert row.histogram == {1: 0, 2: 0, 3: 0, 4: 2, 5: 1}
+
+    evaluations[0].rating = 2
+    db.session.commit()
+    assert stats()[first.id] == (3, 10, 36, {1: 0, 2: 1, 3: 0, 4: 2, 5: 0})
+
+    evaluations[1].course_id = second.id  # Déplacée d'un agrégat à l'autre
+    db.session.commit()
+    assert stats() == {first.id: (2, 6, 20, {1: 0, 2: 1, 3: 0, 4: 1, 5: 0}),
+                       second.id: (1, 4, 16, {1: 0, 2: 0, 3: 0, 4: 1, 5: 0})}
+
+    db.session.delete(evaluations[1])
+    db.session.commit()
+    assert stats()[second.id][0] == 0 and [r.course_id for r in evaluation_stats()] == [first.id]
+
+
+@pytest.mark.parametrize('rating', [0, 6, -1, True, None])
+def test_rating_outside_the_scale_is_rejected(setup, rating):
+    teacher, (course, _), students = setup
+    evaluation = evaluate(teacher, course, students[0], 3)
+    with pytest.raises(ValueError):
+        evaluation.rating = rating
+    with pytest.raises(ValueError):
+        TeacherEvaluation(teacher_id=teacher.id, course_id=course.id, student_id=students[1].id, rating=rating)
+    db.session.rollback()
+    assert stats()[course.id] == (1, 3, 9, {1: 0, 2: 0, 3: 1, 4: 0, 5: 0})
+
+
+def test_rebuild_matches_incremental_stats_and_skips_legacy_ratings(setup):
+    teacher, (first, second), students = setup
+    for student, rating in zip(students, (1, 3, 5, 5)):
+        evaluate(teacher, first, student, rating)
+    evaluate(teacher, second, students[0], 2)
+    legacy = TeacherEvaluation.__table__
+    db.session.execute(legacy.insert().values(teacher_id=teacher.id, course_id=first.id, student_id=students[1].id,
+                                              rating=9, created_at=AUTUMN))  # Ancienne ligne, hors contrôle
+    db.session.execute(legacy.update().where(legacy.c.rating == 2).values(term=None))
+    db.session.commit()
+    incremental = stats()
+
+    assert rebuild_evaluation_stats() == 2
+    assert stats() == incremental
+    assert TeacherEvaluation.query.filter_by(rating=2).one().term == '2025-2026 S1'
+
+    db.session.delete(TeacherEvaluation.query.filter_by(rating=9).one())  # Jamais comptée : rien à retirer
+    db.session.commit()
+    assert stats() == incremental
@@ -0,0 +1,77 @@
+from datetime import datetime
+
+from conftest import make_user, run_concurrently
+from scolarite_app import (db, Event, EventParticipant, User, cancel_registration, register_for_event,
+                           run_data_migration, REGISTRATION_CONFIRMED, REGISTRATION_WAITLISTED)
+
+
+def make_event(capacity):
+    organizer = make_user('organisateur', 'admin')
+    event = Event(title='Conférence', start_date=datetime(2030, 1, 15, 10), organizer_id=organizer.id,
+                  max_participants=capacity)
+    db.session.add(event)
+    db.session.commit()
+    return event.id
+
+
+def make_users(count):
+    users = [User(username=f'u{i}', email=f'u{i}@test', user_type='student', password_hash='x') for i in range(count)]
+    db.session.add_all(users)
+    db.session.commit()
+    return [user.id for user in users]
+
+
+def participants(event_id, status):
+    return EventParticipant.query.filter_by(event_id=event_id, status=status).count()
+
+
+def test_concurrent_registrations_respect_capacity(database):
+    event_id = make_event(10)
+    user_ids = make_users(40)
+
+    run_concurrently(register_for_event, [(event_id, user_id) for user_id in user_ids])
+
+    db.session.expire_all()
+    assert participants(event_id, REGISTRATION_CONFIRMED) == 10
+    assert participants(event_id, REGISTRATION_WAITLISTED) == 30
+    assert db.session.get(Event, event_id).confirmed_count == 10
+
+
+def test_concurrent_duplicate_requests_take_one_seat(database):
+    event_id = make_event(10)
+    user_ids = make_users(3)
+
+    results = run_concurrently(register_for_event, [(event_id, user_id) for user_id in user_ids for _ in range(6)])
+
+    db.session.expire_all()
+    assert all(result is not None for result in results)
+    assert EventParticipant.query.filter_by(event_id=event_id).count() == 3
+    assert db.session.get(Event, event_id).confirmed_count == 3
+
+
+def test_registration_after_cancellation_rejoins_the_queue(database):
+    event_id = make_event(1)
+    first, second, third = make_users(3)
+    seat = register_for_event(event_id, first)
+    register_for_event(event_id, second)
+    assert cancel_registration(seat.id)
+
+    again = register_for_event(event_id, first)
+
+    db.session.expire_all()
+    assert again.status == REGISTRATION_WAITLISTED
+    assert EventParticipant.query.filter_by(event_id=event_id, user_id=first).count() == 1
+    assert register_for_event(event_id, third).id > again.id  # Ordre d'arrivée conservé
+
+
+def test_backfill_counts_existing_confirmed_seats(database):
+    event_id = make_event(5)
+    user_ids = make_users(3)
+    db.session.add_all([EventParticipant(event_id=event_id, user_id=user_id, status=REGISTRATION_CONFIRMED)
+                        for user_id in user_ids])
+    db.session.commit()
+
+    run_data_migration('event-confirmed-counts', report=lambda message: None)
+
+    db.session.expire_all()
+    assert db.session.get(Event, event_id).confirmed_count == 3
@@ -0,0 +1,89 @@
+import io
+import os
+import threading
+from datetime import date
+
+import scolarite_app
+from conftest import login, make_students, make_teacher, make_user
+from scolarite_app import app, db, Course, CourseResource, Payment, User, store_stream, stored_sha256, thumbnail_path
+
+
+def test_private_documents_are_served_to_their_owner_and_staff_only(client):
+    owner, other = make_students(2)
+    payment = Payment(student_id=owner.id, amount=100.0, payment_date=date(2026, 1, 5), status='paid')
+    db.session.add(payment)
+    payment.receipt_path = store_stream(io.BytesIO(b'recu confidentiel'), 'application/pdf')
+    owner_user, other_user = db.session.get(User, owner.user_id), db.session.get(User, other.user_id)
+    other_user.profile_image = store_stream(io.BytesIO(b'photo'), 'image/jpeg')
+    db.session.commit()
+    receipt = f'/files/{stored_sha256(payment.receipt_path)}'
+    photo = f'/files/{stored_sha256(other_user.profile_image)}'
+    orphan = f"/files/{stored_sha256(store_stream(io.BytesIO(b'sans fiche')))}"
+    db.session.commit()
+
+    login(client, other_user)
+    assert client.get(receipt).status_code == 403
+    assert client.get(orphan).status_code == 403
+    assert client.get(photo).status_code == 200
+
+    login(client, owner_user)
+    assert client.get(receipt).data == b'recu confidentiel'
+    assert client.get(photo).status_code == 200  # Photo d'un autre utilisateur : visible
+
+    login(client, make_user('comptable', 'staff'))
+    assert client.get(receipt).status_code == 200
+    assert client.get(orphan).status_code == 200
+
+
+def test_only_the_course_teacher_attaches_course_resources(client):
+    owner, teacher = make_teacher('titulaire')
+    course = Course(code='MAT101', name='Analyse', teacher_id=teacher.id)
+    db.session.add(course)
+    db.session.flush()
+    resource = CourseResource(course_id=course.id, title='Polycopié')
+    db.session.add(resource)
+    db.session.commit()
+
+    def attach():
+        return client.post('/files', data={'file': (io.BytesIO(b'cours'), 'cours.pdf'), 'target': 'course_resource',
+                                           'id': resource.id}).status_code
+
+    login(client, make_teacher('autre')[0])
+    assert attach() == 403
+    login(client, db.session.get(User, make_students(1)[0].user_id))
+    assert attach() == 403
+    login(client, owner)
+    assert attach() == 201
+    db.session.expire_all()
+    assert stored_sha256(db.session.get(CourseResource, resource.id).file_path) is not None
+
+
+def photo(client):
+    from PIL import Image
+
+    image = io.BytesIO()
+    Image.new('RGB', (40, 20), 'red').save(image, 'PNG')
+    image.seek(0)
+    user = make_user('photographe', 'student')
+    user.profile_image = store_stream(image, 'image/png')
+    db.session.commit()
+    login(client, user)
+    return stored_sha256(user.profile_image)
+
+
+def test_thumbnails_are_rendered_once_without_leftover_files(client):
+    sha256 = photo(client)
+    response = client.get(f'/files/{sha256}/thumbnail/32')
+    assert response.status_code == 200 and response.mimetype == 'image/jpeg'
+    assert os.listdir(os.path.dirname(thumbnail_path(sha256, 32))) == [f'{sha256}.jpg']
+    assert client.get(f'/files/{sha256}/thumbnail/33').status_code == 404
+
+
+def test_slow_thumbnail_answers_503(client, monkeypatch):
+    sha256 = photo(client)
+    release = threading.Event()
+    monkeypatch.setitem(app.config, 'THUMBNAIL_TIMEOUT_SECONDS', 0.01)
+    monkeypatch.setattr(scolarite_app, '_render_thumbnail', lambda *args: release.wait(5))
+    response = client.get(f'/files/{sha256}/thumbnail/64')
+    release.set()
+    assert response.status_code == 503 and response.headers['Retry-After'] == '5'
@@ -0,0 +1,51 @@
+import base64
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import login, make_user
+from scolarite_app import db, Forum, ForumTopic
+
+
+def cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+@pytest.fixture
+def forum(client):
+    user = make_user('auteur', 'student')
+    login(client, user)
+    forum = Forum(title='Général', created_by=user.id)
+    db.session.add(forum)
+    db.session.flush()
+    start = datetime(2026, 1, 1)
+    db.session.add_all([ForumTopic(forum_id=forum.id, title=f'Sujet {i}', content='...', author_id=user.id,
+                                   created_at=start + timedelta(hours=i), is_sticky=i < 2) for i in range(7)])
+    db.session.commit()
+    return forum.id
+
+
+def test_topic_pages_follow_the_cursor(client, forum):
+    seen, after = [], None
+    while True:
+        page = client.get(f'/forums/{forum}/topics', query_string={'per_page': 3, **({'after': after} if after else {})}).json
+        seen.extend(topic['title'] for topic in page['topics'])
+        after = page['next']
+        if after is None:
+            break
+    assert seen == ['Sujet 1', 'Sujet 0', 'Sujet 6', 'Sujet 5', 'Sujet 4', 'Sujet 3', 'Sujet 2']
+
+
+@pytest.mark.parametrize('per_page', [0, -3])
+def test_page_size_has_a_lower_bound(client, forum, per_page):
+    page = client.get(f'/forums/{forum}/topics', query_string={'per_page': per_page})
+    assert page.status_code == 200
+    assert [topic['title'] for topic in page.json['topics']] == ['Sujet 1'] and page.json['next']
+
+
+@pytest.mark.parametrize('after', [cursor(['x']), cursor({'a': 1}), cursor([True, 'hier', 1]),
+                                   cursor(['1', '2026-01-01T00:00:00', 1]), cursor([True, '2026-01-01T00:00:00', 2 ** 70]),
+                                   '%%%', 'WyJ4Il0'])
+def test_malformed_cursor_is_rejected(client, forum, after):
+    assert client.get(f'/forums/{forum}/topics', query_string={'after': after}).status_code == 400
@@ -0,0 +1,65 @@
+import io
+from datetime import date
+
+import pytest
+
+from conftest import login, make_students, make_user
+from scolarite_app import db, Course, CourseAverage, Exam, Grade, run_data_migration
+
+
+@pytest.fixture
+def exam(database):
+    course = Course(code='MAT101', name='Analyse')
+    db.session.add(course)
+    db.session.flush()
+    exam = Exam(course_id=course.id, title='Partiel', max_score=20.0, exam_date=date(2026, 1, 12))
+    db.session.add(exam)
+    db.session.commit()
+    return exam
+
+
+def upload(client, rows):
+    sheet = 'matricule;examen;note\n' + ''.join(f'{m};{e};{v}\n' for m, e, v in rows)
+    return client.post('/teacher/grades/import', data={'file': (io.BytesIO(sheet.encode()), 'notes.csv')})
+
+
+def test_unreadable_exam_ids_are_line_errors(client, exam):
+    student = make_students(1)[0]
+    login(client, make_user('admin', 'admin'))
+    response = upload(client, [(student.matricule, 'inf', 12), (student.matricule, '1e30', 12),
+                               (student.matricule, '2.5', 12)])
+    assert response.status_code == 400
+    assert [e['row'] for e in response.json['errors']] == [2, 3, 4]
+    assert response.json['errors'][0]['error'] == 'Examen inconnu : inf'
+
+
+def test_averages_are_written_by_grade_writes_not_reads(client, exam):
+    student = make_students(1)[0]
+    # Note antérieure au cache : insérée sans passer par la session
+    db.session.execute(Grade.__table__.insert(), [{'student_id': student.id, 'course_id': exam.course_id,
+                                                    'exam_id': exam.id, 'value': 10.0, 'date': date(2026, 1, 12),
+                                                    'weight': 1.0, 'is_final': False}])
+    db.session.commit()
+    login(client, make_user('admin', 'admin'))
+
+    response = client.get(f'/api/grades/averages?course_id={exam.course_id}')
+    assert response.json['averages'][0]['average'] == 10.0
+    assert db.session.query(CourseAverage).count() == 0
+
+    assert upload(client, [(student.matricule, exam.id, 14)]).status_code == 200
+    assert db.session.get(CourseAverage, (student.id, exam.course_id)).average == 14.0
+
+    db.session.get(Grade, 1).value = 16.0
+    db.session.commit()
+    assert db.session.get(CourseAverage, (student.id, exam.course_id)).average == 16.0
+
+
+def test_backfill_fills_the_average_cache(exam):
+    students = make_students(3)
+    db.session.execute(Grade.__table__.insert(), [{'student_id': s.id, 'course_id': exam.course_id, 'exam_id': exam.id,
+                                                    'value': 8.0 + i, 'date': date(2026, 1, 12), 'weight': 1.0,
+                                                    'is_final': False} for i, s in enumerate(students)])
+    db.session.commit()
+    run_data_migration('course-averages', report=lambda message: None)
+    db.session.expire_all()
+    assert sorted(a.average for a in CourseAverage.query) == [8.0, 9.0, 10.0]
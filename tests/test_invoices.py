@@ -0,0 +1,65 @@
+from datetime import date
+
+import pytest
+
+from conftest import run_concurrently
+from scolarite_app import app, db, InvoiceNumberAllocator, InvoiceSequence
+
+DAY = date(2026, 3, 1)
+
+
+def numbers_of(invoices):
+    return [int(invoice.rsplit('-', 1)[1]) for invoice in invoices]
+
+
+@pytest.fixture
+def block_size():
+    previous = app.config['INVOICE_BLOCK_SIZE']
+    app.config['INVOICE_BLOCK_SIZE'] = 20
+    yield 20
+    app.config['INVOICE_BLOCK_SIZE'] = previous
+
+
+def test_concurrent_allocators_never_share_a_number(database, block_size):
+    # Un allocateur par « processus », partagé par plusieurs threads
+    allocators = [InvoiceNumberAllocator() for _ in range(4)]
+
+    def allocate(allocator):
+        return [allocator.next_number(DAY) for _ in range(75)]
+
+    batches = run_concurrently(allocate, [(allocators[i % 4],) for i in range(16)])
+
+    numbers = [n for batch in batches for n in numbers_of(batch)]
+    assert len(numbers) == len(set(numbers)) == 16 * 75
+    for batch in batches:
+        assert numbers_of(batch) == sorted(numbers_of(batch))  # Croissants pour un même appelant
+    # Chaque bloc réservé n'est distribué que par un seul allocateur
+    owners = {}
+    for i, batch in enumerate(batches):
+        for number in numbers_of(batch):
+            owners.setdefault((number - 1) // block_size, set()).add(i % 4)
+    assert all(len(owner) == 1 for owner in owners.values())
+    reserved = db.session.get(InvoiceSequence, InvoiceNumberAllocator.prefix_for(DAY)).next_value - 1
+    assert max(numbers) <= reserved and reserved % block_size == 0
+
+
+def test_each_block_is_handed_out_in_order(database, block_size):
+    allocator = InvoiceNumberAllocator()
+    numbers = numbers_of(allocator.next_number(DAY) for _ in range(3 * block_size))
+    assert numbers == list(range(1, 3 * block_size + 1))
+
+
+def test_gapless_policy_allocates_unique_consecutive_numbers(database):
+    app.config['INVOICE_GAP_POLICY'] = 'gapless'
+    try:
+        allocator = InvoiceNumberAllocator()
+
+        def allocate():
+            number = allocator.next_number(DAY)
+            db.session.commit()
+            return number
+
+        numbers = numbers_of(run_concurrently(allocate, [()] * 60))
+    finally:
+        app.config['INVOICE_GAP_POLICY'] = 'blocks'
+    assert sorted(numbers) == list(range(1, 61))
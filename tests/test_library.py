@@ -0,0 +1,121 @@
+from datetime import date, timedelta
+
+from conftest import login, make_students, make_user, run_concurrently
+from scolarite_app import (app, db, User, LibraryBook, LibraryHold, LibraryLoan, Notification, checkout_book,
+                           compute_overdue_fines, days_between, loan_fine, place_hold, return_book, HOLD_STATUS_READY,
+                           HOLD_STATUS_WAITING, LOAN_STATUS_BORROWED, LOAN_STATUS_OVERDUE, LOAN_STATUS_RETURNED)
+
+
+def _user(student):
+    return db.session.get(User, student.user_id)
+
+
+def make_book(copies):
+    book = LibraryBook(title='Algèbre', author='Auteur', quantity=copies, available=copies)
+    db.session.add(book)
+    db.session.commit()
+    return book
+
+
+def test_concurrent_checkouts_never_oversell(database):
+    students = make_students(40)
+    book_id = make_book(5).id
+
+    loans = run_concurrently(checkout_book, [(book_id, s.id) for s in students])
+
+    granted = [loan for loan in loans if loan is not None]
+    db.session.expire_all()
+    assert len(granted) == 5
+    assert LibraryLoan.query.filter_by(book_id=book_id).count() == 5
+    assert db.session.get(LibraryBook, book_id).available == 0
+
+
+def test_concurrent_returns_serve_holds_in_order(database):
+    students = make_students(8)
+    book = make_book(3)
+    loans = [checkout_book(book.id, s.id) for s in students[:3]]
+    holds = [place_hold(book.id, s.id) for s in students[3:5]]
+    loan_ids = [loan.id for loan in loans]
+
+    returned = run_concurrently(return_book, [(loan_id,) for loan_id in loan_ids + loan_ids])
+
+    db.session.expire_all()
+    assert returned.count(True) == 3  # Un second retour du même prêt est refusé
+    assert [db.session.get(LibraryHold, h.id).status for h in holds] == [HOLD_STATUS_READY, HOLD_STATUS_READY]
+    assert db.session.get(LibraryBook, book.id).available == 1
+    assert LibraryHold.query.filter_by(status=HOLD_STATUS_WAITING).count() == 0
+
+
+def test_return_fixes_fine_on_return_date(database):
+    student, = make_students(1)
+    book = make_book(1)
+    today = date(2026, 3, 20)
+    loan = checkout_book(book.id, student.id, today=today - timedelta(days=20))
+
+    assert return_book(loan.id, today=today)
+    db.session.expire_all()
+    loan = db.session.get(LibraryLoan, loan.id)
+    assert loan.status == LOAN_STATUS_RETURNED
+    assert loan.fine_amount == 6 * app.config['LIBRARY_DAILY_FINE']
+
+
+def test_only_borrower_or_staff_can_return(client):
+    owner, other = make_students(2)
+    book = make_book(2)
+    loan = checkout_book(book.id, owner.id)
+
+    login(client, _user(other))
+    assert client.post(f'/library/loans/{loan.id}/return').status_code == 403
+
+    login(client, _user(owner))
+    assert client.post(f'/library/loans/{loan.id}/return').status_code == 200
+
+    second = checkout_book(book.id, other.id)
+    login(client, make_user('bibliothecaire', 'staff'))
+    assert client.post(f'/library/loans/{second.id}/return').status_code == 200
+
+
+def test_overdue_fines_follow_the_number_of_late_days(database):
+    today = date(2026, 3, 1)
+    students = make_students(5)
+    book = make_book(5)
+    ages = {'not_due': -3, 'due_today': 0, 'one_day': 1, 'leap_month': 30, 'over_a_year': 400}
+
+    def loan(student, age, status=LOAN_STATUS_BORROWED, **columns):
+        due = today - timedelta(days=age)
+        record = LibraryLoan(book_id=book.id, student_id=student.id, checkout_date=due - timedelta(days=14),
+                             due_date=due, status=status, **columns)
+        db.session.add(record)
+        return record
+
+    loans = {name: loan(student, age) for student, (name, age) in zip(students, ages.items())}
+    loans['already_overdue'] = loan(students[0], 5, LOAN_STATUS_OVERDUE, fine_amount=0.0)
+    returned = loan(students[1], 20, LOAN_STATUS_RETURNED, return_date=today - timedelta(days=12), fine_amount=800.0)
+    db.session.commit()
+
+    # days_between calculé par la base = différence de dates Python, y compris 29 février et changement d'année
+    for age in list(ages.values()) + [365, 366]:
+        due = today - timedelta(days=age)
+        assert db.session.scalar(db.select(days_between(db.literal(today, db.Date), db.literal(due, db.Date)))) == age
+
+    assert compute_overdue_fines(today) == {'extended': 1, 'new_overdue': 3, 'reminders': 3}
+    db.session.expire_all()
+    rate = app.config['LIBRARY_DAILY_FINE']
+    assert {name: (record.status, record.fine_amount) for name, record in loans.items()} == {
+        'not_due': (LOAN_STATUS_BORROWED, 0.0),
+        'due_today': (LOAN_STATUS_BORROWED, 0.0),
+        'one_day': (LOAN_STATUS_OVERDUE, rate),
+        'leap_month': (LOAN_STATUS_OVERDUE, 30 * rate),
+        'over_a_year': (LOAN_STATUS_OVERDUE, 400 * rate),
+        'already_overdue': (LOAN_STATUS_OVERDUE, 5 * rate),
+    }
+    assert all(record.fine_amount == loan_fine(record.due_date, today) for record in loans.values())
+    assert (returned.status, returned.fine_amount) == (LOAN_STATUS_RETURNED, 800.0)  # Fixée au retour
+    assert Notification.query.filter_by(notification_type='library_overdue').count() == 3
+
+    # Une seule mise à jour par jour ; le lendemain, les pénalités avancent d'un jour
+    assert compute_overdue_fines(today) == {'extended': 0, 'new_overdue': 0, 'reminders': 0}
+    assert compute_overdue_fines(today + timedelta(days=1)) == {'extended': 4, 'new_overdue': 1, 'reminders': 1}
+    db.session.expire_all()
+    assert (loans['one_day'].fine_amount, loans['due_today'].fine_amount, returned.fine_amount) == \
+        (2 * rate, rate, 800.0)
@@ -0,0 +1,147 @@
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+import scolarite_app
+from conftest import make_students
+from scolarite_app import (app, db, Absence, Course, DocumentRequest, MailRateLimiter, OutboundEmail, ParentNotice,
+                           SMTPSink, SMTPTransport, collect_outbound_emails, deliver_outbound_emails, enqueue_email,
+                           mail_claim_limit)
+
+
+class NoWait:
+    def acquire(self):
+        pass
+
+
+@pytest.fixture
+def mail(database, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAIL_DIGEST_WINDOW_SECONDS', 0)
+    sinks, transports = [], []
+
+    def start(**options):
+        sink = SMTPSink(port=0, **options).start()
+        transport = SMTPTransport(dict(app.config, MAIL_SERVER='127.0.0.1', MAIL_PORT=sink.server_address[1]))
+        sinks.append(sink)
+        transports.append(transport)
+        return sink, transport
+
+    yield start
+    for transport in transports:
+        transport.close()
+    for sink in sinks:
+        sink.stop()
+
+
+def queued(recipient, subject='Sujet', count=1):
+    for i in range(count):
+        enqueue_email(recipient, subject, f'Message {i}', 'notification', None)
+    db.session.commit()
+
+
+def test_one_digest_per_recipient_over_one_connection(mail):
+    sink, transport = mail()
+    first, second = make_students(2)
+    first.parent_email = second.parent_email = 'parent@test'
+    course = Course(code='MAT101', name='Analyse')
+    db.session.add(course)
+    db.session.flush()
+    for student in (first, second):
+        absence = Absence(student_id=student.id, course_id=course.id, date=date(2026, 1, 5))
+        db.session.add(absence)
+        db.session.flush()
+        db.session.add(ParentNotice(student_id=student.id, absence_id=absence.id))
+    db.session.add(DocumentRequest(student_id=first.id, document_type='certificate', request_date=date(2026, 1, 5),
+                                   status='completed', notify_ready=True))
+    db.session.commit()
+
+    assert collect_outbound_emails() == {'parent_notice': 2, 'document': 1, 'notification': 0}
+    assert collect_outbound_emails() == {'parent_notice': 0, 'document': 0, 'notification': 0}
+    assert deliver_outbound_emails(transport, NoWait()) == {'sent': 3, 'retry': 0, 'failed': 0}
+
+    subjects = sorted((str(m['To']), str(m['Subject'])) for m in sink.messages)
+    assert subjects == [('parent@test', 'Scolarité : 2 nouveaux messages'),
+                        ('s0@test', 'Document disponible : Certificat de scolarité')]
+    assert sink.connections == 1
+
+
+def test_source_queued_by_another_worker_is_skipped(mail, monkeypatch):
+    student = make_students(1)[0]
+    request = DocumentRequest(student_id=student.id, document_type='diploma', request_date=date(2026, 1, 5),
+                              status='completed', notify_ready=True)
+    db.session.add(request)
+    db.session.commit()
+    enqueue_email('s0@test', 'Document disponible', 'Déjà en file', 'document', request.id)
+    db.session.commit()
+    # Lecture antérieure au commit de l'autre worker : l'anti-jointure ne voit pas la ligne
+    monkeypatch.setattr(scolarite_app, '_not_queued', lambda source, column: db.true())
+
+    assert collect_outbound_emails()['document'] == 0
+    assert OutboundEmail.query.count() == 1
+
+
+def test_temporary_refusal_is_retried_later(mail):
+    sink, transport = mail(fail_rate=1.0)
+    queued('eleve@test')
+    assert deliver_outbound_emails(transport, NoWait()) == {'sent': 0, 'retry': 1, 'failed': 0}
+
+    email = OutboundEmail.query.one()
+    assert (email.status, email.attempts) == ('pending', 1)
+    assert '451' in email.last_error
+    earliest = datetime.now(timezone.utc) + timedelta(seconds=app.config['MAIL_RETRY_BASE_SECONDS'] / 2 - 5)
+    assert email.next_attempt_at.replace(tzinfo=timezone.utc) >= earliest
+    assert deliver_outbound_emails(transport, NoWait()) == {'sent': 0, 'retry': 0, 'failed': 0}  # Pas encore dû
+
+
+def test_permanent_refusal_and_last_attempt_fail(mail):
+    sink, transport = mail(fail_rate=1.0, rejected=['inconnu@test'])
+    queued('inconnu@test')
+    queued('eleve@test')
+    OutboundEmail.query.filter_by(recipient='eleve@test').update({'attempts': app.config['MAIL_MAX_ATTEMPTS'] - 1})
+    db.session.commit()
+
+    assert deliver_outbound_emails(transport, NoWait()) == {'sent': 0, 'retry': 0, 'failed': 2}
+    assert {e.status for e in OutboundEmail.query} == {'failed'}
+    assert '550' in OutboundEmail.query.filter_by(recipient='inconnu@test').one().last_error
+
+
+def test_message_that_cannot_be_composed_does_not_block_the_queue(mail):
+    sink, transport = mail()
+    enqueue_email('a@test', 'Ligne\r\ncoupée', 'Corps', 'notification', None)
+    db.session.commit()
+    assert OutboundEmail.query.one().subject == 'Ligne coupée'
+
+    # Ligne mise en file avant le filtrage des sauts de ligne
+    OutboundEmail.query.update({'subject': 'Ligne\ncoupée'})
+    queued('b@test')
+    assert deliver_outbound_emails(transport, NoWait()) == {'sent': 1, 'retry': 0, 'failed': 1}
+    assert [str(m['To']) for m in sink.messages] == ['b@test']
+    assert OutboundEmail.query.filter_by(recipient='a@test').one().status == 'failed'
+
+
+def test_claim_is_capped_by_what_the_rate_sends_in_time(mail, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAIL_RATE_PER_MINUTE', 6)
+    monkeypatch.setitem(app.config, 'MAIL_CLAIM_TIMEOUT_SECONDS', 600)
+    assert mail_claim_limit() == 30
+    monkeypatch.setitem(app.config, 'MAIL_RATE_PER_MINUTE', 6000)
+    assert mail_claim_limit() == app.config['MAIL_BATCH_RECIPIENTS']
+
+    sink, transport = mail()
+    monkeypatch.setitem(app.config, 'MAIL_RATE_PER_MINUTE', 1)
+    monkeypatch.setitem(app.config, 'MAIL_CLAIM_TIMEOUT_SECONDS', 120)
+    for i in range(3):
+        queued(f'e{i}@test')
+    assert deliver_outbound_emails(transport, NoWait())['sent'] == 1
+    assert OutboundEmail.query.filter_by(status='pending').count() == 2
+
+
+def test_rate_limiter_spaces_sends_after_the_burst():
+    limiter = MailRateLimiter(1200)  # 20 par seconde, rafale de 120
+    started = time.monotonic()
+    for _ in range(120):
+        limiter.acquire()
+    assert time.monotonic() - started < 0.05
+    for _ in range(4):
+        limiter.acquire()
+    assert time.monotonic() - started >= 4 / 20 - 0.01
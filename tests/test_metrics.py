@@ -0,0 +1,69 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from scolarite_app import app, MetricsRegistry
+
+
+@pytest.fixture
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'METRICS_DIR', str(tmp_path))
+    return tmp_path
+
+
+def dead_pid():
+    child = subprocess.Popen([sys.executable, '-c', 'pass'])
+    child.wait()
+    return child.pid
+
+
+def write_state(directory, pid, token, requests, gauge):
+    with open(directory / f'metrics-{pid}-{token}.json', 'w') as out:
+        json.dump({
+            'pid': pid,
+            'counters': [['http_requests_total', [['status', '200']], requests]],
+            'histograms': [],
+            'gauges': [['worker_queue_depth', [], gauge]],
+        }, out)
+
+
+def test_dead_workers_are_folded_into_retired_counters(metrics_dir):
+    registry = MetricsRegistry()
+    registry.inc('http_requests_total', (('status', '200'),), 2)
+    write_state(metrics_dir, dead_pid(), 'a1', 5, 7)
+
+    for _ in range(2):  # Le second passage ne doit pas recompter le worker arrêté
+        counters, _, gauges = registry.collect()
+        assert counters[('http_requests_total', (('status', '200'),))] == 7
+        assert ('worker_queue_depth', ()) not in gauges
+    assert sorted(os.listdir(metrics_dir)) == ['retired.json', 'retired.lock']
+
+
+def test_reused_pid_keeps_previous_incarnation(metrics_dir):
+    registry = MetricsRegistry()
+    write_state(metrics_dir, os.getpid(), 'ancien', 3, 1)
+    registry.inc('http_requests_total', (('status', '200'),))
+    registry.maybe_flush(force=True)
+
+    counters, _, _ = registry.collect()
+    assert counters[('http_requests_total', (('status', '200'),))] == 4
+    assert not (metrics_dir / f'metrics-{os.getpid()}-ancien.json').exists()
+    assert (metrics_dir / f'metrics-{os.getpid()}-{registry.token}.json').exists()
+
+
+def test_metrics_endpoint_is_local_unless_a_token_is_set(monkeypatch):
+    client = app.test_client()
+    assert client.get('/metrics').status_code == 200  # Client de test : 127.0.0.1
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.5'}).status_code == 403
+    monkeypatch.setitem(app.config, 'METRICS_PUBLIC', True)
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.5'}).status_code == 200
+
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'secret')
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer autre'}).status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer secret'},
+                          environ_base={'REMOTE_ADDR': '203.0.113.5'})
+    assert response.status_code == 200 and 'worker_queue_depth{queue="thumbnail"} 0' in response.text
@@ -0,0 +1,45 @@
+import sqlite3
+
+from scolarite_app import InstrumentedQueuePool
+
+
+def make_pool(**options):
+    return InstrumentedQueuePool(lambda: sqlite3.connect(':memory:', check_same_thread=False), **options)
+
+
+def test_each_pool_keeps_its_own_stats():
+    pool, other = make_pool(pool_size=1, max_overflow=2), make_pool(pool_size=1)
+    first, second = pool.connect(), pool.connect()
+    assert (pool.stats.in_use, pool.stats.checkouts, pool.stats.connects, pool.stats.overflow_opened) == (2, 2, 2, 1)
+    first.close()
+    second.close()
+    pool.connect().close()
+    snapshot = pool.stats.snapshot(pool)
+    assert (snapshot['in_use'], snapshot['peak_in_use'], snapshot['checkouts'], snapshot['connects']) == (0, 2, 3, 2)
+    assert (snapshot['pool_size'], snapshot['idle']) == (1, 1)
+    assert sum(snapshot['wait_histogram_ms'].values()) == 3
+    assert (other.stats.checkouts, other.stats.connects) == (0, 0)
+
+
+def test_recreated_pool_keeps_counting_once():
+    pool = make_pool(pool_size=1)
+    pool.connect().close()
+    recreated = pool.recreate()
+    pool.dispose()
+    recreated.connect().close()
+    assert recreated.stats is pool.stats and recreated.stats.pool is recreated
+    assert (recreated.stats.checkouts, recreated.stats.connects, recreated.stats.in_use) == (2, 2, 0)
+
+
+def test_recycles_and_invalidations():
+    pool = make_pool(pool_size=1, recycle=3600)
+    pool.connect().close()
+    pool._recycle = 0  # Connexion trop ancienne au prochain emprunt
+    pool.connect().close()
+    pool._recycle = 3600
+    assert (pool.stats.connects, pool.stats.recycles) == (2, 1)
+    connection = pool.connect()
+    connection.invalidate()
+    connection.close()
+    pool.connect().close()
+    assert (pool.stats.invalidations, pool.stats.preping_failures, pool.stats.connects, pool.stats.recycles) == (1, 0, 3, 1)
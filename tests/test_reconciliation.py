@@ -0,0 +1,59 @@
+import csv
+import io
+from datetime import date
+
+from conftest import make_students
+from scolarite_app import db, Payment, StudentBalance, reconcile_statement, PAYMENT_STATUS_PENDING
+
+
+def pending(student, amount, day, **columns):
+    payment = Payment(student_id=student.id, amount=amount, payment_date=day, status=PAYMENT_STATUS_PENDING,
+                      **columns)
+    db.session.add(payment)
+    return payment
+
+
+def reconcile(lines):
+    report = io.StringIO()
+    stats = reconcile_statement(io.StringIO('date;amount;reference;label\n' + '\n'.join(lines) + '\n'), report)
+    db.session.expire_all()
+    rows = list(csv.DictReader(io.StringIO(report.getvalue()), delimiter=';'))
+    return stats, {int(row['line']): row['reason'] for row in rows}
+
+
+def test_statement_matches_by_reference_and_amount(database):
+    student = make_students(1)[0]
+    by_transaction = pending(student, 450.0, date(2026, 1, 5), transaction_id='VIR-001')
+    by_invoice = pending(student, 120.5, date(2026, 1, 5), invoice_number='FAC-2026-00001')
+    by_amount = pending(student, 80.0, date(2026, 1, 10))
+    partial = pending(student, 300.0, date(2026, 1, 5), transaction_id='VIR-002')
+    db.session.commit()
+
+    stats, reasons = reconcile([
+        '2026-01-06;450,00;vir-001;Frais',
+        '06/01/2026;120.50;;Facture FAC-2026-00001',
+        '2026-01-12;80;;Virement',
+        '2026-01-06;100,00;VIR-002;Acompte',
+        '2026-01-06;inf;;Ligne corrompue',
+        '2026-01-06;nan;;Ligne corrompue',
+        '2026-01-06;999,00;;Inconnu',
+    ])
+
+    assert (stats['lines'], stats['matched'], stats['validated'], stats['unmatched']) == (7, 3, 3, 4)
+    assert stats['methods'] == {'transaction': 1, 'invoice': 1, 'amount': 1}
+    assert reasons[5] == 'montant différent'
+    assert reasons[6].startswith('illisible') and reasons[7].startswith('illisible')
+    assert reasons[8] == 'aucun paiement en attente'
+    assert [p.status for p in (by_transaction, by_invoice, by_amount, partial)] == \
+        ['validated', 'validated', 'validated', 'pending']
+    assert db.session.get(StudentBalance, student.id).due_total == 300.0
+
+
+def test_amount_match_respects_date_tolerance_and_single_use(database):
+    student = make_students(1)[0]
+    pending(student, 50.0, date(2026, 1, 5))
+    db.session.commit()
+
+    stats, reasons = reconcile(['2026-01-20;50;;Trop tard', '2026-01-06;50;;A', '2026-01-06;50;;B'])
+    assert stats['validated'] == 1
+    assert sorted(reasons) == [2, 4]
@@ -0,0 +1,69 @@
+from datetime import date, time
+
+import pytest
+
+from scolarite_app import (db, Course, CourseSchedule, CourseSession, cancel_occurrence, expand_schedule,
+                           override_occurrence, timetable)
+
+
+@pytest.fixture
+def course(database):
+    course = Course(code='MAT101', name='Analyse', start_date=date(2026, 1, 5), end_date=date(2026, 2, 27))
+    db.session.add(course)
+    db.session.commit()
+    return course
+
+
+def weekly(course, weekday=0, **columns):
+    schedule = CourseSchedule(course_id=course.id, weekday=weekday, start_time=time(8), end_time=time(10), **columns)
+    db.session.add(schedule)
+    db.session.commit()
+    return schedule
+
+
+def days(occurrences):
+    return [o.session_date for o in occurrences]
+
+
+def test_expand_schedule_only_computes_the_requested_range(course):
+    mondays = weekly(course)
+    assert days(expand_schedule(mondays, course, date(2026, 1, 14), date(2026, 2, 3))) == \
+        [date(2026, 1, 19), date(2026, 1, 26), date(2026, 2, 2)]
+    # Fin du cours avant la fin de la plage ; end est exclue
+    assert days(expand_schedule(mondays, course, date(2026, 2, 20), date(2026, 3, 31)))[-1] == date(2026, 2, 23)
+    assert days(expand_schedule(mondays, course, date(2026, 1, 5), date(2026, 1, 12))) == [date(2026, 1, 5)]
+
+    fortnightly = weekly(course, weekday=2, interval_weeks=2, start_date=date(2026, 1, 8))
+    assert days(expand_schedule(fortnightly, course, date(2026, 1, 20), date(2026, 2, 28))) == \
+        [date(2026, 1, 28), date(2026, 2, 11), date(2026, 2, 25)]
+    assert days(expand_schedule(mondays, course, date(2026, 1, 5), date(2026, 1, 31),
+                                skipped={date(2026, 1, 12)})) == [date(2026, 1, 5), date(2026, 1, 19), date(2026, 1, 26)]
+
+
+def test_expand_schedule_without_dates(database):
+    course = Course(code='LIB100', name='Sans dates')
+    db.session.add(course)
+    db.session.commit()
+    assert days(expand_schedule(weekly(course), course, date(2026, 1, 1), date(2026, 2, 1))) == []
+    open_ended = weekly(course, weekday=4, start_date=date(2026, 1, 2))
+    assert days(expand_schedule(open_ended, course, date(2026, 1, 1), date(2026, 1, 17))) == \
+        [date(2026, 1, 2), date(2026, 1, 9), date(2026, 1, 16)]
+
+
+def test_timetable_merges_sessions_exceptions_and_overrides(course):
+    mondays = weekly(course)
+    cancel_occurrence(mondays.id, date(2026, 1, 12))
+    moved = override_occurrence(mondays.id, date(2026, 1, 19), session_date=date(2026, 1, 20), start_time=time(14),
+                                end_time=time(16))
+    db.session.add(CourseSession(course_id=course.id, session_date=date(2026, 1, 21), start_time=time(9),
+                                 end_time=time(11)))
+    db.session.commit()
+
+    sessions = timetable([course.id], date(2026, 1, 5), date(2026, 1, 27))
+    assert [(o.session_date, o.start_time) for o in sessions] == [
+        (date(2026, 1, 5), time(8)), (date(2026, 1, 20), time(14)), (date(2026, 1, 21), time(9)),
+        (date(2026, 1, 26), time(8))]
+    assert sessions[1].session_id == moved.id and sessions[1].schedule_id == mondays.id
+    assert sessions[0].session_id is None
+    assert timetable([course.id], date(2026, 3, 1), date(2026, 3, 8)) == []
+    assert timetable([], date(2026, 1, 1), date(2026, 2, 1)) == []
@@ -0,0 +1,24 @@
+from datetime import datetime, timedelta, timezone
+
+from conftest import make_user
+from scolarite_app import db, LogPartition, UserLog, log_partition_table, rotate_user_logs
+
+
+def test_rotation_cuts_months_in_utc(database):
+    user = make_user('admin', 'admin')
+    db.session.add_all([
+        UserLog(matricule=user.id, action='avant minuit', timestamp=datetime(2026, 1, 31, 23, 30)),
+        UserLog(matricule=user.id, action='après minuit', timestamp=datetime(2026, 2, 1, 0, 30)),
+    ])
+    db.session.commit()
+
+    # 1er février 01:00 UTC, encore le 31 janvier à l'heure locale (UTC-5)
+    moved = rotate_user_logs(now=datetime(2026, 1, 31, 20, 0, tzinfo=timezone(timedelta(hours=-5))))
+
+    assert moved == 1
+    assert [log.action for log in UserLog.query] == ['après minuit']
+    january = log_partition_table('202601')
+    assert [row.Action for row in db.session.execute(db.select(january))] == ['avant minuit']
+    assert db.session.get(LogPartition, '202601').row_count == 1
+    january.drop(bind=db.session.connection())
+    db.session.commit()